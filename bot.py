@@ -1,20 +1,30 @@
 ﻿import telebot
 from telebot import types
+from telebot.apihelper import ApiTelegramException
 import logging
 import re
 import json
+import base64
 import threading
+import heapq
 import shutil
 import os
+import queue
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
 import pytz  # For timezone support
+import requests
+from requests.adapters import HTTPAdapter
 from config import BOT_TOKEN, ADMIN_CHAT_ID, PAYMENT_CHANNEL_ID, SERVERS as CONFIG_SERVERS, PLANS, PAYMENT_INFO, MESSAGES, DATABASE_PATH
+from config import BOT_WORKER_THREADS, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET
 from database import (
-    init_db, create_user, get_user, has_used_free_test, mark_free_test_used,
+    init_db, create_user, create_users_batch, get_user, has_used_free_test, get_free_test_status, mark_free_test_used,
     create_order, update_order_screenshot, approve_order, approve_order_atomic, reject_order,
-    get_order, get_user_orders, save_vpn_key, get_user_keys, get_vpn_key_by_id, update_vpn_key,
-    get_sales_stats, get_all_orders, get_expiring_keys, get_all_users,
-    deactivate_vpn_key, log_security_event,
+    get_order, get_user_orders, get_awaiting_screenshot_order, save_vpn_key, approve_and_save_key, get_user_keys, count_user_keys, get_key_position, get_vpn_key_by_id, update_vpn_key,
+    get_sales_stats, get_all_orders, count_orders, get_expiring_keys, get_all_users, count_users, iter_all_users,
+    deactivate_vpn_keys, log_security_event,
     # Referral system
     get_referral_code, get_user_by_referral_code, add_referral, 
     mark_referral_paid, get_referral_stats, claim_free_month_reward, get_referrer_id,
@@ -24,12 +34,12 @@ from database import (
     # Protocol settings
     get_protocol_enabled, set_protocol_enabled, get_all_protocol_settings, get_enabled_protocols,
     # User ban system
-    ban_user, unban_user, is_user_banned as is_user_banned_db, 
+    ban_user as ban_user_db, unban_user as unban_user_db, is_user_banned as is_user_banned_db, 
     get_banned_users, get_user_ban_history,
     # Statistics
     get_statistics, get_revenue_by_period, get_top_users,
     # Server management
-    add_server, update_server, delete_server, get_server, get_all_db_servers, toggle_server_active,
+    add_server, update_server, delete_server, get_server, get_all_db_servers, toggle_server_active, set_server_disabled, get_disabled_servers,
     # Free key stats
     get_free_test_stats, get_free_key_conversions, get_free_key_server_stats,
     # Screenshot duplicate detection
@@ -37,7 +47,7 @@ from database import (
     # Stale order cleanup
     cancel_stale_orders
 )
-from xui_api import create_vpn_key, get_available_protocols, delete_vpn_client, verify_client_exists, set_server_alert_callback
+from xui_api import XUIApi, encode_vmess_link, create_vpn_key, get_available_protocols, delete_vpn_client, list_all_clients, set_server_alert_callback, invalidate_protocol_cache
 from security import (
     rate_limiter, InputValidator, is_valid_callback, SecurityLogger,
     abuse_detector, VALID_CALLBACK_PREFIXES
@@ -56,10 +66,13 @@ except ImportError as e:
 REQUIRED_CHANNEL_ID = "@BurmeseDigitalStore"  # Channel username (with @)
 REQUIRED_CHANNEL_LINK = "https://t.me/BurmeseDigitalStore"
 
+# Bot username for t.me links - replaced with the real one from get_me() at startup
+BOT_USERNAME = "BurmeseDigitalStore_bot"
+
 # Auto-approve settings
 AUTO_APPROVE_ENABLED = True  # Enable/disable auto-approve
 AUTO_APPROVE_TIMEOUT = 100  # ~1.5 min - gives admin time to review before auto-approve
-pending_auto_approvals = {}  # {order_id: {'timer': timer, 'data': {...}}}
+pending_auto_approvals = {}  # {order_id: approval data incl. 'due_at'}
 
 # Protocol display names
 PROTOCOL_NAMES = {
@@ -70,6 +83,60 @@ PROTOCOL_NAMES = {
     'wireguard': '🛡️ WireGuard'
 }
 
+# Static part of a VMess share link (per-client fields are filled in when building links)
+VMESS_CONFIG_TEMPLATE = {
+    "v": "2",
+    "ps": "",
+    "add": "",
+    "port": "",
+    "id": "",
+    "aid": "0",
+    "net": "tcp",
+    "type": "none",
+    "tls": ""
+}
+
+# Protocol menu order (Trojan first) and button labels - Trojan is always recommended
+PROTOCOL_PRIORITY = ('trojan', 'vless', 'vmess', 'shadowsocks', 'wireguard')
+_PROTOCOL_RANK = {proto: i for i, proto in enumerate(PROTOCOL_PRIORITY)}
+_PROTOCOL_BUTTON_LABELS = {
+    proto: name + " ⭐" if proto == 'trojan' else name
+    for proto, name in PROTOCOL_NAMES.items()
+}
+
+# Protocol buttons on the key exchange screen
+_EXCHANGE_PROTOCOL_LABELS = {
+    'trojan': '⭐ Trojan (အကောင်းဆုံး)',
+    'vless': 'VLESS',
+    'vmess': 'VMess',
+    'shadowsocks': 'Shadowsocks',
+    'wireguard': 'WireGuard'
+}
+
+# Device count embedded in client emails ("username - 2D / Key 1")
+_DEVICE_RE = re.compile(r'(\d+)D')
+
+# Stand-in for a key whose server was removed (read-only, shared)
+_EMPTY_SERVER = {}
+
+# Share-link scheme -> protocol display name
+_PROTO_MAP = {
+    'trojan': 'Trojan',
+    'vless': 'VLESS',
+    'vmess': 'VMess',
+    'ss': 'Shadowsocks'
+}
+
+# Static message texts (looked up once, not per request)
+WELCOME_TEXT = MESSAGES['welcome']
+FREE_KEY_LIMIT_TEXT = MESSAGES['free_key_limit']
+SELECT_SERVER_TEXT = MESSAGES['select_server']
+
+@lru_cache(maxsize=256)
+def payment_info_text(amount):
+    """Payment instructions for an amount - only a handful of distinct prices exist"""
+    return MESSAGES['payment_info'].format(amount=amount)
+
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -78,79 +145,320 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Create bot instance
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='Markdown')
+# threaded=True dispatches each update to a worker pool, so blocking XUI/DB calls
+# in one handler no longer hold up updates from other users.
+# No default parse_mode: messages that use Markdown pass parse_mode='Markdown' explicitly,
+# plain status texts (which may contain user input / error strings) are sent unparsed.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=BOT_WORKER_THREADS)
+
+# Per-user ordering on top of the worker pool: updates from the same user run one at a
+# time (so session steps can't interleave), different users still run concurrently.
+# No worker ever waits for a busy user: if the sender already has a handler running, the
+# update is queued for the worker running it and this worker goes back to the pool.
+USER_QUEUE_MAX = 5  # Updates waiting behind a user's running handler; more are dropped
+_user_queues = {}  # {user_id: deque of (handler, update)} - present while a worker runs that user
+_user_queues_lock = threading.Lock()
+
+def per_user_serial(gate=None):
+    """Decorator: run a message/callback handler serially per sender.
+    gate(update) -> bool runs first, unserialized (ban/rate-limit checks) - rejected updates
+    are never queued, so a flood is turned away instead of piling up behind a slow handler."""
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(update):
+            if gate is not None and not gate(update):
+                return
+            user_id = update.from_user.id
+            with _user_queues_lock:
+                pending = _user_queues.get(user_id)
+                if pending is not None:
+                    if len(pending) < USER_QUEUE_MAX:
+                        pending.append((handler, update))
+                    else:
+                        logger.info("User %s has %s updates queued, dropping %s", user_id, len(pending), handler.__name__)
+                    return
+                _user_queues[user_id] = deque()
+            _run_user_updates(user_id, handler, update)
+        return wrapper
+    return decorator
+
+def _run_user_updates(user_id, handler, update):
+    """Run a user's update and whatever queued up behind it, then release the user"""
+    while True:
+        try:
+            handler(update)
+        except Exception as e:
+            logger.error(f"{handler.__name__} failed for user {user_id}: {e}", exc_info=True)
+        with _user_queues_lock:
+            pending = _user_queues[user_id]
+            if not pending:
+                del _user_queues[user_id]
+                return
+            handler, update = pending.popleft()
+
+# Shared pool for fanning out 3x-ui panel round-trips (e.g. verifying several keys at once)
+panel_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='panel')
+
+# Longer multi-step panel jobs (e.g. protocol swaps) so they never hold an update worker
+provision_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='provision')
+
+# Provisioning jobs in flight, keyed e.g. ('order', order_id): a re-delivered update or a second
+# approve press while the first job is still talking to the panel must not create another key
+_provisioning = set()
+_provisioning_lock = threading.Lock()
+
+def start_provisioning(job_key):
+    """Claim job_key for this caller; False if the same job is already running"""
+    with _provisioning_lock:
+        if job_key in _provisioning:
+            return False
+        _provisioning.add(job_key)
+        return True
+
+def finish_provisioning(job_key):
+    """Release a job_key claimed by start_provisioning"""
+    with _provisioning_lock:
+        _provisioning.discard(job_key)
 
 # User session storage (with thread lock for safety)
 import time as _time
-_session_lock = threading.Lock()
-user_sessions = {}
 SESSION_TTL = 3600  # 1 hour - sessions older than this are cleaned up
+SESSION_MAX_USERS = 50000  # Hard cap - least recently updated sessions are evicted first
+
+class SessionStore:
+    """Per-user conversation state with a sliding TTL (every write refreshes it)
+    and a size bound, so a burst of new users can't grow memory without limit"""
+    
+    def __init__(self, ttl=SESSION_TTL, maxsize=SESSION_MAX_USERS):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # {user_id: {field: value, '_created_at': ts}}, oldest write first
+    
+    def _live(self, user_id, now):
+        """Return the session dict if present and not expired (caller holds _lock)"""
+        sess = self._sessions.get(user_id)
+        if sess is None:
+            return None
+        if now - sess.get('_created_at', 0) > self.ttl:
+            # Expire on read, like a key TTL - don't wait for the cleanup sweep
+            del self._sessions[user_id]
+            return None
+        return sess
+    
+    def get(self, user_id):
+        """Return a COPY of the user's session ({} if none)"""
+        with self._lock:
+            return dict(self._live(user_id, _time.time()) or {})
+    
+    def update(self, user_id, **fields):
+        """Merge fields into the user's session, creating it if needed"""
+        with self._lock:
+            now = _time.time()
+            sess = self._live(user_id, now)
+            if sess is None:
+                sess = self._sessions[user_id] = {}
+            sess.update(fields)
+            sess['_created_at'] = now
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+    
+    def exists(self, user_id):
+        """Check whether the user has a live session"""
+        with self._lock:
+            return self._live(user_id, _time.time()) is not None
+    
+    def clear(self, user_id):
+        """Remove the user's session"""
+        with self._lock:
+            self._sessions.pop(user_id, None)
+    
+    def purge_expired(self):
+        """Drop all expired sessions, returns how many were removed"""
+        now = _time.time()
+        with self._lock:
+            expired = [uid for uid, sess in self._sessions.items()
+                       if now - sess.get('_created_at', 0) > self.ttl]
+            for uid in expired:
+                del self._sessions[uid]
+        return len(expired)
+
+session_store = SessionStore()
 
 def cleanup_expired_sessions():
     """Remove expired user sessions to prevent memory leaks"""
     while True:
         try:
             _time.sleep(300)  # Run every 5 minutes
-            now = _time.time()
-            with _session_lock:
-                expired = [uid for uid, sess in user_sessions.items() 
-                          if now - sess.get('_created_at', 0) > SESSION_TTL]
-                for uid in expired:
-                    del user_sessions[uid]
-                if expired:
-                    logger.info(f"🧹 Cleaned {len(expired)} expired sessions")
+            expired = session_store.purge_expired()
+            if expired:
+                logger.info("🧹 Cleaned %s expired sessions", expired)
+            cleanup_screenshot_waits()
+            cleanup_username_cache()
+            cleanup_recent_callbacks()
+            # Pick up bans written by other processes / expired temporary bans
+            load_banned_users()
         except Exception as e:
             logger.error(f"Session cleanup error: {e}")
 
 def set_session(user_id, data):
     """Thread-safe session setter"""
-    with _session_lock:
-        existing = user_sessions.get(user_id, {})
-        existing.update(data)
-        existing['_created_at'] = _time.time()
-        user_sessions[user_id] = existing
+    session_store.update(user_id, **data)
 
 def get_session(user_id):
     """Thread-safe session getter - returns a COPY"""
-    with _session_lock:
-        return dict(user_sessions.get(user_id, {}))
+    return session_store.get(user_id)
 
 def clear_session(user_id):
     """Thread-safe session removal"""
-    with _session_lock:
-        user_sessions.pop(user_id, None)
+    session_store.clear(user_id)
 
 def has_session(user_id):
     """Thread-safe session existence check"""
-    with _session_lock:
-        return user_id in user_sessions
+    return session_store.exists(user_id)
 
 def update_session_field(user_id, key, value):
     """Thread-safe single field update"""
-    with _session_lock:
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {'_created_at': _time.time()}
-        user_sessions[user_id][key] = value
+    session_store.update(user_id, **{key: value})
+
+# Payment screenshot state: {user_id: (order_id, expires_at)}
+# Kept apart from the session store so later menu navigation can't clobber it. If the
+# bot restarts mid-flow, handle_photo falls back to the user's pending order in the DB.
+_screenshot_lock = threading.Lock()
+_screenshot_waits = {}
+SCREENSHOT_WAIT_TTL = 600  # 10 minutes
+
+def set_awaiting_screenshot(user_id, order_id):
+    """Mark user as about to send the payment screenshot for order_id"""
+    with _screenshot_lock:
+        _screenshot_waits[user_id] = (order_id, _time.time() + SCREENSHOT_WAIT_TTL)
+
+def pop_awaiting_screenshot(user_id):
+    """Take the order id the user is sending a screenshot for (None if not waiting/expired)"""
+    with _screenshot_lock:
+        state = _screenshot_waits.pop(user_id, None)
+    if state and state[1] > _time.time():
+        return state[0]
+    return None
+
+def cleanup_screenshot_waits():
+    """Drop expired screenshot waits (called from the session cleanup sweep)"""
+    now = _time.time()
+    with _screenshot_lock:
+        for uid in [uid for uid, (_, expires_at) in _screenshot_waits.items() if expires_at <= now]:
+            del _screenshot_waits[uid]
+
+# Username cache for display lookups (admin captions, notifications): {user_id: (username, expires_at)}
+# /start refreshes entries, so a username change shows up on the user's next /start
+USERNAME_CACHE_TTL = 300  # 5 minutes
+_username_cache_lock = threading.Lock()
+_username_cache = {}
+
+def remember_username(user_id, username):
+    """Store a freshly seen username"""
+    with _username_cache_lock:
+        _username_cache[user_id] = (username, _time.time() + USERNAME_CACHE_TTL)
+
+def get_username(user_id):
+    """Telegram username of a user (None if unknown or not set)"""
+    with _username_cache_lock:
+        cached = _username_cache.get(user_id)
+    if cached and cached[1] > _time.time():
+        return cached[0]
+    user = get_user(user_id)
+    username = user[2] if user else None
+    remember_username(user_id, username)
+    return username
+
+def cleanup_username_cache():
+    """Drop expired usernames (called from the session cleanup sweep)"""
+    now = _time.time()
+    with _username_cache_lock:
+        for uid in [uid for uid, (_, expires_at) in _username_cache.items() if expires_at <= now]:
+            del _username_cache[uid]
 
 # Server status (runtime - disabled servers)
 disabled_servers = set()
 
-# Banned users set (runtime cache)
-banned_users = set()
+# Banned users cache: {user_id: banned_until datetime, or None if permanent}
+# Mirrors active user_bans rows so ban checks don't query the DB on every update
+_banned_users_lock = threading.Lock()
+banned_users = {}
+
+def _parse_banned_until(banned_until):
+    """DB banned_until value -> datetime (None = permanent)"""
+    if not banned_until:
+        return None
+    if isinstance(banned_until, datetime):
+        return banned_until
+    return datetime.fromisoformat(str(banned_until))
+
+def load_banned_users():
+    """(Re)load active bans from the database into the cache"""
+    try:
+        bans = {ban['telegram_id']: _parse_banned_until(ban['banned_until']) for ban in get_banned_users()}
+    except Exception as e:
+        logger.error(f"Failed to load banned users: {e}")
+        return
+    with _banned_users_lock:
+        banned_users.clear()
+        banned_users.update(bans)
+
+def refresh_banned_user(user_id):
+    """Sync one user's cached ban state from the database"""
+    ban_info = is_user_banned_db(user_id)
+    with _banned_users_lock:
+        if ban_info:
+            banned_users[user_id] = _parse_banned_until(ban_info['banned_until'])
+        else:
+            banned_users.pop(user_id, None)
+
+def is_banned_cached(user_id):
+    """Check the ban cache (expired temporary bans are dropped)"""
+    with _banned_users_lock:
+        if user_id not in banned_users:
+            return False
+        banned_until = banned_users[user_id]
+        if banned_until is None or datetime.now() < banned_until:
+            return True
+        del banned_users[user_id]
+    # Let the DB auto-unban the expired row
+    refresh_banned_user(user_id)
+    return False
+
+def ban_user(telegram_id, reason=None, duration_hours=None, banned_by=None):
+    """Ban user in database and update the ban cache"""
+    success = ban_user_db(telegram_id, reason=reason, duration_hours=duration_hours, banned_by=banned_by)
+    if success:
+        refresh_banned_user(telegram_id)
+    return success
+
+def unban_user(telegram_id, unbanned_by=None):
+    """Unban user in database and update the ban cache"""
+    success = unban_user_db(telegram_id, unbanned_by=unbanned_by)
+    if success:
+        refresh_banned_user(telegram_id)
+    return success
 
 # Dynamic SERVERS dict (merged from config + database)
 SERVERS = {}
+_SERVER_NAMES = {}  # {server_id: display name}, rebuilt by load_servers()
+_SERVER_DISPLAY = {}  # {server_id: (Markdown-escaped name, panel type, db tag)} for admin lists
+_db_server_count = 0
 
 def load_servers():
     """Load servers from config.py and merge with database servers"""
-    global SERVERS, disabled_servers
+    global SERVERS, _SERVER_NAMES, _SERVER_DISPLAY, _db_server_count, disabled_servers
     
     # Start with config servers
     SERVERS = dict(CONFIG_SERVERS)
+    _db_server_count = 0
     
     # Merge database servers (database servers can override config)
     try:
         db_servers = get_all_db_servers(active_only=False)
+        _db_server_count = len(db_servers)
         for server_id, server_data in db_servers.items():
             if server_id not in SERVERS:
                 # New server from database
@@ -162,13 +470,32 @@ def load_servers():
             # Restore disabled state from database
             if server_data.get('is_active') == False:
                 disabled_servers.add(server_id)
+        
+        # Admin toggles (config servers included) survive restarts
+        disabled_servers.update(get_disabled_servers())
                 
-        logger.info(f"📡 Servers loaded: {len(CONFIG_SERVERS)} from config + {len(db_servers)} from database = {len(SERVERS)} total")
+        logger.info("📡 Servers loaded: %s from config + %s from database = %s total", len(CONFIG_SERVERS), len(db_servers), len(SERVERS))
         if disabled_servers:
-            logger.info(f"🔴 Disabled servers: {', '.join(disabled_servers)}")
+            logger.info("🔴 Disabled servers: %s", ', '.join(disabled_servers))
     except Exception as e:
         logger.error(f"Error loading database servers: {e}")
         # Keep using config servers only
+    
+    _SERVER_NAMES = {sid: srv['name'] for sid, srv in SERVERS.items() if 'name' in srv}
+    _SERVER_DISPLAY = {
+        sid: (
+            escape_markdown(srv.get('name', sid)),
+            srv.get('panel_type', 'xui').upper(),
+            " 📦" if srv.get('from_database') else ""
+        )
+        for sid, srv in SERVERS.items()
+    }
+    
+    # Server list may have changed - drop cached panel protocols and keyboards. Done last, once
+    # SERVERS and disabled_servers are rebuilt, so a rebuild racing this can't cache the old list
+    invalidate_protocol_cache()
+    invalidate_server_keyboards()
+    invalidate_server_page()
 
 def get_active_servers():
     """Get all active servers (not disabled)"""
@@ -188,7 +515,7 @@ def load_feature_flags():
         for flag in expected_flags:
             if flag not in feature_flags:
                 feature_flags[flag] = True
-        logger.info(f"📋 Feature flags loaded: {feature_flags}")
+        logger.info("📋 Feature flags loaded: %s", feature_flags)
     except Exception as e:
         logger.error(f"Error loading feature flags: {e}")
         # Use defaults if database fails
@@ -215,14 +542,13 @@ def check_rate_limit(user_id: int, action_type: str = 'message') -> tuple:
 
 def is_user_banned(user_id: int) -> bool:
     """Check if user is banned (runtime, database, rate limiter, or abuse detector)"""
-    return (user_id in banned_users or 
+    return (is_banned_cached(user_id) or 
             rate_limiter.is_banned(user_id) or 
-            is_user_banned_db(user_id) or
             abuse_detector.is_user_blocked(user_id))
 
 def security_check(user_id: int, text: str = None, action_type: str = 'message') -> tuple[bool, str]:
     """
-    Comprehensive security check for all user actions
+    Comprehensive security check for all user actions - the single gate at the top of each handler
     Returns: (is_allowed, error_message)
     """
     # Check if user is banned
@@ -232,6 +558,9 @@ def security_check(user_id: int, text: str = None, action_type: str = 'message')
     # Check rate limit
     is_allowed, error_msg = check_rate_limit(user_id, action_type)
     if not is_allowed:
+        if action_type == 'callback':
+            # Record potential flood attempt (button mashing)
+            abuse_detector.check_message_flood(user_id)
         return False, error_msg
     
     # Check input safety if text provided
@@ -254,23 +583,33 @@ def validate_plan_id(plan_id: str) -> bool:
     """Validate plan ID"""
     return plan_id in PLANS
 
+# Characters stripped from usernames before display
+_USERNAME_DELETE_CHARS = str.maketrans('', '', '<>"\'')
+
 def sanitize_username(username: str) -> str:
     """Sanitize username for display"""
     if not username:
         return "Unknown"
     # Remove potentially dangerous characters
-    safe_username = re.sub(r'[<>"\']', '', username)
+    safe_username = username.translate(_USERNAME_DELETE_CHARS)
     return safe_username[:50]  # Limit length
 
 # Channel that users must join for Free Test Key
 REQUIRED_CHANNEL_ID = "@BurmeseDigitalStore"  # Channel username (with @)
 REQUIRED_CHANNEL_LINK = "https://t.me/BurmeseDigitalStore"
 
+# Legacy Markdown control characters
+_MARKDOWN_ESCAPES = str.maketrans({'_': '\\_', '*': '\\*', '`': '\\`', '[': '\\['})
+
+def escape_markdown(text: str) -> str:
+    """Escape text for parse_mode='Markdown'"""
+    return text.translate(_MARKDOWN_ESCAPES)
+
 def check_channel_membership(user_id):
     """Check if user is a member of the required channel"""
     try:
         member = bot.get_chat_member(REQUIRED_CHANNEL_ID, user_id)
-        logger.info(f"Channel membership check for {user_id}: status={member.status}")
+        logger.info("Channel membership check for %s: status=%s", user_id, member.status)
         # User is a member if status is creator, administrator, member, or restricted
         return member.status in ['creator', 'administrator', 'member', 'restricted']
     except telebot.apihelper.ApiTelegramException as e:
@@ -295,9 +634,80 @@ def check_channel_membership(user_id):
         logger.warning(f"Failed to check channel membership for {user_id}: {e}")
         return False
 
+def parse_expiry_date(value) -> datetime:
+    """Parse a stored expiry date (ISO form, space or 'T' separated, optional fraction)"""
+    if isinstance(value, datetime):
+        return value
+    # Normalise the separator once so both parsers below see the same form
+    expiry_str = str(value).replace(' ', 'T', 1)
+    try:
+        return datetime.fromisoformat(expiry_str)
+    except ValueError:
+        # Pre-3.11 fromisoformat rejects odd fraction lengths - drop the fraction
+        return datetime.strptime(expiry_str[:19], '%Y-%m-%dT%H:%M:%S')
+
+def format_expiry(value, fmt='%Y-%m-%d %H:%M') -> str:
+    """Display form of a stored expiry date (the raw value if it can't be parsed)"""
+    try:
+        return parse_expiry_date(value).strftime(fmt)
+    except (ValueError, TypeError):
+        return str(value)
+
+def to_epoch_ms(dt: datetime) -> int:
+    """Epoch milliseconds (3x-ui expiryTime) for a naive local datetime, in integer math"""
+    # Whole seconds from timestamp() are exact; add ms from the microsecond field
+    # instead of scaling the float (which can round off by a millisecond)
+    return int(dt.timestamp()) * 1000 + dt.microsecond // 1000
+
+# ===================== CONFIG LINKS =====================
+
+def _build_trojan_link(client, inbound, server, port):
+    """trojan:// share link"""
+    # Use custom trojan_port if configured, otherwise use inbound port
+    trojan_port = server.get('trojan_port', port)
+    return f"trojan://{client.get('password')}@{server.get('domain', '')}:{trojan_port}?security=none&type=tcp#{client.get('email')}"
+
+def _build_vless_link(client, inbound, server, port):
+    """vless:// share link"""
+    return f"vless://{client.get('id')}@{server.get('domain', '')}:{port}?type=tcp&security=none#{client.get('email')}"
+
+def _build_vmess_link(client, inbound, server, port):
+    """vmess:// share link (base64 JSON)"""
+    vmess_config = dict(
+        VMESS_CONFIG_TEMPLATE,
+        ps=client.get('email'),
+        add=server.get('domain', ''),
+        port=str(port),
+        id=client.get('id')
+    )
+    return encode_vmess_link(vmess_config)
+
+# Small: the settings string embeds the inbound's whole client list, and each panel refresh
+# produces a new one
+@lru_cache(maxsize=16)
+def parse_inbound_settings(settings_json):
+    """Parsed inbound 'settings' JSON - memoized since every key on an inbound shares it (read-only)"""
+    return json.loads(settings_json or '{}')
+
+def _build_ss_link(client, inbound, server, port):
+    """ss:// share link - cipher comes from the inbound settings"""
+    ss_settings = parse_inbound_settings(inbound.get('settings', '{}'))
+    method = ss_settings.get('method', 'aes-256-gcm')
+    password = client.get('password', client.get('id'))
+    ss_auth = base64.b64encode(f"{method}:{password}".encode()).decode()
+    return f"ss://{ss_auth}@{server.get('domain', '')}:{port}#{client.get('email')}"
+
+# Config link builders by inbound protocol: fn(client, inbound, server, port) -> link
+_LINK_BUILDERS = {
+    'trojan': _build_trojan_link,
+    'vless': _build_vless_link,
+    'vmess': _build_vmess_link,
+    'shadowsocks': _build_ss_link,
+}
+
 # ===================== KEYBOARDS =====================
 
-def main_menu_keyboard():
+def _build_main_menu_keyboard():
     """Main menu keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(
@@ -314,8 +724,22 @@ def main_menu_keyboard():
     markup.add(types.InlineKeyboardButton("📞 Contact Admin", url="https://t.me/BDS_Admin"))
     return markup
 
+# Static menus are built once and shared - never mutate these
+MAIN_MENU_MARKUP = _build_main_menu_keyboard()
+
+# Server selection keyboards by for_free (+ 'admin' management view) - rebuilt after servers change
+_server_keyboard_cache = {}
+
+def invalidate_server_keyboards():
+    """Drop cached server selection keyboards (call after SERVERS/disabled_servers change)"""
+    _server_keyboard_cache.clear()
+
 def server_keyboard(for_free=False):
     """Server selection keyboard"""
+    markup = _server_keyboard_cache.get(for_free)
+    if markup is not None:
+        return markup
+    
     markup = types.InlineKeyboardMarkup(row_width=1)
     for server_id, server in SERVERS.items():
         # Skip disabled servers
@@ -325,8 +749,12 @@ def server_keyboard(for_free=False):
         callback_data = f"free_server_{server_id}" if for_free else f"server_{server_id}"
         markup.add(types.InlineKeyboardButton(server_name, callback_data=callback_data))
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"))
+    _server_keyboard_cache[for_free] = markup
     return markup
 
+# Device/month keyboards only depend on (server_id, device_count) - built once per key
+# and shared, so never mutate the returned markups
+@lru_cache(maxsize=256)
 def plan_keyboard(server_id):
     """Device count selection keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -340,54 +768,61 @@ def plan_keyboard(server_id):
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="buy_key"))
     return markup
 
+# Month button labels/callbacks per device count - PLANS is static, so build once at import
+MONTH_OPTIONS = (1, 3, 5, 7, 9, 12)
+
+def _build_month_buttons(device_count):
+    """(label, callback template) pairs for one device count"""
+    return [
+        (
+            f"{months} {'Month' if months == 1 else 'Months'} - {PLANS.get(f'{device_count}dev_{months}month', {}).get('price', 0):,} Ks",
+            f"plan_{{sid}}_{device_count}dev_{months}month"
+        )
+        for months in MONTH_OPTIONS
+    ]
+
+_MONTH_BUTTONS = {str(dev): _build_month_buttons(dev) for dev in range(1, 6)}
+
+@lru_cache(maxsize=1024)
 def month_keyboard(server_id, device_count):
     """Month duration selection keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=2)
     
-    # Get prices for each duration
-    prices = {
-        1: PLANS.get(f"{device_count}dev_1month", {}).get('price', 0),
-        3: PLANS.get(f"{device_count}dev_3month", {}).get('price', 0),
-        5: PLANS.get(f"{device_count}dev_5month", {}).get('price', 0),
-        7: PLANS.get(f"{device_count}dev_7month", {}).get('price', 0),
-        9: PLANS.get(f"{device_count}dev_9month", {}).get('price', 0),
-        12: PLANS.get(f"{device_count}dev_12month", {}).get('price', 0),
-    }
-    
-    markup.add(
-        types.InlineKeyboardButton(f"1 Month - {prices[1]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_1month"),
-        types.InlineKeyboardButton(f"3 Months - {prices[3]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_3month"),
-        types.InlineKeyboardButton(f"5 Months - {prices[5]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_5month"),
-        types.InlineKeyboardButton(f"7 Months - {prices[7]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_7month"),
-        types.InlineKeyboardButton(f"9 Months - {prices[9]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_9month"),
-        types.InlineKeyboardButton(f"12 Months - {prices[12]:,} Ks", callback_data=f"plan_{server_id}_{device_count}dev_12month"),
-    )
+    buttons = _MONTH_BUTTONS.get(str(device_count)) or _build_month_buttons(device_count)
+    markup.add(*[
+        types.InlineKeyboardButton(label, callback_data=callback.format(sid=server_id))
+        for label, callback in buttons
+    ])
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data=f"proto_{server_id}_trojan"))
     return markup
 
+def server_protocols(server_id):
+    """Protocols offered by a server's panel (TTL-cached in xui_api), Trojan if unknown"""
+    try:
+        available = get_available_protocols(server_id)
+    except Exception as e:
+        logger.error(f"Error getting protocols: {e}")
+        available = None
+    return available or ['trojan']  # Default fallback
+
 def protocol_keyboard(server_id, is_free=False):
     """Protocol selection keyboard - Trojan first as default, only shows enabled protocols"""
     markup = types.InlineKeyboardMarkup(row_width=1)
     
     # Get available protocols from server
-    try:
-        available = get_available_protocols(server_id)
-        if not available:
-            available = ['trojan']  # Default fallback
-    except Exception as e:
-        logger.error(f"Error getting protocols: {e}")
-        available = ['trojan']  # Default fallback
+    available = server_protocols(server_id)
     
     # Get enabled protocols from database (admin settings)
     try:
         enabled_protocols = get_enabled_protocols()
         if not enabled_protocols:
-            enabled_protocols = ['trojan', 'vless', 'vmess', 'shadowsocks', 'wireguard']  # Default all enabled
+            enabled_protocols = PROTOCOL_PRIORITY  # Default all enabled
     except Exception as e:
         logger.error(f"Error getting enabled protocols: {e}")
-        enabled_protocols = ['trojan', 'vless', 'vmess', 'shadowsocks', 'wireguard']
+        enabled_protocols = PROTOCOL_PRIORITY
     
     # Filter available protocols by enabled status
+    enabled_protocols = set(enabled_protocols)
     available = [proto for proto in available if proto in enabled_protocols]
     
     # Ensure at least one protocol is available
@@ -396,24 +831,11 @@ def protocol_keyboard(server_id, is_free=False):
     
     prefix = "free_proto" if is_free else "proto"
     
-    # Priority order - Trojan first
-    priority_order = ['trojan', 'vless', 'vmess', 'shadowsocks', 'wireguard']
-    
-    # Sort available protocols by priority
-    sorted_protocols = []
-    for proto in priority_order:
-        if proto in available:
-            sorted_protocols.append(proto)
-    # Add any remaining protocols not in priority list
-    for proto in available:
-        if proto not in sorted_protocols:
-            sorted_protocols.append(proto)
-    
-    # Show protocols with Trojan as recommended
-    for i, proto in enumerate(sorted_protocols):
-        name = PROTOCOL_NAMES.get(proto, f"🔗 {proto.upper()}")
-        if proto == 'trojan':  # Trojan is always recommended
-            name += " ⭐"
+    # Sort by priority; unknown protocols keep panel order at the end (sort is stable)
+    sorted_protocols = sorted(available, key=lambda proto: _PROTOCOL_RANK.get(proto, len(PROTOCOL_PRIORITY)))
+    
+    for proto in sorted_protocols:
+        name = _PROTOCOL_BUTTON_LABELS.get(proto) or f"🔗 {proto.upper()}"
         markup.add(types.InlineKeyboardButton(
             name,
             callback_data=f"{prefix}_{server_id}_{proto}"
@@ -431,7 +853,7 @@ def admin_order_keyboard(order_id, user_id):
     )
     return markup
 
-def admin_menu_keyboard():
+def _build_admin_menu_keyboard():
     """Admin menu keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(
@@ -448,8 +870,53 @@ def admin_menu_keyboard():
     )
     return markup
 
+ADMIN_MENU_MARKUP = _build_admin_menu_keyboard()
+
+# Server Management page: one cached row per server, patched in place when a server is toggled
+_server_page_rows = {}  # {server_id: row text}
+_server_page_text = None
+
+def _server_page_row(server_id):
+    """One status row of the Server Management page"""
+    name, panel_type, db_tag = _SERVER_DISPLAY[server_id]
+    status = "🔴" if server_id in disabled_servers else "🟢"
+    return f"{status} {name} [{panel_type}]{db_tag}\n"
+
+def invalidate_server_page():
+    """Drop the cached Server Management page (call after SERVERS change)"""
+    global _server_page_text
+    _server_page_rows.clear()
+    _server_page_text = None
+
+def refresh_server_page_row(server_id):
+    """Re-render only the toggled server's row"""
+    global _server_page_text
+    if server_id in _server_page_rows and server_id in _SERVER_DISPLAY:
+        _server_page_rows[server_id] = _server_page_row(server_id)
+        _server_page_text = None
+
+def server_management_text():
+    """Server Management page text (status of every server)"""
+    global _server_page_text
+    if _server_page_text is None:
+        if not _server_page_rows:
+            for server_id in _SERVER_DISPLAY:
+                _server_page_rows[server_id] = _server_page_row(server_id)
+        _server_page_text = (
+            "🖥️ *Server Management*\n\n"
+            "Server ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n"
+            "📦 = Database မှ ထည့်ထားသော Server\n\n"
+            f"📊 Total: {len(SERVERS)} servers ({_db_server_count} custom)\n\n"
+            + "".join(_server_page_rows.values())
+        )
+    return _server_page_text
+
 def server_management_keyboard():
     """Server management keyboard for admin"""
+    markup = _server_keyboard_cache.get('admin')
+    if markup is not None:
+        return markup
+    
     markup = types.InlineKeyboardMarkup(row_width=1)
     for server_id, server in SERVERS.items():
         status = "🔴 Disabled" if server_id in disabled_servers else "🟢 Active"
@@ -463,9 +930,10 @@ def server_management_keyboard():
         types.InlineKeyboardButton("🗑️ Delete Server", callback_data="delete_server_start")
     )
     markup.add(types.InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back"))
+    _server_keyboard_cache['admin'] = markup
     return markup
 
-def add_server_type_keyboard():
+def _build_add_server_type_keyboard():
     """Server type selection keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(
@@ -474,6 +942,8 @@ def add_server_type_keyboard():
     markup.add(types.InlineKeyboardButton("❌ Cancel", callback_data="admin_servers"))
     return markup
 
+ADD_SERVER_TYPE_MARKUP = _build_add_server_type_keyboard()
+
 def delete_server_keyboard():
     """Delete server selection keyboard (only database servers)"""
     markup = types.InlineKeyboardMarkup(row_width=1)
@@ -543,7 +1013,7 @@ def protocol_management_keyboard():
     markup.add(types.InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back"))
     return markup
 
-def stats_period_keyboard():
+def _build_stats_period_keyboard():
     """Statistics period selection keyboard"""
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -559,7 +1029,9 @@ def stats_period_keyboard():
     markup.add(types.InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back"))
     return markup
 
-def ban_management_keyboard():
+STATS_PERIOD_MARKUP = _build_stats_period_keyboard()
+
+def _build_ban_management_keyboard():
     """Ban management keyboard for admin"""
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(
@@ -570,30 +1042,119 @@ def ban_management_keyboard():
     markup.add(types.InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_back"))
     return markup
 
+BAN_MENU_MARKUP = _build_ban_management_keyboard()
+
+# Static navigation keyboards - built once at import, shared by every handler (never mutate)
+_MAIN_MENU_BUTTON = types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
+_CANCEL_PAYMENT_BUTTON = types.InlineKeyboardButton("❌ Cancel", callback_data="main_menu")
+
+def _rows_keyboard(*rows):
+    """Keyboard with one row per argument (each a tuple of buttons)"""
+    markup = types.InlineKeyboardMarkup()
+    for row in rows:
+        markup.row(*row)
+    return markup
+
+MAIN_MENU_ONLY_MARKUP = _rows_keyboard((_MAIN_MENU_BUTTON,))
+FREE_TEST_JOIN_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("📢 Channel Join မည်", url=REQUIRED_CHANNEL_LINK),),
+    (types.InlineKeyboardButton("✅ Join ပြီးပါပြီ", callback_data="free_test_verify"),),
+    (_MAIN_MENU_BUTTON,)
+)
+FREE_KEY_READY_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
+     types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/blackc0der404")),
+    (_MAIN_MENU_BUTTON,)
+)
+ORDER_APPROVED_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
+     types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin")),
+    (_MAIN_MENU_BUTTON,)
+)
+ORDER_REJECTED_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
+     types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin")),
+    (types.InlineKeyboardButton("📖 Help", callback_data="help"), _MAIN_MENU_BUTTON)
+)
+SCREENSHOT_RECEIVED_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("📖 Help", callback_data="help"),
+     types.InlineKeyboardButton("📞 Contact", url="https://t.me/BDS_Admin")),
+    (_MAIN_MENU_BUTTON,)
+)
+NO_KEYS_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("💎 Buy VPN Key", callback_data="buy_key"),),
+    (_MAIN_MENU_BUTTON,)
+)
+REFERRAL_KEY_READY_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("🔑 My Keys", callback_data="my_keys"),),
+    (_MAIN_MENU_BUTTON,)
+)
+REFERRAL_REJECTED_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("👥 Referral Menu", callback_data="referral"),),
+    (types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin"),),
+    (_MAIN_MENU_BUTTON,)
+)
+REFERRAL_LINK_REPLY_MARKUP = _rows_keyboard(
+    (types.InlineKeyboardButton("📊 My Stats", callback_data="referral_stats"),),
+    (types.InlineKeyboardButton("🔙 Back", callback_data="referral"),)
+)
+REFERRAL_BACK_MARKUP = _rows_keyboard((types.InlineKeyboardButton("🔙 Back", callback_data="referral"),))
+_CLAIM_FREE_MONTH_BUTTON = types.InlineKeyboardButton("🎁 1 Month Free Key ရယူမည်", callback_data="claim_free_month")
+_REFERRAL_MENU_ROWS = (
+    (types.InlineKeyboardButton("🔗 ကျွန်ုပ်၏ Referral Link", callback_data="my_referral_link"),),
+    (types.InlineKeyboardButton("📊 Referral Stats", callback_data="referral_stats"),),
+)
+# Referral menu/stats keyboards by can_claim_free_month - the claim button only shows at 3 paid referrals
+REFERRAL_MENU_MARKUPS = {
+    False: _rows_keyboard(*_REFERRAL_MENU_ROWS, (types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"),)),
+    True: _rows_keyboard(*_REFERRAL_MENU_ROWS, (_CLAIM_FREE_MONTH_BUTTON,),
+                         (types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"),)),
+}
+REFERRAL_STATS_MARKUPS = {
+    False: REFERRAL_BACK_MARKUP,
+    True: _rows_keyboard((_CLAIM_FREE_MONTH_BUTTON,), (types.InlineKeyboardButton("🔙 Back", callback_data="referral"),)),
+}
+ADMIN_SERVERS_CANCEL_MARKUP = _rows_keyboard((types.InlineKeyboardButton("❌ Cancel", callback_data="admin_servers"),))
+ADMIN_STATS_BACK_MARKUP = _rows_keyboard((types.InlineKeyboardButton("🔙 Back", callback_data="admin_stats"),))
+ADMIN_BANS_CANCEL_MARKUP = _rows_keyboard((types.InlineKeyboardButton("❌ Cancel", callback_data="admin_bans"),))
+ADMIN_BANS_BACK_MARKUP = _rows_keyboard((types.InlineKeyboardButton("🔙 Back", callback_data="admin_bans"),))
+
+def payment_keyboard(order_id):
+    """Payment screen keyboard - only the screenshot button depends on the order"""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("📸 Screenshot ပို့ရန် နှိပ်ပါ", callback_data=f"send_screenshot_{order_id}"),
+        _CANCEL_PAYMENT_BUTTON
+    )
+    return markup
+
 # ===================== HANDLERS =====================
 
+def _start_gate(message):
+    """Security: Ban + rate limit, checked before /start is queued"""
+    allowed, error_msg = security_check(message.from_user.id)
+    if not allowed:
+        bot.reply_to(message, error_msg, parse_mode='Markdown')
+    return allowed
+
 @bot.message_handler(commands=['start'])
+@per_user_serial(gate=_start_gate)
 def start(message):
     """Start command handler with referral support"""
     user = message.from_user
     user_id = user.id
     
-    # Security: Check if user is banned
-    if is_user_banned(user_id):
-        bot.reply_to(message, "⚠️ You are temporarily blocked. Please try again later.")
-        return
-    
-    # Security: Rate limiting
-    allowed, error_msg = check_rate_limit(user_id, 'message')
-    if not allowed:
-        bot.reply_to(message, error_msg)
-        return
-    
     # Check if user is new
     existing_user = get_user(user_id)
     is_new_user = existing_user is None
     
-    create_user(user.id, user.username, user.first_name, user.last_name)
+    if is_new_user:
+        # Row must exist before referral linking below
+        create_user(user.id, user.username, user.first_name, user.last_name)
+    else:
+        # Returning user - name/username refresh can be written behind the reply
+        queue_user_update(user.id, user.username, user.first_name, user.last_name)
+    remember_username(user.id, user.username)
     
     # Handle referral code from deep link: /start REF_XXXXXXXX
     if is_new_user:
@@ -630,8 +1191,9 @@ def start(message):
     
     bot.send_message(
         message.chat.id,
-        MESSAGES['welcome'],
-        reply_markup=main_menu_keyboard()
+        WELCOME_TEXT,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
     )
 
 @bot.message_handler(commands=['ban'])
@@ -695,7 +1257,7 @@ def admin_command(message):
     if not allowed:
         return
     
-    logger.info(f"Admin command from user_id: {user_id}, ADMIN_CHAT_ID: {ADMIN_CHAT_ID}")
+    logger.info("Admin command from user_id: %s, ADMIN_CHAT_ID: %s", user_id, ADMIN_CHAT_ID)
     
     if user_id != ADMIN_CHAT_ID:
         # Security: Log unauthorized access attempt
@@ -707,8 +1269,190 @@ def admin_command(message):
     bot.send_message(
         message.chat.id,
         "🔐 *Admin Panel*",
-        reply_markup=admin_menu_keyboard()
+        reply_markup=ADMIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+# Broadcast settings
+BROADCAST_RATE = 25  # msgs/sec - stays under Telegram's ~30 msg/sec global limit
+BROADCAST_WORKERS = 8  # Concurrent in-flight sends
+BROADCAST_MAX_RETRIES = 3
+
+# Keep-alive session shared by all broadcast workers, so each send reuses a pooled TLS connection
+_broadcast_session = requests.Session()
+_broadcast_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=BROADCAST_WORKERS))
+_SEND_MESSAGE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+
+def broadcast_send(chat_id, text):
+    """POST sendMessage on the shared broadcast session; raises ApiTelegramException like bot.send_message"""
+    response = _broadcast_session.post(
+        _SEND_MESSAGE_URL,
+        json={'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'},
+        timeout=(5, 15)
     )
+    result_json = response.json()
+    if not result_json.get('ok'):
+        raise ApiTelegramException('sendMessage', response, result_json)
+    return result_json
+
+class TokenBucket:
+    """Thread-safe token bucket - acquire() blocks until a send is allowed"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = _time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = _time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    # Paused by a 429 until self.updated
+                    wait = self.updated - now
+            _time.sleep(wait)
+    
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (Telegram flood wait)"""
+        with self._lock:
+            self.tokens = 0
+            self.updated = max(self.updated, _time.monotonic() + seconds)
+
+def send_with_retry(throttle, chat_id, text):
+    """Send one message through the throttle, honouring 429 retry_after.
+    Returns None on success, otherwise a short failure reason."""
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        throttle.acquire()
+        try:
+            broadcast_send(chat_id, text)
+            return None
+        except ApiTelegramException as e:
+            if e.error_code == 429 and attempt < BROADCAST_MAX_RETRIES - 1:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                logger.warning(f"Broadcast flood wait: {retry_after}s")
+                throttle.pause(retry_after)
+                continue
+            return e.description or f"HTTP {e.error_code}"
+        except Exception as e:
+            return type(e).__name__
+    return "Too Many Requests"
+
+# Customer notifications (key delivered, order rejected, referral reward) are queued so a burst
+# of approvals never blocks the admin's handler or trips Telegram's global send limit
+OUTBOUND_RATE = 25  # msgs/sec shared by all notification workers
+OUTBOUND_WORKERS = 5
+OUTBOUND_CHAT_INTERVAL = 1.0  # Seconds between messages to the same chat (Telegram's per-chat limit)
+_outbound_executor = ThreadPoolExecutor(max_workers=OUTBOUND_WORKERS, thread_name_prefix='outbound')
+_outbound_throttle = TokenBucket(OUTBOUND_RATE)
+_outbound_pending = {}  # {chat_id: deque of (text, kwargs)} - present while a worker owns the chat
+_outbound_lock = threading.Lock()
+
+def queue_message(chat_id, text, **kwargs):
+    """Queue bot.send_message(chat_id, text, **kwargs); messages to one chat are sent in order"""
+    with _outbound_lock:
+        pending = _outbound_pending.get(chat_id)
+        if pending is not None:
+            pending.append((text, kwargs))
+            return
+        _outbound_pending[chat_id] = deque([(text, kwargs)])
+    _outbound_executor.submit(_drain_outbound, chat_id)
+
+def _drain_outbound(chat_id):
+    """Send a chat's queued messages one by one, then release the chat"""
+    last_sent = None
+    while True:
+        with _outbound_lock:
+            pending = _outbound_pending[chat_id]
+            if not pending:
+                del _outbound_pending[chat_id]
+                return
+            text, kwargs = pending.popleft()
+        if last_sent is not None:
+            # This worker owns the chat, so spacing consecutive sends here keeps it under 1 msg/s
+            wait = last_sent + OUTBOUND_CHAT_INTERVAL - _time.monotonic()
+            if wait > 0:
+                _time.sleep(wait)
+        _send_outbound(chat_id, text, kwargs)
+        last_sent = _time.monotonic()
+
+def _send_outbound(chat_id, text, kwargs):
+    """Send one message through the throttle, honouring 429 retry_after; True if it was sent.
+    Provisioning workers call this directly when they need to report whether delivery worked"""
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        _outbound_throttle.acquire()
+        try:
+            bot.send_message(chat_id, text, **kwargs)
+            return True
+        except ApiTelegramException as e:
+            if e.error_code == 429 and attempt < BROADCAST_MAX_RETRIES - 1:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                logger.warning(f"Notification flood wait: {retry_after}s")
+                _outbound_throttle.pause(retry_after)
+                continue
+            logger.warning(f"Could not notify {chat_id}: {e.description or e.error_code}")
+            return False
+        except Exception as e:
+            logger.error(f"Error notifying {chat_id}: {e}")
+            return False
+    return False
+
+def run_broadcast(message, text):
+    """Send text to all users with bounded concurrency, then report to the admin"""
+    throttle = TokenBucket(BROADCAST_RATE)
+    # Bounds queued sends so users are streamed from the DB, not loaded all at once
+    in_flight = threading.BoundedSemaphore(BROADCAST_WORKERS * 4)
+    sent = 0
+    failures = Counter()  # {reason: count} - reported once at the end, not logged per user
+    counts_lock = threading.Lock()
+    
+    def send_one(chat_id):
+        nonlocal sent
+        try:
+            reason = send_with_retry(throttle, chat_id, text)
+            with counts_lock:
+                if reason is None:
+                    sent += 1
+                else:
+                    failures[reason] += 1
+        finally:
+            in_flight.release()
+    
+    # Runs on its own thread - nothing above it would log a failure or tell the admin
+    try:
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix='broadcast') as executor:
+            for batch in iter_all_users():
+                for chat_id in batch:
+                    in_flight.acquire()
+                    executor.submit(send_one, chat_id)
+        
+        failed = sum(failures.values())
+        report = f"✅ Broadcast sent to {sent}/{sent + failed} users ({failed} failed)"
+        if failures:
+            logger.warning(f"Broadcast failures: {dict(failures)}")
+            report += "\n" + "\n".join(f"• {reason}: {count}" for reason, count in failures.most_common(5))
+        bot.reply_to(message, report)
+    except Exception as e:
+        logger.error(f"Broadcast error: {e}", exc_info=True)
+        # The executor has drained by now, so these are the final partial counts
+        with counts_lock:
+            failed = sum(failures.values())
+            report = (f"❌ Broadcast stopped: {e}\n"
+                      f"Sent to {sent} users before it stopped ({failed} failed)")
+            if failures:
+                report += "\n" + "\n".join(f"• {reason}: {count}" for reason, count in failures.most_common(5))
+        try:
+            bot.reply_to(message, report)
+        except Exception as e:
+            logger.error(f"Could not send broadcast report: {e}")
 
 @bot.message_handler(commands=['broadcast'])
 def broadcast_command(message):
@@ -738,26 +1482,14 @@ def broadcast_command(message):
     
     SecurityLogger.log_admin_action(user_id, "broadcast", f"message_length={len(broadcast_message)}")
     
-    users = get_all_users()
-    
-    sent = 0
-    failed = 0
-    for user in users:
-        try:
-            bot.send_message(
-                user[1],  # telegram_id
-                f"📢 *Announcement*\n\n{broadcast_message}"
-            )
-            sent += 1
-            # Telegram rate limit: ~30 msg/sec
-            if sent % 25 == 0:
-                import time as _t
-                _t.sleep(1)
-        except Exception as e:
-            failed += 1
-            logger.error(f"Failed to send to {user[1]}: {e}")
+    bot.reply_to(message, "⏳ Broadcasting...")
     
-    bot.reply_to(message, f"✅ Broadcast sent to {sent}/{len(users)} users ({failed} failed)")
+    # Run in the background so this worker thread isn't tied up for the whole send
+    threading.Thread(
+        target=run_broadcast,
+        args=(message, f"📢 *Announcement*\n\n{broadcast_message}"),
+        daemon=True
+    ).start()
 
 @bot.message_handler(commands=['backup'])
 def backup_command(message):
@@ -800,7 +1532,7 @@ def freekeys_command(message):
             tid, used_at, srv, proto, uname, tg_uname, first_name = row
             display = tg_uname or first_name or f"User\\_{tid}"
             display = str(display).replace('_', '\\_')
-            srv_name = SERVERS.get(srv, {}).get('name', srv or '-') if srv else '-'
+            srv_name = _SERVER_NAMES.get(srv, srv or '-') if srv else '-'
             proto_str = proto or '-'
             text += f"{i}. @{display} (`{tid}`)\n"
             text += f"   📅 {used_at}\n"
@@ -860,7 +1592,7 @@ def freekeys_command(message):
         
         text = "🖥️ *Free Key - Server/Protocol Breakdown*\n\n"
         for srv_id, proto, count in srv_stats:
-            srv_name = SERVERS.get(srv_id, {}).get('name', srv_id or 'Unknown')
+            srv_name = _SERVER_NAMES.get(srv_id, srv_id or 'Unknown')
             text += f"• {srv_name} | {proto}: {count} keys\n"
         
         bot.reply_to(message, text, parse_mode='Markdown')
@@ -885,655 +1617,699 @@ def freekeys_command(message):
         bot.reply_to(message, text, parse_mode='Markdown')
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def button_callback(call):
-    """Handle button callbacks"""
-    user_id = call.from_user.id
-    data = call.data
+# ===================== MESSAGE HELPERS =====================
+
+# Fingerprint of the last text/keyboard sent to each edited message: {(chat_id, message_id): hash}
+# Re-tapping a button that redraws the same screen would otherwise cost an API call that
+# Telegram rejects with "message is not modified"
+LAST_RENDER_MAX = 20000
+_last_render = OrderedDict()
+_last_render_lock = threading.Lock()
+
+def safe_edit_message_text(text, chat_id, message_id, **kwargs):
+    """bot.edit_message_text, skipped when the message already shows this exact content"""
+    reply_markup = kwargs.get('reply_markup')
+    render = hash((
+        text,
+        reply_markup.to_json() if reply_markup is not None else None,
+        kwargs.get('parse_mode'),
+        kwargs.get('disable_web_page_preview'),
+    ))
+    key = (chat_id, message_id)
+    with _last_render_lock:
+        if _last_render.get(key) == render:
+            _last_render.move_to_end(key)
+            return None
     
-    # Security: Check if user is banned or blocked by abuse detector
-    if is_user_banned(user_id):
-        bot.answer_callback_query(call.id, "⚠️ You are temporarily blocked.", show_alert=True)
+    try:
+        result = bot.edit_message_text(text, chat_id, message_id, **kwargs)
+    except ApiTelegramException as e:
+        # Edited outside this process (or before a restart) - it already shows this content
+        if 'message is not modified' not in (e.description or ''):
+            raise
+        result = None
+    
+    with _last_render_lock:
+        _last_render[key] = render
+        _last_render.move_to_end(key)
+        while len(_last_render) > LAST_RENDER_MAX:
+            _last_render.popitem(last=False)
+    return result
+
+def answer_callback(call, text=None, show_alert=False):
+    """Answer a callback query at most once - Telegram rejects a second answer for the same query.
+    button_callback acks before most handlers run, so their later alerts are dropped here."""
+    if getattr(call, '_answered', False):
+        if text:
+            logger.debug("Callback %s already answered, dropping: %s", call.id, text)
         return
-    
-    # Security: Rate limiting for callbacks
-    allowed, error_msg = check_rate_limit(user_id, 'callback')
-    if not allowed:
-        bot.answer_callback_query(call.id, "⚠️ Too many requests. Please slow down.", show_alert=True)
-        # Record potential flood attempt
-        abuse_detector.check_message_flood(user_id)
+    call._answered = True
+    try:
+        bot.answer_callback_query(call.id, text, show_alert=show_alert)
+    except ApiTelegramException as e:
+        logger.debug("answer_callback_query failed for %s: %s", call.id, e)
+
+# ===================== CALLBACK HANDLERS =====================
+
+def _cb_main_menu(call, user_id, data):
+    """Main menu"""
+    safe_edit_message_text(
+        WELCOME_TEXT,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_free_test(call, user_id, data):
+    """Free test key"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Check if feature is enabled
+    if not feature_flags.get('free_test_key', True):
+        safe_edit_message_text(
+            "🚫 *Free Test Key ယာယီ ပိတ်ထားပါသည်။*\n\nကျေးဇူးပြု၍ VPN Key ဝယ်ယူပါ။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
         return
     
-    # Security: Validate callback data format and check for injection
-    is_safe, threat_type = InputValidator.is_safe_text(data)
-    if not is_safe:
-        should_block, _ = abuse_detector.check_injection_attempt(user_id, threat_type)
-        bot.answer_callback_query(call.id, "❌ Invalid action.", show_alert=True)
+    # Check if user has joined the required channel
+    if not check_channel_membership(user_id):
+        safe_edit_message_text(
+            "📢 *Free Test Key ရယူရန်*\n\n"
+            "Free Test Key ရရှိရန် အောက်ပါ Channel ကို အရင်ဦးဆုံး Join ပါ:\n\n"
+            f"👉 {REQUIRED_CHANNEL_LINK}\n\n"
+            "Join ပြီးပါက *'✅ Join ပြီးပါပြီ'* ကို နှိပ်ပါ။",
+            chat_id,
+            message_id,
+            parse_mode='Markdown',
+            reply_markup=FREE_TEST_JOIN_MARKUP
+        )
         return
     
-    if not is_valid_callback(data):
-        SecurityLogger.log_suspicious_activity(user_id, "INVALID_CALLBACK", data[:100])
-        abuse_detector.record_suspicious_activity(user_id, "INVALID_CALLBACK_DATA", 2)
-        bot.answer_callback_query(call.id, "❌ Invalid action.", show_alert=True)
+    if has_used_free_test(user_id):
+        safe_edit_message_text(
+            FREE_KEY_LIMIT_TEXT,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+    else:
+        safe_edit_message_text(
+            "🖥️ *Free Test Key အတွက် Server ရွေးပါ:*",
+            chat_id,
+            message_id,
+            reply_markup=server_keyboard(for_free=True),
+            parse_mode='Markdown'
+        )
+
+def _cb_free_test_verify(call, user_id, data):
+    """Free test key verification after channel join"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Re-check channel membership
+    if not check_channel_membership(user_id):
+        safe_edit_message_text(
+            "❌ *Channel Join မလုပ်ရသေးပါ!*\n\n"
+            "Free Test Key ရရှိရန် အောက်ပါ Channel ကို Join ပါ:\n\n"
+            f"👉 {REQUIRED_CHANNEL_LINK}\n\n"
+            "Join ပြီးပါက *'✅ Join ပြီးပါပြီ'* ကို ပြန်နှိပ်ပါ။",
+            chat_id,
+            message_id,
+            parse_mode='Markdown',
+            reply_markup=FREE_TEST_JOIN_MARKUP
+        )
         return
     
-    bot.answer_callback_query(call.id)
+    # Check if feature is enabled
+    if not feature_flags.get('free_test_key', True):
+        safe_edit_message_text(
+            "🚫 *Free Test Key ယာယီ ပိတ်ထားပါသည်။*\n\nကျေးဇူးပြု၍ VPN Key ဝယ်ယူပါ။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+        return
     
-    # Main menu
-    if data == "main_menu":
-        bot.edit_message_text(
-            MESSAGES['welcome'],
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=main_menu_keyboard()
+    # User has joined - proceed to server selection
+    if has_used_free_test(user_id):
+        safe_edit_message_text(
+            FREE_KEY_LIMIT_TEXT,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+    else:
+        safe_edit_message_text(
+            "✅ *Channel Join အတည်ပြုပြီးပါပြီ!*\n\n🖥️ *Free Test Key အတွက် Server ရွေးပါ:*",
+            chat_id,
+            message_id,
+            parse_mode='Markdown',
+            reply_markup=server_keyboard(for_free=True)
         )
+
+def _cb_free_server(call, user_id, data):
+    """Free server selection - goes to protocol selection"""
+    server_id = data.replace("free_server_", "")
     
-    # Free test key
-    elif data == "free_test":
-        # Check if feature is enabled
-        if not feature_flags.get('free_test_key', True):
-            bot.edit_message_text(
-                "🚫 *Free Test Key ယာယီ ပိတ်ထားပါသည်။*\n\nကျေးဇူးပြု၍ VPN Key ဝယ်ယူပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-            return
-        
-        # Check if user has joined the required channel
-        if not check_channel_membership(user_id):
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                types.InlineKeyboardButton("📢 Channel Join မည်", url=REQUIRED_CHANNEL_LINK),
-                types.InlineKeyboardButton("✅ Join ပြီးပါပြီ", callback_data="free_test_verify")
-            )
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            bot.edit_message_text(
-                "📢 *Free Test Key ရယူရန်*\n\n"
-                "Free Test Key ရရှိရန် အောက်ပါ Channel ကို အရင်ဦးဆုံး Join ပါ:\n\n"
-                f"👉 {REQUIRED_CHANNEL_LINK}\n\n"
-                "Join ပြီးပါက *'✅ Join ပြီးပါပြီ'* ကို နှိပ်ပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='Markdown',
-                reply_markup=markup
-            )
-            return
-        
-        if has_used_free_test(user_id):
-            bot.edit_message_text(
-                MESSAGES['free_key_limit'],
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            bot.edit_message_text(
-                "🖥️ *Free Test Key အတွက် Server ရွေးပါ:*",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=server_keyboard(for_free=True)
-            )
+    # Security: Validate server_id
+    if not validate_server_id(server_id):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
+        answer_callback(call, "❌ Invalid server.", show_alert=True)
+        return
     
-    # Free test key verification after channel join
-    elif data == "free_test_verify":
-        # Re-check channel membership
-        if not check_channel_membership(user_id):
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            markup.add(
-                types.InlineKeyboardButton("📢 Channel Join မည်", url=REQUIRED_CHANNEL_LINK),
-                types.InlineKeyboardButton("✅ Join ပြီးပါပြီ", callback_data="free_test_verify")
-            )
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            bot.edit_message_text(
-                "❌ *Channel Join မလုပ်ရသေးပါ!*\n\n"
-                "Free Test Key ရရှိရန် အောက်ပါ Channel ကို Join ပါ:\n\n"
-                f"👉 {REQUIRED_CHANNEL_LINK}\n\n"
-                "Join ပြီးပါက *'✅ Join ပြီးပါပြီ'* ကို ပြန်နှိပ်ပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='Markdown',
-                reply_markup=markup
-            )
-            return
-        
-        # Check if feature is enabled
-        if not feature_flags.get('free_test_key', True):
-            bot.edit_message_text(
-                "🚫 *Free Test Key ယာယီ ပိတ်ထားပါသည်။*\n\nကျေးဇူးပြု၍ VPN Key ဝယ်ယူပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-            return
-        
-        # User has joined - proceed to server selection
-        if has_used_free_test(user_id):
-            bot.edit_message_text(
-                MESSAGES['free_key_limit'],
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            bot.edit_message_text(
-                "✅ *Channel Join အတည်ပြုပြီးပါပြီ!*\n\n🖥️ *Free Test Key အတွက် Server ရွေးပါ:*",
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='Markdown',
-                reply_markup=server_keyboard(for_free=True)
-            )
+    set_session(user_id, {'server_id': server_id, 'is_free': True})
     
-    # Free server selection - goes to protocol selection
-    elif data.startswith("free_server_"):
-        server_id = data.replace("free_server_", "")
-        
-        # Security: Validate server_id
-        if not validate_server_id(server_id):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
-            bot.answer_callback_query(call.id, "❌ Invalid server.", show_alert=True)
-            return
-        
-        set_session(user_id, {'server_id': server_id, 'is_free': True})
+    # Show protocol selection
+    safe_edit_message_text(
+        "🔐 *Protocol ရွေးချယ်ပါ:*\n\n_⭐ ပြထားသော Protocol သည် အကောင်းဆုံး ဖြစ်ပါသည်_",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=protocol_keyboard(server_id, is_free=True),
+        parse_mode='Markdown'
+    )
+
+def _cb_free_proto(call, user_id, data):
+    """Free protocol selection - create key"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    parts = data.replace("free_proto_", "").split("_")
+    server_id = parts[0]
+    protocol = parts[1] if len(parts) > 1 else 'trojan'
+    
+    # Get username
+    username = call.from_user.username if call.from_user.username else call.from_user.first_name
+    
+    # The used-free-test flag is only set once the key is saved, so a second press (or an
+    # old message replayed) while the first key is still being created must not start another
+    job_key = ('free_test', user_id)
+    if not start_provisioning(job_key):
+        logger.info("Free test key for %s is already being created, ignoring press", user_id)
+        return
+    
+    submitted = False
+    try:
+        safe_edit_message_text(
+            "⏳ Key ဖန်တီးနေပါသည်...",
+            chat_id,
+            message_id
+        )
         
-        # Show protocol selection
-        bot.edit_message_text(
-            "🔐 *Protocol ရွေးချယ်ပါ:*\n\n_⭐ ပြထားသော Protocol သည် အကောင်းဆုံး ဖြစ်ပါသည်_",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=protocol_keyboard(server_id, is_free=True)
+        # Panel round-trip runs off the update thread
+        provision_executor.submit(perform_free_test_key, chat_id, message_id, user_id, server_id, protocol, username)
+        submitted = True
+    finally:
+        if not submitted:
+            finish_provisioning(job_key)
+
+def perform_free_test_key(chat_id, message_id, user_id, server_id, protocol, username):
+    """Create a free test key and report the result in the status message"""
+    try:
+        _create_free_test_key(chat_id, message_id, user_id, server_id, protocol, username)
+    except Exception as e:
+        logger.error(f"Free test key error for user {user_id}: {e}")
+        try:
+            safe_edit_message_text(
+                "❌ Key ဖန်တီးရာတွင် အမှားရှိပါသည်။ ကျေးဇူးပြု၍ နောက်မှ ထပ်ကြိုးစားပါ။",
+                chat_id,
+                message_id,
+                reply_markup=MAIN_MENU_MARKUP
+            )
+        except Exception:
+            pass
+    finally:
+        finish_provisioning(('free_test', user_id))
+
+def _create_free_test_key(chat_id, message_id, user_id, server_id, protocol, username):
+    """Create the 3 GB / 72 hour test client, save it and show it to the user"""
+    # Re-check the free test (the callback can be replayed from an old message)
+    # and get the key count for the key number in the same query
+    used_free_test, key_count = get_free_test_status(user_id)
+    if used_free_test:
+        safe_edit_message_text(
+            FREE_KEY_LIMIT_TEXT,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
         )
+        return
+    key_number = key_count + 1
+    
+    # Create free test key
+    result = create_vpn_key(
+        server_id=server_id,
+        telegram_id=user_id,
+        username=username,
+        data_limit_gb=3,  # 3GB limit
+        expiry_days=3,    # 72 hours
+        devices=1,
+        protocol=protocol,
+        key_number=key_number
+    )
     
-    # Free protocol selection - create key
-    elif data.startswith("free_proto_"):
-        parts = data.replace("free_proto_", "").split("_")
-        server_id = parts[0]
-        protocol = parts[1] if len(parts) > 1 else 'trojan'
-        
-        # Get username
-        username = call.from_user.username if call.from_user.username else call.from_user.first_name
-        
-        # Get current key count for this user to determine key number
-        existing_keys = get_user_keys(user_id)
-        key_number = len(existing_keys) + 1
+    if result and result.get('success'):
+        mark_free_test_used(user_id, server_id=server_id, protocol=protocol, username=username)
+        config_link = result.get('config_link', result['sub_link'])
+        save_vpn_key(
+            telegram_id=user_id,
+            order_id=None,
+            server_id=server_id,
+            client_email=result['client_email'],
+            client_id=result['client_id'],
+            sub_link=result['sub_link'],
+            config_link=config_link,
+            data_limit=3,
+            expiry_date=result['expiry_date']
+        )
         
-        bot.edit_message_text(
-            "⏳ Key ဖန်တီးနေပါသည်...",
-            call.message.chat.id,
-            call.message.message_id
+        expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
+        message_text = MESSAGES['key_generated'].format(
+            server=_SERVER_NAMES[server_id],
+            plan="🎁 Free Test",
+            expiry=expiry_str,
+            data_limit="3 GB",
+            config_link=config_link,
+            sub_link=result['sub_link']
         )
         
-        # Create free test key
-        result = create_vpn_key(
-            server_id=server_id,
-            telegram_id=user_id,
-            username=username,
-            data_limit_gb=3,  # 3GB limit
-            expiry_days=3,    # 72 hours
-            devices=1,
-            protocol=protocol,
-            key_number=key_number
+        safe_edit_message_text(
+            message_text,
+            chat_id,
+            message_id,
+            reply_markup=FREE_KEY_READY_MARKUP,
+            disable_web_page_preview=True,
+            parse_mode='Markdown'
         )
-        
-        if result and result.get('success'):
-            mark_free_test_used(user_id, server_id=server_id, protocol=protocol, username=username)
-            config_link = result.get('config_link', result['sub_link'])
-            save_vpn_key(
-                telegram_id=user_id,
-                order_id=None,
-                server_id=server_id,
-                client_email=result['client_email'],
-                client_id=result['client_id'],
-                sub_link=result['sub_link'],
-                config_link=config_link,
-                data_limit=3,
-                expiry_date=result['expiry_date']
-            )
-            
-            expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
-            message_text = MESSAGES['key_generated'].format(
-                server=SERVERS[server_id]['name'],
-                plan="🎁 Free Test",
-                expiry=expiry_str,
-                data_limit="3 GB",
-                config_link=config_link,
-                sub_link=result['sub_link']
-            )
-            
-            # Create keyboard with buttons
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            markup.add(
-                types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
-                types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/blackc0der404")
-            )
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            
-            bot.edit_message_text(
-                message_text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                disable_web_page_preview=True
-            )
-        else:
-            bot.edit_message_text(
-                "❌ Key ဖန်တီးရာတွင် အမှားရှိပါသည်။ ကျေးဇူးပြု၍ နောက်မှ ထပ်ကြိုးစားပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-    
-    # Buy key - server selection
-    elif data == "buy_key":
-        bot.edit_message_text(
-            MESSAGES['select_server'],
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=server_keyboard(for_free=False)
+    else:
+        safe_edit_message_text(
+            "❌ Key ဖန်တီးရာတွင် အမှားရှိပါသည်။ ကျေးဇူးပြု၍ နောက်မှ ထပ်ကြိုးစားပါ။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP
         )
+
+def _cb_buy_key(call, user_id, data):
+    """Buy key - server selection"""
+    safe_edit_message_text(
+        SELECT_SERVER_TEXT,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=server_keyboard(for_free=False),
+        parse_mode='Markdown'
+    )
+
+def _cb_server(call, user_id, data):
+    """Server selected for purchase - go to protocol selection"""
+    if data.startswith("server_selection"):
+        return
     
-    # Server selected for purchase - go to protocol selection
-    elif data.startswith("server_") and not data.startswith("server_selection"):
-        server_id = data.replace("server_", "")
-        
-        # Security: Validate server_id
-        if not validate_server_id(server_id):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
-            bot.answer_callback_query(call.id, "❌ Invalid server.", show_alert=True)
-            return
-        
-        set_session(user_id, {'server_id': server_id})
-        
-        # Show protocol selection
-        bot.edit_message_text(
-            "🔐 *Protocol ရွေးချယ်ပါ:*\n\n_⭐ ပြထားသော Protocol သည် အကောင်းဆုံး ဖြစ်ပါသည်_",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=protocol_keyboard(server_id, is_free=False)
-        )
+    server_id = data.replace("server_", "")
     
-    # Protocol selected for purchase - go to device selection
-    elif data.startswith("proto_"):
-        parts = data.replace("proto_", "").split("_")
-        server_id = parts[0]
-        protocol = parts[1] if len(parts) > 1 else 'trojan'
-        
-        set_session(user_id, {'server_id': server_id, 'protocol': protocol})
-        
-        bot.edit_message_text(
-            "📱 *Device အရေအတွက် ရွေးချယ်ပါ:*\n\n_Device များများ သုံးလိုပါက များများ ရွေးပါ_",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=plan_keyboard(server_id)
-        )
+    # Security: Validate server_id
+    if not validate_server_id(server_id):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
+        answer_callback(call, "❌ Invalid server.", show_alert=True)
+        return
     
-    # Device count selected - go to month selection
-    elif data.startswith("device_"):
-        parts = data.replace("device_", "").split("_")
-        server_id = parts[0]
-        device_count = parts[1] if len(parts) > 1 else '1'
-        
-        set_session(user_id, {'device_count': device_count})
-        
-        bot.edit_message_text(
-            f"📅 *{device_count} Device အတွက် ကာလ ရွေးချယ်ပါ:*\n\n_ကာလ ကြာကြာ ဝယ်လေ စျေးသက်သာလေ_",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=month_keyboard(server_id, device_count)
-        )
+    set_session(user_id, {'server_id': server_id})
     
-    # Plan selected
-    elif data.startswith("plan_"):
-        parts = data.split("_")
-        server_id = parts[1]
-        plan_id = "_".join(parts[2:])
-        
-        # Security: Validate server and plan
-        if not validate_server_id(server_id):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
-            bot.answer_callback_query(call.id, "❌ Invalid server.", show_alert=True)
-            return
-        
-        if not validate_plan_id(plan_id):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_PLAN_ID", plan_id)
-            bot.answer_callback_query(call.id, "❌ Invalid plan.", show_alert=True)
-            return
-        
-        plan = PLANS.get(plan_id)
-        if not plan:
-            bot.answer_callback_query(call.id, "❌ Invalid plan selected.", show_alert=True)
-            return
-        
-        # Keep existing session data and add new data
-        existing_session = get_session(user_id)
-        protocol = existing_session.get('protocol', 'trojan')
-        
-        set_session(user_id, {
-            'server_id': server_id,
-            'plan_id': plan_id,
-            'amount': plan['price'],
-            'protocol': protocol
-        })
-        
-        # Create order with protocol
-        order_id = create_order(user_id, server_id, plan_id, plan['price'], protocol)
-        update_session_field(user_id, 'order_id', order_id)
-        
-        # Show payment info
-        payment_text = MESSAGES['payment_info'].format(amount=plan['price'])
-        
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            types.InlineKeyboardButton("📸 Screenshot ပို့ရန် နှိပ်ပါ", callback_data=f"send_screenshot_{order_id}"),
-            types.InlineKeyboardButton("❌ Cancel", callback_data="main_menu")
+    # Show protocol selection
+    safe_edit_message_text(
+        "🔐 *Protocol ရွေးချယ်ပါ:*\n\n_⭐ ပြထားသော Protocol သည် အကောင်းဆုံး ဖြစ်ပါသည်_",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=protocol_keyboard(server_id, is_free=False),
+        parse_mode='Markdown'
+    )
+
+def _cb_proto(call, user_id, data):
+    """Protocol selected for purchase - go to device selection"""
+    parts = data.replace("proto_", "").split("_")
+    server_id = parts[0]
+    protocol = parts[1] if len(parts) > 1 else 'trojan'
+    
+    set_session(user_id, {'server_id': server_id, 'protocol': protocol})
+    
+    safe_edit_message_text(
+        "📱 *Device အရေအတွက် ရွေးချယ်ပါ:*\n\n_Device များများ သုံးလိုပါက များများ ရွေးပါ_",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=plan_keyboard(server_id),
+        parse_mode='Markdown'
+    )
+
+def _cb_device(call, user_id, data):
+    """Device count selected - go to month selection"""
+    parts = data.replace("device_", "").split("_")
+    server_id = parts[0]
+    device_count = parts[1] if len(parts) > 1 else '1'
+    
+    set_session(user_id, {'device_count': device_count})
+    
+    safe_edit_message_text(
+        f"📅 *{device_count} Device အတွက် ကာလ ရွေးချယ်ပါ:*\n\n_ကာလ ကြာကြာ ဝယ်လေ စျေးသက်သာလေ_",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=month_keyboard(server_id, device_count),
+        parse_mode='Markdown'
+    )
+
+def _cb_plan(call, user_id, data):
+    """Plan selected"""
+    parts = data.split("_")
+    server_id = parts[1]
+    plan_id = "_".join(parts[2:])
+    
+    # Security: Validate server and plan
+    if not validate_server_id(server_id):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_SERVER_ID", server_id)
+        answer_callback(call, "❌ Invalid server.", show_alert=True)
+        return
+    
+    if not validate_plan_id(plan_id):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_PLAN_ID", plan_id)
+        answer_callback(call, "❌ Invalid plan.", show_alert=True)
+        return
+    
+    plan = PLANS.get(plan_id)
+    if not plan:
+        answer_callback(call, "❌ Invalid plan selected.", show_alert=True)
+        return
+    
+    # Keep existing session data and add new data
+    existing_session = get_session(user_id)
+    protocol = existing_session.get('protocol', 'trojan')
+    
+    set_session(user_id, {
+        'server_id': server_id,
+        'plan_id': plan_id,
+        'amount': plan['price'],
+        'protocol': protocol
+    })
+    
+    # Create order with protocol
+    order_id = create_order(user_id, server_id, plan_id, plan['price'], protocol)
+    update_session_field(user_id, 'order_id', order_id)
+    
+    # Show payment info
+    payment_text = payment_info_text(plan['price'])
+    
+    safe_edit_message_text(
+        payment_text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=payment_keyboard(order_id),
+        parse_mode='Markdown'
+    )
+
+def _cb_send_screenshot(call, user_id, data):
+    """Send screenshot prompt"""
+    order_id = data.replace("send_screenshot_", "")
+    set_awaiting_screenshot(user_id, int(order_id))
+    
+    safe_edit_message_text(
+        "📸 *Payment Screenshot ပို့ပေးပါ*\n\nScreenshot ကို ဤနေရာတွင် ယခု ပို့ပေးပါ။",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode='Markdown'
+    )
+
+def _cb_my_keys(call, user_id, data):
+    """My keys"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    keys = get_user_keys(user_id)
+    if not keys:
+        safe_edit_message_text(
+            "🔑 သင့်တွင် Active VPN Key မရှိပါ။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP
         )
-        
-        bot.edit_message_text(
-            payment_text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
+    else:
+        safe_edit_message_text(
+            "⏳ *Verifying keys with panel...*",
+            chat_id,
+            message_id,
+            parse_mode='Markdown'
         )
-    
-    # Send screenshot prompt
-    elif data.startswith("send_screenshot_"):
-        order_id = data.replace("send_screenshot_", "")
-        set_session(user_id, {'waiting_screenshot': True, 'order_id': int(order_id)})
         
-        bot.edit_message_text(
-            "📸 *Payment Screenshot ပို့ပေးပါ*\n\nScreenshot ကို ဤနေရာတွင် ယခု ပို့ပေးပါ။",
-            call.message.chat.id,
-            call.message.message_id
-        )
-    
-    # My keys
-    elif data == "my_keys":
-        keys = get_user_keys(user_id)
-        if not keys:
-            bot.edit_message_text(
-                "🔑 သင့်တွင် Active VPN Key မရှိပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            bot.edit_message_text(
-                "⏳ *Verifying keys with panel...*",
-                call.message.chat.id,
-                call.message.message_id
-            )
+        valid_keys = []  # (key, client_info) - client_info is None when the panel couldn't be read
+        missing_key_ids = []
+        
+        # One inbounds request per distinct server (not per key), servers fetched concurrently
+        server_ids = list(dict.fromkeys(key.server_id for key in keys))
+        clients_by_server = dict(zip(server_ids, panel_executor.map(list_all_clients, server_ids)))
+        
+        for key in keys:
+            key_id = key.id
+            client_email = key.client_email
+            server_clients = clients_by_server[key.server_id]
+            if server_clients is None:
+                # Panel down - can't tell whether the key exists, so keep it active
+                valid_keys.append((key, None))
+                continue
+            client_info = server_clients.get(client_email)
             
-            text = "🔑 *သင့် VPN Keys*\n\n"
-            valid_keys = []
-            
-            for key in keys:
-                key_id = key[0]
-                server_id = key[3]
-                client_email = key[4]
-                
-                # Verify key exists in 3x-ui panel
-                client_info = verify_client_exists(server_id, client_email)
-                if client_info:
-                    valid_keys.append((key, client_info))
-                else:
-                    # Key doesn't exist in panel - deactivate it
-                    logger.info(f"Key {key_id} ({client_email}) not found in panel, deactivating...")
-                    deactivate_vpn_key(key_id)
+            if client_info:
+                valid_keys.append((key, client_info))
+            else:
+                # Key doesn't exist in panel - deactivate it
+                logger.info("Key %s (%s) not found in panel, deactivating...", key_id, client_email)
+                missing_key_ids.append(key_id)
+        
+        # All missing keys in one UPDATE
+        deactivate_vpn_keys(missing_key_ids)
+        
+        if not valid_keys:
+            safe_edit_message_text(
+                "🔑 သင့်တွင် Active VPN Key မရှိပါ။\n\n_(Panel တွင် Key များ မတွေ့ပါ။)_",
+                chat_id,
+                message_id,
+                reply_markup=MAIN_MENU_MARKUP,
+                parse_mode='Markdown'
+            )
+            return
+        
+        parts = ["🔑 *သင့် VPN Keys*\n\n"]
+        for i, (key, client_info) in enumerate(valid_keys, 1):
+            server_id = key.server_id
+            server_name = key.server_name or _SERVER_NAMES.get(server_id, 'Unknown')
             
-            if not valid_keys:
-                bot.edit_message_text(
-                    "🔑 သင့်တွင် Active VPN Key မရှိပါ။\n\n_(Panel တွင် Key များ မတွေ့ပါ။)_",
-                    call.message.chat.id,
-                    call.message.message_id,
-                    reply_markup=main_menu_keyboard()
+            if client_info is None:
+                # Show the saved key rather than dropping it while the panel is unreachable
+                parts.append(
+                    f"*Key {i}:*\n"
+                    f"├ Server: {server_name}\n"
+                    f"├ Status: ⚠️ Panel unavailable\n"
+                    f"└ Key:\n`{key.config_link or key.sub_link}`\n\n"
                 )
-                return
-            
-            for i, (key, client_info) in enumerate(valid_keys, 1):
-                server_id = key[3]
-                server_name = SERVERS.get(server_id, {}).get('name', 'Unknown')
-                
-                # Get expiry from panel (in milliseconds)
-                client = client_info['client']
-                inbound = client_info['inbound']
-                protocol = inbound.get('protocol', 'trojan')
-                
-                # XUI Panel handling
-                panel_expiry_ms = client.get('expiryTime', 0)
-                
-                if panel_expiry_ms > 0:
-                    panel_expiry = datetime.fromtimestamp(panel_expiry_ms / 1000)
-                    expiry_str = panel_expiry.strftime('%Y-%m-%d %H:%M')
-                    days_left = (panel_expiry - datetime.now()).days
-                    expiry_display = f"{expiry_str} ({days_left} days left)"
-                else:
-                    expiry_display = "Unlimited"
-                
-                # Get protocol and generate config link
-                port = inbound.get('port', 443)
-                server_domain = SERVERS.get(server_id, {}).get('domain', '')
-                
-                # Generate config link based on protocol
-                if protocol == 'trojan':
-                    client_uuid = client.get('password')
-                    # Use custom trojan_port if configured, otherwise use inbound port
-                    trojan_port = SERVERS.get(server_id, {}).get('trojan_port', port)
-                    config_link = f"trojan://{client_uuid}@{server_domain}:{trojan_port}?security=none&type=tcp#{client.get('email')}"
-                elif protocol == 'vless':
-                    client_uuid = client.get('id')
-                    config_link = f"vless://{client_uuid}@{server_domain}:{port}?type=tcp&security=none#{client.get('email')}"
-                elif protocol == 'vmess':
-                    import base64
-                    import json as json_lib
-                    client_uuid = client.get('id')
-                    vmess_config = {
-                        "v": "2",
-                        "ps": client.get('email'),
-                        "add": server_domain,
-                        "port": str(port),
-                        "id": client_uuid,
-                        "aid": "0",
-                        "net": "tcp",
-                        "type": "none",
-                        "tls": ""
-                    }
-                    config_link = "vmess://" + base64.b64encode(json_lib.dumps(vmess_config).encode()).decode()
-                elif protocol == 'shadowsocks':
-                    import base64
-                    ss_settings = json.loads(inbound.get('settings', '{}'))
-                    method = ss_settings.get('method', 'aes-256-gcm')
-                    password = client.get('password', client.get('id'))
-                    ss_auth = base64.b64encode(f"{method}:{password}".encode()).decode()
-                    config_link = f"ss://{ss_auth}@{server_domain}:{port}#{client.get('email')}"
-                else:
-                    config_link = key[7] if key[7] else key[6]  # Fallback to database
-                
-                text += f"*Key {i}:*\n"
-                text += f"├ Server: {server_name}\n"
-                text += f"├ Protocol: {protocol.upper()}\n"
-                text += f"├ Expiry: {expiry_display}\n"
-                text += f"└ Key:\n`{config_link}`\n\n"
+                continue
             
-            text += "_Key ကို Long Press လုပ်ပြီး Copy ယူပါ_"
+            # Get expiry from panel (in milliseconds)
+            client = client_info['client']
+            inbound = client_info['inbound']
+            protocol = inbound.get('protocol', 'trojan')
             
-            try:
-                bot.edit_message_text(
-                    text,
-                    call.message.chat.id,
-                    call.message.message_id,
-                    reply_markup=main_menu_keyboard()
-                )
-            except Exception as e:
-                # Message not modified error - ignore
-                pass
-    
-    # Check usage
-    elif data == "check_usage":
-        keys = get_user_keys(user_id)
-        if not keys:
-            bot.edit_message_text(
-                "📊 *Usage Check*\n\n❌ သင့်တွင် Active VPN Key မရှိပါ။\n\nKey ဝယ်ပြီးမှ Usage ကြည့်လို့ရပါမည်။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            text = "📊 *Usage Check*\n\n"
-            text += "သင့် VPN Key ၏ Usage ကို အောက်ပါ Link များမှ ကြည့်နိုင်ပါသည်:\n\n"
+            # XUI Panel handling
+            panel_expiry_ms = client.get('expiryTime', 0)
             
-            for i, key in enumerate(keys, 1):
-                server_name = SERVERS.get(key[3], {}).get('name', 'Unknown')
-                sub_link = key[6]  # sub_link column
-                text += f"*Key {i}* ({server_name}):\n"
-                text += f"🔗 [Usage ကြည့်ရန် နှိပ်ပါ]({sub_link})\n\n"
+            if panel_expiry_ms > 0:
+                panel_expiry = datetime.fromtimestamp(panel_expiry_ms / 1000)
+                expiry_str = panel_expiry.strftime('%Y-%m-%d %H:%M')
+                days_left = (panel_expiry - datetime.now()).days
+                expiry_display = f"{expiry_str} ({days_left} days left)"
+            else:
+                expiry_display = "Unlimited"
             
-            text += "_Link ကို Browser မှာ ဖွင့်ပြီး Traffic, Expiry Date စတာတွေ ကြည့်နိုင်ပါတယ်။_"
+            # Generate config link based on protocol
+            server = SERVERS.get(server_id, _EMPTY_SERVER)
+            port = inbound.get('port', 443)
+            build_link = _LINK_BUILDERS.get(protocol)
+            if build_link:
+                config_link = build_link(client, inbound, server, port)
+            else:
+                config_link = key.config_link or key.sub_link  # Fallback to database
             
-            bot.edit_message_text(
-                text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard(),
-                disable_web_page_preview=True
-            )
-    
-    # Exchange key - show user's keys to select
-    elif data == "exchange_key":
-        # Check if feature is enabled
-        if not feature_flags.get('protocol_change', True):
-            bot.edit_message_text(
-                "🚫 *Protocol Change ယာယီ ပိတ်ထားပါသည်။*\n\nနောက်မှ ပြန်ဖွင့်ပါမည်။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
+            parts.append(
+                f"*Key {i}:*\n"
+                f"├ Server: {server_name}\n"
+                f"├ Protocol: {protocol.upper()}\n"
+                f"├ Expiry: {expiry_display}\n"
+                f"└ Key:\n`{config_link}`\n\n"
             )
-            return
         
-        keys = get_user_keys(user_id)
-        if not keys:
-            bot.edit_message_text(
-                "🔄 *Key လဲလှယ်ရန်*\n\n❌ သင့်တွင် Active VPN Key မရှိပါ။\n\nKey ဝယ်ပြီးမှ Protocol လဲလှယ်လို့ရပါမည်။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            text = "🔄 *Key လဲလှယ်ရန်*\n\nProtocol ပြောင်းလိုသော Key ကို ရွေးပါ:\n\n"
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            
-            for i, key in enumerate(keys, 1):
-                key_id = key[0]  # id column
-                server_name = SERVERS.get(key[3], {}).get('name', 'Unknown')
-                expiry = key[9]
-                config_link = key[7] if key[7] else key[6]
-                
-                # Detect current protocol
-                current_proto = "Unknown"
-                if config_link.startswith('trojan://'):
-                    current_proto = "Trojan"
-                elif config_link.startswith('vless://'):
-                    current_proto = "VLESS"
-                elif config_link.startswith('vmess://'):
-                    current_proto = "VMess"
-                elif config_link.startswith('ss://'):
-                    current_proto = "Shadowsocks"
-                
-                text += f"*Key {i}:* {server_name}\n"
-                text += f"├ Protocol: {current_proto}\n"
-                text += f"└ Expiry: {expiry}\n\n"
-                
-                markup.add(types.InlineKeyboardButton(f"🔄 Key {i} - {current_proto} ပြောင်းရန်", callback_data=f"exkey_{key_id}"))
-            
-            markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"))
-            
-            bot.edit_message_text(
-                text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup
-            )
-    
-    # Exchange key - select key to change protocol
-    elif data.startswith("exkey_"):
-        key_id = int(data.replace("exkey_", ""))
-        key = get_vpn_key_by_id(key_id)
+        parts.append("_Key ကို Long Press လုပ်ပြီး Copy ယူပါ_")
+        text = "".join(parts)
         
-        if not key or key[1] != user_id:  # Check ownership
-            bot.answer_callback_query(call.id, "❌ Key ရှာမတွေ့ပါ။", show_alert=True)
-            return
+        safe_edit_message_text(
+            text,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+
+def _cb_check_usage(call, user_id, data):
+    """Check usage"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    keys = get_user_keys(user_id)
+    if not keys:
+        safe_edit_message_text(
+            "📊 *Usage Check*\n\n❌ သင့်တွင် Active VPN Key မရှိပါ။\n\nKey ဝယ်ပြီးမှ Usage ကြည့်လို့ရပါမည်။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+    else:
+        parts = [
+            "📊 *Usage Check*\n\n"
+            "သင့် VPN Key ၏ Usage ကို အောက်ပါ Link များမှ ကြည့်နိုင်ပါသည်:\n\n"
+        ]
+        
+        for i, key in enumerate(keys, 1):
+            server_name = key.server_name or _SERVER_NAMES.get(key.server_id, 'Unknown')
+            sub_link = key.sub_link
+            parts.append(
+                f"*Key {i}* ({server_name}):\n"
+                f"🔗 [Usage ကြည့်ရန် နှိပ်ပါ]({sub_link})\n\n"
+            )
         
-        server_id = key[3]
-        set_session(user_id, {'exchange_key_id': key_id, 'exchange_server_id': server_id})
+        parts.append("_Link ကို Browser မှာ ဖွင့်ပြီး Traffic, Expiry Date စတာတွေ ကြည့်နိုင်ပါတယ်။_")
+        text = "".join(parts)
         
-        # Show protocol selection
+        safe_edit_message_text(
+            text,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            disable_web_page_preview=True,
+            parse_mode='Markdown'
+        )
+
+def _cb_exchange_key(call, user_id, data):
+    """Exchange key - show user's keys to select"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Check if feature is enabled
+    if not feature_flags.get('protocol_change', True):
+        safe_edit_message_text(
+            "🚫 *Protocol Change ယာယီ ပိတ်ထားပါသည်။*\n\nနောက်မှ ပြန်ဖွင့်ပါမည်။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+        return
+    
+    keys = get_user_keys(user_id)
+    if not keys:
+        safe_edit_message_text(
+            "🔄 *Key လဲလှယ်ရန်*\n\n❌ သင့်တွင် Active VPN Key မရှိပါ။\n\nKey ဝယ်ပြီးမှ Protocol လဲလှယ်လို့ရပါမည်။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
+        )
+    else:
+        parts = ["🔄 *Key လဲလှယ်ရန်*\n\nProtocol ပြောင်းလိုသော Key ကို ရွေးပါ:\n\n"]
         markup = types.InlineKeyboardMarkup(row_width=1)
         
-        try:
-            available = get_available_protocols(server_id)
-            if not available:
-                available = ['trojan']
-        except:
-            available = ['trojan']
-        
-        protocol_labels = {
-            'trojan': '⭐ Trojan (အကောင်းဆုံး)',
-            'vless': 'VLESS',
-            'vmess': 'VMess',
-            'shadowsocks': 'Shadowsocks',
-            'wireguard': 'WireGuard'
-        }
-        
-        for proto in available:
-            label = protocol_labels.get(proto, proto.upper())
-            markup.add(types.InlineKeyboardButton(label, callback_data=f"expro_{key_id}_{proto}"))
+        for i, key in enumerate(keys, 1):
+            key_id = key.id
+            server_name = key.server_name or _SERVER_NAMES.get(key.server_id, 'Unknown')
+            expiry = key.expiry_date
+            config_link = key.config_link or key.sub_link
+            
+            # Detect current protocol
+            scheme, sep, _ = config_link.partition('://')
+            current_proto = _PROTO_MAP.get(scheme, "Unknown") if sep else "Unknown"
+            
+            parts.append(
+                f"*Key {i}:* {server_name}\n"
+                f"├ Protocol: {current_proto}\n"
+                f"└ Expiry: {expiry}\n\n"
+            )
+            
+            markup.add(types.InlineKeyboardButton(f"🔄 Key {i} - {current_proto} ပြောင်းရန်", callback_data=f"exkey_{key_id}"))
         
-        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="exchange_key"))
+        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"))
         
-        bot.edit_message_text(
-            f"🔐 *Protocol ရွေးချယ်ပါ*\n\n_ပြောင်းလိုသော Protocol ကို ရွေးပါ:_\n\n⭐ = အကောင်းဆုံး (ISP အားလုံးအတွက်)",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
+        safe_edit_message_text(
+            "".join(parts),
+            chat_id,
+            message_id,
+            reply_markup=markup,
+            parse_mode='Markdown'
         )
+
+def _cb_exkey(call, user_id, data):
+    """Exchange key - select key to change protocol"""
+    key_id = int(data.replace("exkey_", ""))
+    key = get_vpn_key_by_id(key_id)
     
-    # Exchange key - change protocol
-    elif data.startswith("expro_"):
-        parts = data.replace("expro_", "").split("_")
-        key_id = int(parts[0])
-        new_protocol = parts[1]
-        
+    if not key or key.telegram_id != user_id:  # Check ownership
+        answer_callback(call, "❌ Key ရှာမတွေ့ပါ။", show_alert=True)
+        return
+    
+    server_id = key.server_id
+    set_session(user_id, {'exchange_key_id': key_id, 'exchange_server_id': server_id})
+    
+    # Show protocol selection
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    
+    for proto in server_protocols(server_id):
+        label = _EXCHANGE_PROTOCOL_LABELS.get(proto) or proto.upper()
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"expro_{key_id}_{proto}"))
+    
+    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="exchange_key"))
+    
+    safe_edit_message_text(
+        f"🔐 *Protocol ရွေးချယ်ပါ*\n\n_ပြောင်းလိုသော Protocol ကို ရွေးပါ:_\n\n⭐ = အကောင်းဆုံး (ISP အားလုံးအတွက်)",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=markup,
+        parse_mode='Markdown'
+    )
+
+def _cb_expro(call, user_id, data):
+    """Exchange key - change protocol"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    parts = data.replace("expro_", "").split("_")
+    key_id = int(parts[0])
+    new_protocol = parts[1]
+    
+    # A second press while the swap is still running would delete/recreate the same key again
+    job_key = ('swap', key_id)
+    if not start_provisioning(job_key):
+        logger.info("Key %s protocol swap already in progress, ignoring press", key_id)
+        return
+    
+    submitted = False
+    try:
+        # Read the key after claiming, so a swap that just finished is seen
         key = get_vpn_key_by_id(key_id)
-        if not key or key[1] != user_id:
-            bot.answer_callback_query(call.id, "❌ Key ရှာမတွေ့ပါ။", show_alert=True)
+        if not key or key.telegram_id != user_id:
+            answer_callback(call, "❌ Key ရှာမတွေ့ပါ။", show_alert=True)
             return
         
-        server_id = key[3]
-        old_client_email = key[4]
-        
-        # Parse expiry date with multiple format support
-        expiry_str = str(key[9])
-        try:
-            if '.' in expiry_str:
-                expiry_date = datetime.strptime(expiry_str, '%Y-%m-%d %H:%M:%S.%f')
-            elif 'T' in expiry_str:
-                expiry_date = datetime.fromisoformat(expiry_str)
-            else:
-                expiry_date = datetime.strptime(expiry_str, '%Y-%m-%d %H:%M:%S')
-        except:
-            # Fallback - try other formats
-            try:
-                expiry_date = datetime.strptime(expiry_str[:19], '%Y-%m-%d %H:%M:%S')
-            except:
-                expiry_date = datetime.strptime(expiry_str[:10], '%Y-%m-%d')
-        
-        # Calculate exact expiry timestamp in milliseconds (keep ORIGINAL expiry date)
-        expiry_timestamp = int(expiry_date.timestamp() * 1000)
-        logger.info(f"Exchange key: Original expiry = {expiry_date}, timestamp = {expiry_timestamp}")
+        # Parse expiry date
+        expiry_date = parse_expiry_date(key.expiry_date)
         
         # Extract devices from old client_email (format: "username - 2D / Key 1")
         devices = 1
         try:
-            device_match = re.search(r'(\d+)D', old_client_email)
+            device_match = _DEVICE_RE.search(key.client_email)
             if device_match:
                 devices = int(device_match.group(1))
         except:
@@ -1542,96 +2318,137 @@ def button_callback(call):
         # Get username
         username = call.from_user.username if call.from_user.username else call.from_user.first_name
         
-        bot.edit_message_text(
+        safe_edit_message_text(
             "⏳ Protocol ပြောင်းနေပါသည်...",
-            call.message.chat.id,
-            call.message.message_id
+            chat_id,
+            message_id
         )
         
-        # Find the key number from old client name or use key position
-        existing_keys = get_user_keys(user_id)
-        key_position = 1
-        for i, k in enumerate(existing_keys, 1):
-            if k[0] == key_id:
-                key_position = i
-                break
-        
-        # Create new key with new protocol FIRST (using EXACT original expiry timestamp)
-        result = create_vpn_key(
-            server_id=server_id,
-            telegram_id=user_id,
-            username=username,
-            data_limit_gb=key[8] if key[8] else 0,  # Keep same data limit
-            expiry_days=30,  # Not used when expiry_timestamp is provided
-            devices=devices,  # Use extracted devices count
-            protocol=new_protocol,
-            expiry_timestamp=expiry_timestamp,  # Use EXACT original expiry
-            key_number=key_position
+        # Panel round-trips (create, delete, retry/rollback) run off the update thread
+        provision_executor.submit(
+            perform_protocol_swap,
+            chat_id,
+            message_id,
+            user_id,
+            key,
+            new_protocol,
+            expiry_date,
+            devices,
+            username
         )
+        submitted = True
+    finally:
+        if not submitted:
+            finish_provisioning(job_key)
+
+def perform_protocol_swap(chat_id, message_id, user_id, key, new_protocol, expiry_date, devices, username):
+    """Recreate a key with a new protocol and report the result in the status message"""
+    try:
+        _swap_key_protocol(chat_id, message_id, user_id, key, new_protocol, expiry_date, devices, username)
+    except Exception as e:
+        logger.error(f"Protocol swap error for key {key.id}: {e}")
+        try:
+            safe_edit_message_text(
+                "❌ Protocol ပြောင်းရာတွင် အမှားရှိပါသည်။ Admin ကို ဆက်သွယ်ပါ။",
+                chat_id,
+                message_id,
+                reply_markup=MAIN_MENU_MARKUP
+            )
+        except Exception:
+            pass
+    finally:
+        finish_provisioning(('swap', key.id))
+
+def _swap_key_protocol(chat_id, message_id, user_id, key, new_protocol, expiry_date, devices, username):
+    """Create the new-protocol client, remove the old one and update the DB"""
+    key_id = key.id
+    server_id = key.server_id
+    old_client_email = key.client_email
+    
+    # Calculate exact expiry timestamp in milliseconds (keep ORIGINAL expiry date)
+    expiry_timestamp = to_epoch_ms(expiry_date)
+    logger.info("Exchange key: Original expiry = %s, timestamp = %s", expiry_date, expiry_timestamp)
+    
+    # Keep the key's number (Key 1, Key 2, ...) for the new client name
+    key_position = get_key_position(user_id, key_id)
+    
+    # Create new key with new protocol FIRST (using EXACT original expiry timestamp)
+    result = create_vpn_key(
+        server_id=server_id,
+        telegram_id=user_id,
+        username=username,
+        data_limit_gb=key.data_limit or 0,  # Keep same data limit
+        expiry_days=30,  # Not used when expiry_timestamp is provided
+        devices=devices,  # Use extracted devices count
+        protocol=new_protocol,
+        expiry_timestamp=expiry_timestamp,  # Use EXACT original expiry
+        key_number=key_position
+    )
+    
+    if result and result.get('success'):
+        config_link = result.get('config_link', result['sub_link'])
+        new_client_email = result['client_email']
         
-        if result and result.get('success'):
-            config_link = result.get('config_link', result['sub_link'])
-            new_client_email = result['client_email']
+        # Delete old key from 3x-ui panel AFTER successful creation
+        delete_success = False
+        for attempt in range(3):
+            try:
+                delete_vpn_client(server_id, old_client_email)
+                logger.info("Deleted old key: %s", old_client_email)
+                delete_success = True
+                break
+            except Exception as e:
+                logger.error(f"Delete old key attempt {attempt+1}/3 failed: {e}")
+                _time.sleep(1)
+        
+        if not delete_success:
+            # Compensating action: delete the newly created key to avoid orphan
+            logger.error(f"⚠️ Failed to delete old key after 3 attempts. Rolling back new key creation.")
+            try:
+                delete_vpn_client(server_id, new_client_email)
+                logger.info("Rolled back new key: %s", new_client_email)
+            except Exception as e:
+                logger.error(f"Rollback also failed: {e}")
             
-            # Delete old key from 3x-ui panel AFTER successful creation
-            delete_success = False
-            for attempt in range(3):
-                try:
-                    delete_vpn_client(server_id, old_client_email)
-                    logger.info(f"Deleted old key: {old_client_email}")
-                    delete_success = True
-                    break
-                except Exception as e:
-                    logger.error(f"Delete old key attempt {attempt+1}/3 failed: {e}")
-                    _time.sleep(1)
+            # Notify admin
+            try:
+                bot.send_message(
+                    ADMIN_CHAT_ID,
+                    f"⚠️ *Protocol Exchange Error*\n\n"
+                    f"User: `{user_id}`\n"
+                    f"Old key: `{old_client_email}`\n"
+                    f"New key: `{new_client_email}`\n\n"
+                    f"Delete old key failed 3x. Rolled back new key.\n"
+                    f"Manual cleanup may be needed on {server_id}.",
+                    parse_mode='Markdown'
+                )
+            except:
+                pass
             
-            if not delete_success:
-                # Compensating action: delete the newly created key to avoid orphan
-                logger.error(f"⚠️ Failed to delete old key after 3 attempts. Rolling back new key creation.")
-                try:
-                    delete_vpn_client(server_id, new_client_email)
-                    logger.info(f"Rolled back new key: {new_client_email}")
-                except Exception as e:
-                    logger.error(f"Rollback also failed: {e}")
-                
-                # Notify admin
-                try:
-                    bot.send_message(
-                        ADMIN_CHAT_ID,
-                        f"⚠️ *Protocol Exchange Error*\n\n"
-                        f"User: `{user_id}`\n"
-                        f"Old key: `{old_client_email}`\n"
-                        f"New key: `{new_client_email}`\n\n"
-                        f"Delete old key failed 3x. Rolled back new key.\n"
-                        f"Manual cleanup may be needed on {server_id}.",
-                        parse_mode='Markdown'
-                    )
-                except:
-                    pass
-                
-                bot.edit_message_text(
-                    "❌ Protocol ပြောင်းရာတွင် အမှားရှိပါသည်။ Admin ကို ဆက်သွယ်ပါ။",
-                    call.message.chat.id,
-                    call.message.message_id,
-                    reply_markup=main_menu_keyboard()
-                )
-                return
-            
-            # Update database
-            update_vpn_key(
-                key_id=key_id,
-                sub_link=result['sub_link'],
-                config_link=config_link,
-                client_email=new_client_email,
-                client_id=result['client_id']
+            safe_edit_message_text(
+                "❌ Protocol ပြောင်းရာတွင် အမှားရှိပါသည်။ Admin ကို ဆက်သွယ်ပါ။",
+                chat_id,
+                message_id,
+                reply_markup=MAIN_MENU_MARKUP
             )
-            
-            expiry_str = expiry_date.strftime('%Y-%m-%d %H:%M')
-            
-            success_text = f"""
+            return
+        
+        # Update database
+        update_vpn_key(
+            key_id=key_id,
+            sub_link=result['sub_link'],
+            config_link=config_link,
+            client_email=new_client_email,
+            client_id=result['client_id']
+        )
+        
+        # Display straight from the stored ISO value ("YYYY-MM-DD HH:MM...") - no re-format
+        expiry_str = str(key.expiry_date)[:16].replace('T', ' ')
+        
+        success_text = f"""
 ✅ *Protocol ပြောင်းလဲပြီးပါပြီ!*
 
-🖥️ *Server:* {SERVERS[server_id]['name']}
+🖥️ *Server:* {_SERVER_NAMES[server_id]}
 🔐 *New Protocol:* {new_protocol.upper()}
 📅 *Expiry:* {expiry_str}
 
@@ -1642,27 +2459,25 @@ def button_callback(call):
 
 _Key အသစ်ကို App မှာ ပြန်ထည့်ပါ။_
 """
-            
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            
-            bot.edit_message_text(
-                success_text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup
-            )
-        else:
-            bot.edit_message_text(
-                "❌ Protocol ပြောင်းရာတွင် အမှားရှိပါသည်။ Admin ကို ဆက်သွယ်ပါ။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-    
-    # Help
-    elif data == "help":
-        Help_text = """
+        
+        safe_edit_message_text(
+            success_text,
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_ONLY_MARKUP,
+            parse_mode='Markdown'
+        )
+    else:
+        safe_edit_message_text(
+            "❌ Protocol ပြောင်းရာတွင် အမှားရှိပါသည်။ Admin ကို ဆက်သွယ်ပါ။",
+            chat_id,
+            message_id,
+            reply_markup=MAIN_MENU_MARKUP
+        )
+
+def _cb_help(call, user_id, data):
+    """Help"""
+    Help_text = """
 📖 *အကူအညီ*
 
 *VPN Key ဝယ်နည်း:*
@@ -1681,137 +2496,178 @@ _Key အသစ်ကို App မှာ ပြန်ထည့်ပါ။_
 *ပြဿနာရှိပါက:*
 📞 Admin ကို ဆက်သွယ်ပါ
 """
-        bot.edit_message_text(
-            Help_text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=main_menu_keyboard()
-        )
-    
-    # Contact
-    elif data == "contact":
-        bot.edit_message_text(
-            "📞 *ဆက်သွယ်ရန်*\n\nAdmin: @BDS\\_Admin\n\nအကူအညီလိုပါက Message ပို့ပေးပါ။",
+    safe_edit_message_text(
+        Help_text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_contact(call, user_id, data):
+    """Contact"""
+    safe_edit_message_text(
+        "📞 *ဆက်သွယ်ရန်*\n\nAdmin: @BDS\\_Admin\n\nအကူအညီလိုပါက Message ပို့ပေးပါ။",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_referral(call, user_id, data):
+    """Referral menu"""
+    # Check if feature is enabled
+    if not feature_flags.get('referral_system', True):
+        safe_edit_message_text(
+            "🚫 *Referral System ယာယီ ပိတ်ထားပါသည်။*\n\nနောက်မှ ပြန်ဖွင့်ပါမည်။",
             call.message.chat.id,
             call.message.message_id,
-            reply_markup=main_menu_keyboard()
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
         )
+        return
+    show_referral_menu(call)
+
+def _cb_my_referral_link(call, user_id, data):
+    """Referral link"""
+    show_referral_link(call)
+
+def _cb_referral_stats(call, user_id, data):
+    """Referral stats"""
+    show_referral_stats(call)
+
+def _cb_claim_free_month(call, user_id, data):
+    """Claim referral free month"""
+    claim_referral_reward(call)
+
+def _cb_approve_freekey(call, user_id, data):
+    """Admin approve referral free key"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Allow approval from Payment Channel or Admin
+    if chat_id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
+        answer_callback(call, "❌ Admin only!", show_alert=True)
+        return
     
-    # Referral System
-    elif data == "referral":
-        # Check if feature is enabled
-        if not feature_flags.get('referral_system', True):
-            bot.edit_message_text(
-                "🚫 *Referral System ယာယီ ပိတ်ထားပါသည်။*\n\nနောက်မှ ပြန်ဖွင့်ပါမည်။",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=main_menu_keyboard()
-            )
-            return
-        show_referral_menu(call)
-    
-    elif data == "my_referral_link":
-        show_referral_link(call)
-    
-    elif data == "referral_stats":
-        show_referral_stats(call)
+    try:
+        customer_id = int(data.split("_")[2])
+    except (ValueError, IndexError):
+        answer_callback(call, "❌ Invalid data.", show_alert=True)
+        return
     
-    elif data == "claim_free_month":
-        claim_referral_reward(call)
+    job_key = ('freekey', customer_id)
+    if not start_provisioning(job_key):
+        logger.info("Referral free key for %s is already being created, ignoring approve", customer_id)
+        return
     
-    # Admin approve referral free key (must be BEFORE generic approve_ handler)
-    elif data.startswith("approve_freekey_"):
-        # Allow approval from Payment Channel or Admin
-        if call.message.chat.id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
-            bot.answer_callback_query(call.id, "❌ Admin only!", show_alert=True)
-            return
-        
-        try:
-            customer_id = int(data.split("_")[2])
-        except (ValueError, IndexError):
-            bot.answer_callback_query(call.id, "❌ Invalid data.", show_alert=True)
-            return
-        
+    submitted = False
+    try:
         # Check if user can still claim
-        stats = get_referral_stats(customer_id)
+        stats = get_referral_stats(customer_id, fresh=True)
         if not stats['can_claim_free_month']:
-            bot.edit_message_text(
+            safe_edit_message_text(
                 "❌ *Request Invalid*\n\nUser သည် Free Key ရယူပိုင်ခွင့် မရှိတော့ပါ။",
-                call.message.chat.id,
-                call.message.message_id,
+                chat_id,
+                message_id,
                 parse_mode='Markdown'
             )
             return
         
         # Update message to show processing
-        bot.edit_message_text(
+        safe_edit_message_text(
             "⏳ *Key ဖန်တီးနေပါသည်...*",
-            call.message.chat.id,
-            call.message.message_id,
+            chat_id,
+            message_id,
             parse_mode='Markdown'
         )
         
-        # Get customer info
-        customer = get_user(customer_id)
-        customer_username = customer[2] if customer and customer[2] else f"User_{customer_id}"
-        
-        # Get existing keys count for key number
-        existing_keys = get_user_keys(customer_id)
-        key_number = len(existing_keys) + 1
-        
-        # Create free key - Use first available active server
-        server_id = None
-        for sid, server in SERVERS.items():
-            if sid not in disabled_servers:
-                server_id = sid
-                break
-        if not server_id:
-            server_id = list(SERVERS.keys())[0]  # Fallback to first server
-        
-        # Free key plan: 1 Month, 1 Device
-        free_plan = {
-            'name': '🎁 Referral Free Key (1 Month)',
-            'data_limit': 0,  # Unlimited
-            'expiry_days': 30,
-            'devices': 1
-        }
+        # Panel round-trip runs off the update thread
+        provision_executor.submit(perform_referral_free_key, chat_id, message_id, customer_id)
+        submitted = True
+    finally:
+        if not submitted:
+            finish_provisioning(job_key)
+
+def perform_referral_free_key(chat_id, message_id, customer_id):
+    """Create an approved referral free key and report the result in the admin message"""
+    try:
+        _create_referral_free_key(chat_id, message_id, customer_id)
+    except Exception as e:
+        logger.error(f"Referral free key error for user {customer_id}: {e}")
+        try:
+            safe_edit_message_text(
+                f"❌ *Failed to create key*\n\n"
+                f"👤 User: `{customer_id}`",
+                chat_id,
+                message_id,
+                parse_mode='Markdown'
+            )
+        except Exception:
+            pass
+    finally:
+        finish_provisioning(('freekey', customer_id))
+
+def _create_referral_free_key(chat_id, message_id, customer_id):
+    """Create the 1 month referral key, record the claim and notify customer and admin"""
+    # Get customer info
+    customer_username = get_username(customer_id) or f"User_{customer_id}"
+    
+    # Get existing keys count for key number
+    key_number = count_user_keys(customer_id) + 1
+    
+    # Create free key - Use first available active server
+    server_id = None
+    for sid, server in SERVERS.items():
+        if sid not in disabled_servers:
+            server_id = sid
+            break
+    if not server_id:
+        server_id = list(SERVERS.keys())[0]  # Fallback to first server
+    
+    # Free key plan: 1 Month, 1 Device
+    free_plan = {
+        'name': '🎁 Referral Free Key (1 Month)',
+        'data_limit': 0,  # Unlimited
+        'expiry_days': 30,
+        'devices': 1
+    }
+    
+    result = create_vpn_key(
+        server_id=server_id,
+        telegram_id=customer_id,
+        username=customer_username,
+        data_limit_gb=free_plan['data_limit'],
+        expiry_days=free_plan['expiry_days'],
+        devices=free_plan['devices'],
+        protocol='trojan',
+        key_number=key_number
+    )
+    
+    if result and result.get('success'):
+        # Record the claim in database
+        success, status = claim_free_month_reward(customer_id)
         
-        result = create_vpn_key(
-            server_id=server_id,
+        config_link = result.get('config_link', result['sub_link'])
+        save_vpn_key(
             telegram_id=customer_id,
-            username=customer_username,
-            data_limit_gb=free_plan['data_limit'],
-            expiry_days=free_plan['expiry_days'],
-            devices=free_plan['devices'],
-            protocol='trojan',
-            key_number=key_number
+            order_id=None,  # No order for free key
+            server_id=server_id,
+            client_email=result['client_email'],
+            client_id=result['client_id'],
+            sub_link=result['sub_link'],
+            config_link=config_link,
+            data_limit=free_plan['data_limit'],
+            expiry_date=result['expiry_date']
         )
         
-        if result and result.get('success'):
-            # Record the claim in database
-            success, status = claim_free_month_reward(customer_id)
-            
-            config_link = result.get('config_link', result['sub_link'])
-            save_vpn_key(
-                telegram_id=customer_id,
-                order_id=None,  # No order for free key
-                server_id=server_id,
-                client_email=result['client_email'],
-                client_id=result['client_id'],
-                sub_link=result['sub_link'],
-                config_link=config_link,
-                data_limit=free_plan['data_limit'],
-                expiry_date=result['expiry_date']
-            )
-            
-            # Notify customer
-            expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
-            customer_message = f"""
+        # Notify customer
+        expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
+        customer_message = f"""
 🎉 *Congratulations!*
 
 🎁 *Referral Reward Key ရရှိပါပြီ!*
 
-🖥️ *Server:* {SERVERS[server_id]['name']}
+🖥️ *Server:* {_SERVER_NAMES[server_id]}
 📦 *Plan:* {free_plan['name']}
 ⏰ *Expiry:* {expiry_str}
 📊 *Data:* Unlimited
@@ -1830,121 +2686,120 @@ _App မှာ Subscription Link ထည့်ပြီး အသုံးပြ
 
 🙏 Referral အတွက် ကျေးဇူးတင်ပါသည်!
 """
-            nav_keyboard = types.InlineKeyboardMarkup(row_width=1)
-            nav_keyboard.add(
-                types.InlineKeyboardButton("🔑 My Keys", callback_data="my_keys"),
-                types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
-            )
-            bot.send_message(customer_id, customer_message, parse_mode='Markdown', reply_markup=nav_keyboard)
-            
-            # Update admin message
-            customer_username_display = customer_username.replace("_", "\\_")
-            bot.edit_message_text(
-                f"✅ *Referral Free Key Approved!*\n\n"
-                f"👤 User: @{customer_username_display} (`{customer_id}`)\n"
-                f"🖥️ Server: {SERVERS[server_id]['name']}\n"
-                f"📦 Plan: {free_plan['name']}\n"
-                f"⏰ Expiry: {expiry_str}\n\n"
-                f"✓ Key created and sent to user",
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='Markdown'
-            )
-        else:
-            safe_name = str(customer_username).replace('_', '\\_')
-            bot.edit_message_text(
-                f"❌ *Failed to create key*\n\n"
-                f"👤 User: @{safe_name} ({customer_id})\n"
-                f"Error: {result.get('error', 'Unknown error') if result else 'No response'}",
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='Markdown'
-            )
-    
-    # Admin reject referral free key (must be BEFORE generic reject_ handler)
-    elif data.startswith("reject_freekey_"):
-        # Allow rejection from Payment Channel or Admin
-        if call.message.chat.id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
-            bot.answer_callback_query(call.id, "❌ Admin only!", show_alert=True)
-            return
-        
-        try:
-            customer_id = int(data.split("_")[2])
-        except (ValueError, IndexError):
-            bot.answer_callback_query(call.id, "❌ Invalid data.", show_alert=True)
-            return
-        
-        # Get customer info
-        customer = get_user(customer_id)
-        customer_username = customer[2] if customer and customer[2] else f"User_{customer_id}"
-        customer_username_display = customer_username.replace("_", "\\_") if customer_username else f"User\\_{customer_id}"
-        
-        # Notify customer
-        reject_keyboard = types.InlineKeyboardMarkup(row_width=1)
-        reject_keyboard.add(
-            types.InlineKeyboardButton("👥 Referral Menu", callback_data="referral"),
-            types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin"),
-            types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
-        )
-        bot.send_message(
-            customer_id,
-            "❌ *Referral Free Key Request Rejected*\n\n"
-            "ပြဿနာရှိပါက Admin ကို ဆက်သွယ်ပါ။",
-            parse_mode='Markdown',
-            reply_markup=reject_keyboard
-        )
+        queue_message(customer_id, customer_message, parse_mode='Markdown', reply_markup=REFERRAL_KEY_READY_MARKUP)
         
         # Update admin message
-        bot.edit_message_text(
-            f"❌ *Referral Free Key Rejected*\n\n"
-            f"👤 User: @{customer_username_display} (`{customer_id}`)\n\n"
-            f"✗ Request rejected by admin",
-            call.message.chat.id,
-            call.message.message_id,
+        customer_username_display = customer_username.replace("_", "\\_")
+        safe_edit_message_text(
+            f"✅ *Referral Free Key Approved!*\n\n"
+            f"👤 User: @{customer_username_display} (`{customer_id}`)\n"
+            f"🖥️ Server: {_SERVER_NAMES[server_id]}\n"
+            f"📦 Plan: {free_plan['name']}\n"
+            f"⏰ Expiry: {expiry_str}\n\n"
+            f"✓ Key created and sent to user",
+            chat_id,
+            message_id,
             parse_mode='Markdown'
         )
+    else:
+        safe_name = str(customer_username).replace('_', '\\_')
+        safe_edit_message_text(
+            f"❌ *Failed to create key*\n\n"
+            f"👤 User: @{safe_name} ({customer_id})\n"
+            f"Error: {result.get('error', 'Unknown error') if result else 'No response'}",
+            chat_id,
+            message_id,
+            parse_mode='Markdown'
+        )
+
+def _cb_reject_freekey(call, user_id, data):
+    """Admin reject referral free key"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Allow rejection from Payment Channel or Admin
+    if chat_id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
+        answer_callback(call, "❌ Admin only!", show_alert=True)
+        return
     
-    # Admin approve order (from Payment Channel)
-    elif data.startswith("approve_"):
-        # Allow approval from Payment Channel or Admin
-        if call.message.chat.id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
-            SecurityLogger.log_failed_auth(user_id, "approve_order")
-            bot.answer_callback_query(call.id, "❌ Admin only!", show_alert=True)
-            return
-        
-        parts = data.split("_")
-        
-        # Security: Validate order_id and customer_id are integers
-        try:
-            order_id = int(parts[1])
-            customer_id = int(parts[2])
-        except (ValueError, IndexError):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_APPROVE_DATA", data)
-            bot.answer_callback_query(call.id, "❌ Invalid order data.", show_alert=True)
-            return
-        
-        SecurityLogger.log_admin_action(user_id, "approve_order", f"order_id={order_id}")
-        
-        # Get order details
+    try:
+        customer_id = int(data.split("_")[2])
+    except (ValueError, IndexError):
+        answer_callback(call, "❌ Invalid data.", show_alert=True)
+        return
+    
+    # Get customer info
+    customer_username = get_username(customer_id) or f"User_{customer_id}"
+    customer_username_display = customer_username.replace("_", "\\_") if customer_username else f"User\\_{customer_id}"
+    
+    # Notify customer
+    queue_message(
+        customer_id,
+        "❌ *Referral Free Key Request Rejected*\n\n"
+        "ပြဿနာရှိပါက Admin ကို ဆက်သွယ်ပါ။",
+        parse_mode='Markdown',
+        reply_markup=REFERRAL_REJECTED_MARKUP
+    )
+    
+    # Update admin message
+    safe_edit_message_text(
+        f"❌ *Referral Free Key Rejected*\n\n"
+        f"👤 User: @{customer_username_display} (`{customer_id}`)\n\n"
+        f"✗ Request rejected by admin",
+        chat_id,
+        message_id,
+        parse_mode='Markdown'
+    )
+
+def _cb_approve(call, user_id, data):
+    """Admin approve order (from Payment Channel)"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Allow approval from Payment Channel or Admin
+    if chat_id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
+        SecurityLogger.log_failed_auth(user_id, "approve_order")
+        answer_callback(call, "❌ Admin only!", show_alert=True)
+        return
+    
+    parts = data.split("_")
+    
+    # Security: Validate order_id and customer_id are integers
+    try:
+        order_id = int(parts[1])
+        customer_id = int(parts[2])
+    except (ValueError, IndexError):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_APPROVE_DATA", data)
+        answer_callback(call, "❌ Invalid order data.", show_alert=True)
+        return
+    
+    SecurityLogger.log_admin_action(user_id, "approve_order", f"order_id={order_id}")
+    
+    job_key = ('order', order_id)
+    if not start_provisioning(job_key):
+        logger.info("Order #%s is already being processed, ignoring approve", order_id)
+        return
+    
+    submitted = False
+    try:
+        # Get order details (after claiming, so an auto-approve that just finished is seen)
         order = get_order(order_id)
         if not order:
-            bot.answer_callback_query(call.id, "Order not found!", show_alert=True)
+            answer_callback(call, "Order not found!", show_alert=True)
             return
         
         # Check if order is already approved
         if order[6] != 'pending':  # status column
             safe_username = str(customer_id)
-            customer = get_user(customer_id)
-            if customer and customer[2]:
-                safe_username = str(customer[2]).replace('_', '\\_')
+            customer_username = get_username(customer_id)
+            if customer_username:
+                safe_username = str(customer_username).replace('_', '\\_')
             
             bot.edit_message_caption(
                 caption=f"ℹ️ *Order #{order_id} Already Processed*\n\n"
                         f"👤 User: @{safe_username} ({customer_id})\n"
                         f"📊 Status: {order[6]}\n\n"
                         f"_This order was already handled._",
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                chat_id=chat_id,
+                message_id=message_id,
                 parse_mode='Markdown'
             )
             return
@@ -1952,182 +2807,235 @@ _App မှာ Subscription Link ထည့်ပြီး အသုံးပြ
         # Cancel auto-approve timer if exists
         cancel_auto_approve(order_id)
         
-        server_id = order[2]
-        plan_id = order[3]
-        protocol = order[5] if len(order) > 5 else 'trojan'  # protocol column
-        plan = PLANS.get(plan_id)
-        
-        # Get customer username
-        customer = get_user(customer_id)
-        customer_username = customer[2] if customer and customer[2] else f"User_{customer_id}"
-        customer_username_safe = str(customer_username).replace('_', '\\_')
-        
-        # Get current key count for this customer to determine key number
-        existing_keys = get_user_keys(customer_id)
-        key_number = len(existing_keys) + 1
-        
         bot.edit_message_caption(
             caption="⏳ Key ဖန်တီးနေပါသည်...",
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id
-        )
-        
-        # Create VPN key with username and protocol
-        result = create_vpn_key(
-            server_id=server_id,
-            telegram_id=customer_id,
-            username=customer_username,
-            data_limit_gb=plan['data_limit'],
-            expiry_days=plan['expiry_days'],
-            devices=plan['devices'],
-            protocol=protocol,
-            key_number=key_number
+            chat_id=chat_id,
+            message_id=message_id
         )
         
-        if result and result.get('success'):
-            approve_order(order_id, user_id)
-            config_link = result.get('config_link', result['sub_link'])
-            save_vpn_key(
-                telegram_id=customer_id,
-                order_id=order_id,
-                server_id=server_id,
-                client_email=result['client_email'],
-                client_id=result['client_id'],
-                sub_link=result['sub_link'],
-                config_link=config_link,
-                data_limit=plan['data_limit'],
-                expiry_date=result['expiry_date']
-            )
-            
-            # Notify customer
-            expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
-            data_limit_str = "Unlimited" if plan['data_limit'] == 0 else f"{plan['data_limit']} GB"
-            
-            customer_message = MESSAGES['key_generated'].format(
-                server=SERVERS[server_id]['name'],
-                plan=plan['name'],
-                expiry=expiry_str,
-                data_limit=data_limit_str,
-                config_link=config_link,
-                sub_link=result['sub_link']
-            )
-            
-            # Create keyboard with buttons for customer
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            markup.add(
-                types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
-                types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin")
-            )
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            
-            bot.send_message(customer_id, customer_message, reply_markup=markup, disable_web_page_preview=True)
-            
-            # Process referral reward
-            process_referral_on_purchase(customer_id, order_id)
-            
-            # Update admin message with full order details
+        # Panel round-trip runs off the update thread
+        provision_executor.submit(perform_order_approval, chat_id, message_id, user_id, order, customer_id)
+        submitted = True
+    finally:
+        if not submitted:
+            finish_provisioning(job_key)
+
+def perform_order_approval(chat_id, message_id, admin_id, order, customer_id):
+    """Create the key for an approved order and report the result in the admin message"""
+    order_id = order[0]
+    try:
+        _create_order_key(chat_id, message_id, admin_id, order, customer_id)
+    except Exception as e:
+        logger.error(f"Order #{order_id} approval error: {e}")
+        try:
             bot.edit_message_caption(
-                caption=f"✅ *Order #{order_id} Approved!*\n\n"
-                        f"👤 User: @{customer_username_safe} ({customer_id})\n"
-                        f"🖥️ Server: {SERVERS[server_id]['name']}\n"
-                        f"📦 Plan: {plan['name']}\n"
-                        f"💰 Amount: {plan['price']:,} Ks\n"
-                        f"📅 Expiry: {expiry_str}\n"
-                        f"🔑 Key: {result['client_email']}\n\n"
-                        f"✓ Key sent to user",
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                caption=f"❌ *Failed to create key*\n\nOrder #{order_id}\n👤 User: `{customer_id}`",
+                chat_id=chat_id,
+                message_id=message_id,
                 parse_mode='Markdown'
             )
-        else:
+        except Exception:
+            pass
+    finally:
+        finish_provisioning(('order', order_id))
+
+def _create_order_key(chat_id, message_id, admin_id, order, customer_id):
+    """Create the VPN key for a pending order, mark it approved and notify customer and admin"""
+    order_id = order[0]
+    server_id = order[2]
+    plan_id = order[3]
+    protocol = order[5] if len(order) > 5 else 'trojan'  # protocol column
+    plan = PLANS.get(plan_id)
+    
+    # Get customer username
+    customer_username = get_username(customer_id) or f"User_{customer_id}"
+    customer_username_safe = str(customer_username).replace('_', '\\_')
+    
+    # Get current key count for this customer to determine key number
+    key_number = count_user_keys(customer_id) + 1
+    
+    # Create VPN key with username and protocol
+    result = create_vpn_key(
+        server_id=server_id,
+        telegram_id=customer_id,
+        username=customer_username,
+        data_limit_gb=plan['data_limit'],
+        expiry_days=plan['expiry_days'],
+        devices=plan['devices'],
+        protocol=protocol,
+        key_number=key_number
+    )
+    
+    if result and result.get('success'):
+        config_link = result.get('config_link', result['sub_link'])
+        key_id = approve_and_save_key(
+            order_id=order_id,
+            admin_id=admin_id,
+            telegram_id=customer_id,
+            server_id=server_id,
+            client_email=result['client_email'],
+            client_id=result['client_id'],
+            sub_link=result['sub_link'],
+            config_link=config_link,
+            data_limit=plan['data_limit'],
+            expiry_date=result['expiry_date']
+        )
+        if key_id is None:
+            # Order was rejected meanwhile (or the DB write failed) - remove the panel client
+            # so the customer isn't left with an untracked working key
+            try:
+                delete_vpn_client(server_id, result['client_id'])
+            except Exception as e:
+                logger.error(f"Failed to remove client {result['client_email']} for order #{order_id}: {e}")
+            current = get_order(order_id)
             bot.edit_message_caption(
-                caption=f"❌ *Failed to create key*\n\n"
+                caption=f"❌ *Key not saved*\n\n"
                         f"Order #{order_id}\n"
                         f"👤 User: @{customer_username_safe} ({customer_id})\n"
-                        f"🖥️ Server: {SERVERS[server_id]['name']}\n"
-                        f"📦 Plan: {plan['name']}\n"
-                        f"💰 Amount: {plan['price']:,} Ks",
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
+                        f"📊 Status: {current[6] if current else 'unknown'}\n\n"
+                        f"_Panel client removed, nothing sent to user._",
+                chat_id=chat_id,
+                message_id=message_id,
                 parse_mode='Markdown'
             )
-    
-    # Admin reject order (from Payment Channel)
-    elif data.startswith("reject_"):
-        # Allow rejection from Payment Channel or Admin
-        if call.message.chat.id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
-            SecurityLogger.log_failed_auth(user_id, "reject_order")
-            bot.answer_callback_query(call.id, "❌ Admin only!", show_alert=True)
-            return
-        
-        parts = data.split("_")
-        
-        # Security: Validate order_id and customer_id are integers
-        try:
-            order_id = int(parts[1])
-            customer_id = int(parts[2])
-        except (ValueError, IndexError):
-            SecurityLogger.log_suspicious_activity(user_id, "INVALID_REJECT_DATA", data)
-            bot.answer_callback_query(call.id, "❌ Invalid order data.", show_alert=True)
             return
         
-        # Cancel auto-approve timer if exists
-        cancel_auto_approve(order_id)
-        
-        # Get order details for logging
-        order = get_order(order_id)
-        order_server_id = order[2] if order else 'Unknown'
-        order_plan_id = order[3] if order else 'Unknown'
-        order_amount = order[4] if order else 0
-        plan = PLANS.get(order_plan_id, {})
-        
-        # Get customer info
-        customer = get_user(customer_id)
-        customer_username = customer[2] if customer and customer[2] else f"User_{customer_id}"
-        customer_username_safe = str(customer_username).replace('_', '\\_')
+        # Notify customer
+        expiry_str = result['expiry_date'].strftime('%Y-%m-%d %H:%M')
+        data_limit_str = "Unlimited" if plan['data_limit'] == 0 else f"{plan['data_limit']} GB"
+        
+        customer_message = MESSAGES['key_generated'].format(
+            server=_SERVER_NAMES[server_id],
+            plan=plan['name'],
+            expiry=expiry_str,
+            data_limit=data_limit_str,
+            config_link=config_link,
+            sub_link=result['sub_link']
+        )
         
-        SecurityLogger.log_admin_action(user_id, "reject_order", f"order_id={order_id}")
+        # Already on a provision worker - send directly so the caption below reports what happened
+        delivered = _send_outbound(customer_id, customer_message, dict(reply_markup=ORDER_APPROVED_MARKUP, disable_web_page_preview=True, parse_mode='Markdown'))
         
-        reject_order(order_id, user_id)
+        # Process referral reward
+        process_referral_on_purchase(customer_id, order_id)
         
-        # Notify customer with navigation buttons
-        reject_keyboard = types.InlineKeyboardMarkup(row_width=2)
-        reject_keyboard.add(
-            types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
-            types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin")
+        # Update admin message with full order details
+        bot.edit_message_caption(
+            caption=f"✅ *Order #{order_id} Approved!*\n\n"
+                    f"👤 User: @{customer_username_safe} ({customer_id})\n"
+                    f"🖥️ Server: {_SERVER_NAMES[server_id]}\n"
+                    f"📦 Plan: {plan['name']}\n"
+                    f"💰 Amount: {plan['price']:,} Ks\n"
+                    f"📅 Expiry: {expiry_str}\n"
+                    f"🔑 Key: {result['client_email']}\n\n"
+                    + ("✓ Key sent to user" if delivered else "⚠️ Key saved, but sending it to the user failed"),
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode='Markdown'
         )
-        reject_keyboard.add(
-            types.InlineKeyboardButton("📖 Help", callback_data="help"),
-            types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")
+    else:
+        bot.edit_message_caption(
+            caption=f"❌ *Failed to create key*\n\n"
+                    f"Order #{order_id}\n"
+                    f"👤 User: @{customer_username_safe} ({customer_id})\n"
+                    f"🖥️ Server: {_SERVER_NAMES[server_id]}\n"
+                    f"📦 Plan: {plan['name']}\n"
+                    f"💰 Amount: {plan['price']:,} Ks",
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode='Markdown'
         )
-        bot.send_message(
-            customer_id, 
+
+def _cb_reject(call, user_id, data):
+    """Admin reject order (from Payment Channel)"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    # Allow rejection from Payment Channel or Admin
+    if chat_id != PAYMENT_CHANNEL_ID and user_id != ADMIN_CHAT_ID:
+        SecurityLogger.log_failed_auth(user_id, "reject_order")
+        answer_callback(call, "❌ Admin only!", show_alert=True)
+        return
+    
+    parts = data.split("_")
+    
+    # Security: Validate order_id and customer_id are integers
+    try:
+        order_id = int(parts[1])
+        customer_id = int(parts[2])
+    except (ValueError, IndexError):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_REJECT_DATA", data)
+        answer_callback(call, "❌ Invalid order data.", show_alert=True)
+        return
+    
+    # Same job key as approval: a reject can't land while a key is being created for the order
+    job_key = ('order', order_id)
+    if not start_provisioning(job_key):
+        logger.info("Order #%s is being approved, ignoring reject", order_id)
+        return
+    
+    try:
+        # Cancel auto-approve timer if exists
+        cancel_auto_approve(order_id)
+        
+        # Get order details for logging
+        order = get_order(order_id)
+        order_server_id = order[2] if order else 'Unknown'
+        order_plan_id = order[3] if order else 'Unknown'
+        order_amount = order[4] if order else 0
+        plan = PLANS.get(order_plan_id, {})
+        
+        # Get customer info
+        customer_username = get_username(customer_id) or f"User_{customer_id}"
+        customer_username_safe = str(customer_username).replace('_', '\\_')
+        
+        SecurityLogger.log_admin_action(user_id, "reject_order", f"order_id={order_id}")
+        
+        # Only a still-pending order is rejected - an approved one keeps its key
+        if not reject_order(order_id, user_id):
+            current = get_order(order_id)
+            bot.edit_message_caption(
+                caption=f"ℹ️ *Order #{order_id} Already Processed*\n\n"
+                        f"👤 User: @{customer_username_safe} ({customer_id})\n"
+                        f"📊 Status: {current[6] if current else 'unknown'}\n\n"
+                        f"_This order was already handled._",
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode='Markdown'
+            )
+            return
+        
+        # Notify customer with navigation buttons
+        queue_message(
+            customer_id,
             "❌ *သင့် Order ပယ်ချခံရပါသည်။*\n\n"
             "ပြဿနာရှိပါက Admin ကို ဆက်သွယ်ပါ။\n"
             "သို့မဟုတ် ထပ်မံ Order တင်နိုင်ပါသည်။",
-            reply_markup=reject_keyboard
+            reply_markup=ORDER_REJECTED_MARKUP,
+            parse_mode='Markdown'
         )
         
         # Update admin message with full order details
         bot.edit_message_caption(
             caption=f"❌ *Order #{order_id} Rejected!*\n\n"
                     f"👤 User: @{customer_username_safe} ({customer_id})\n"
-                    f"🖥️ Server: {SERVERS.get(order_server_id, {}).get('name', 'Unknown')}\n"
+                    f"🖥️ Server: {_SERVER_NAMES.get(order_server_id, 'Unknown')}\n"
                     f"📦 Plan: {plan.get('name', order_plan_id)}\n"
                     f"💰 Amount: {order_amount:,} Ks\n\n"
                     f"✗ Order rejected by admin",
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
+            chat_id=chat_id,
+            message_id=message_id,
             parse_mode='Markdown'
         )
+    finally:
+        finish_provisioning(job_key)
+
+def _cb_admin_sales(call, user_id, data):
+    """Admin sales report"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    # Admin menu handlers
-    elif data == "admin_sales":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        stats = get_sales_stats()
-        text = f"""
+    stats = get_sales_stats()
+    text = f"""
 📊 *Sales Report*
 
 💰 *Total Sales:* {stats['total_sales']:,} Ks
@@ -2136,671 +3044,812 @@ _App မှာ Subscription Link ထည့်ပြီး အသုံးပြ
 🔑 *Active Keys:* {stats['active_keys']}
 ⏳ *Pending Orders:* {stats['pending_orders']}
 """
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=admin_menu_keyboard()
-        )
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_admin_pending(call, user_id, data):
+    """Admin pending orders"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    elif data == "admin_pending":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        orders = get_all_orders('pending')
-        if not orders:
-            text = "✅ No pending orders"
+    orders = get_all_orders('pending', limit=10)  # Show last 10
+    if not orders:
+        text = "✅ No pending orders"
+    else:
+        lines = [f"Order #{order[0]} - {order[4]:,} Ks" for order in orders]
+        text = f"⏳ *Pending Orders ({count_orders('pending')})*\n\n" + "\n".join(lines)
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_admin_users(call, user_id, data):
+    """Admin recent users"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    users = get_all_users(limit=20)  # Show last 20
+    lines = [f"• @{user[2] or 'No username'} (ID: {user[1]})" for user in users]
+    text = f"👥 *All Users ({count_users()})*\n\n" + "\n".join(lines)
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_admin_servers(call, user_id, data):
+    """Server management"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    safe_edit_message_text(
+        server_management_text(),
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=server_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+def _cb_toggle_server(call, user_id, data):
+    """Enable/disable a server"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    server_id = data.replace("toggle_server_", "")
+    
+    if server_id in disabled_servers:
+        disabled_servers.remove(server_id)
+        action = "✅ Enabled"
+    else:
+        disabled_servers.add(server_id)
+        action = "🔴 Disabled"
+    try:
+        set_server_disabled(server_id, server_id in disabled_servers)
+    except Exception as e:
+        logger.error(f"Error saving server status for {server_id}: {e}")
+    server = SERVERS.get(server_id)
+    if server and 'is_active' in server:
+        # Database servers carry is_active too - keep it in step so get_active_servers() agrees
+        server['is_active'] = server_id not in disabled_servers
+    invalidate_server_keyboards()
+    refresh_server_page_row(server_id)
+    # Re-enabling is usually after panel maintenance - re-read its inbounds on next use
+    invalidate_protocol_cache(server_id)
+    
+    server_name = _SERVER_NAMES.get(server_id, server_id)
+    answer_callback(call, f"{action}: {server_name}", show_alert=True)
+    
+    # Refresh server management page
+    safe_edit_message_text(
+        server_management_text(),
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=server_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+# ==================== ADD SERVER ====================
+
+def _cb_add_server_start(call, user_id, data):
+    """Add server - choose type"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    text = "➕ *Add New Server*\n\n"
+    text += "Panel Type ရွေးချယ်ပါ:"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADD_SERVER_TYPE_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_add_server_xui(call, user_id, data):
+    """Add server - XUI server input"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    set_session(user_id, {'action': 'add_server', 'panel_type': 'xui', 'step': 1})
+    
+    text = "🖥️ *Add 3X-UI Server*\n\n"
+    text += "အောက်ပါ Format အတိုင်း Server Info ထည့်ပါ:\n\n"
+    text += "```\n"
+    text += "Server ID: sg4\n"
+    text += "Name: 🇸🇬 Singapore 4\n"
+    text += "URL: https://sg4.example.com:8080\n"
+    text += "Panel Path: /mka\n"
+    text += "Domain: sg4.example.com\n"
+    text += "Sub Port: 2096\n"
+    text += "```\n\n"
+    text += "💡 Format:\n`server_id,name,url,panel_path,domain,sub_port`\n\n"
+    text += "Example:\n`sg4,🇸🇬 Singapore 4,https://sg4.example.com:8080,/mka,sg4.example.com,2096`"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_SERVERS_CANCEL_MARKUP,
+        parse_mode='Markdown'
+    )
+
+# ==================== DELETE SERVER ====================
+
+def _cb_delete_server_start(call, user_id, data):
+    """Delete server - choose server"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    text = "🗑️ *Delete Server*\n\n"
+    text += "⚠️ Config.py မှ Server များကို ဖျက်၍မရပါ။\n"
+    text += "Database မှ ထည့်ထားသော Server များသာ ဖျက်နိုင်ပါသည်။\n\n"
+    text += "ဖျက်မည့် Server ကို ရွေးပါ:"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=delete_server_keyboard(),
+        parse_mode='Markdown'
+    )
+
+def _cb_confirm_delete_server(call, user_id, data):
+    """Delete server - confirmation"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    server_id = data.replace("confirm_delete_server_", "")
+    server = get_server(server_id)
+    
+    if not server:
+        answer_callback(call, "❌ Server not found!", show_alert=True)
+        return
+    
+    text = f"⚠️ *Confirm Delete*\n\n"
+    text += f"Server: {server['name']}\n"
+    text += f"ID: `{server_id}`\n"
+    text += f"Type: {server['panel_type'].upper()}\n\n"
+    text += "ဒီ Server ကို ဖျက်မှာ သေချာပါသလား?"
+    
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("✅ Yes, Delete", callback_data=f"do_delete_server_{server_id}"),
+        types.InlineKeyboardButton("❌ Cancel", callback_data="delete_server_start")
+    )
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=markup,
+        parse_mode='Markdown'
+    )
+
+def _cb_do_delete_server(call, user_id, data):
+    """Delete server - perform delete"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    server_id = data.replace("do_delete_server_", "")
+    
+    if delete_server(server_id):
+        # Reload servers
+        load_servers()
+        answer_callback(call, f"✅ Server {server_id} deleted!", show_alert=True)
+    else:
+        answer_callback(call, "❌ Delete failed!", show_alert=True)
+    
+    # Go back to server management
+    safe_edit_message_text(
+        server_management_text(),
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=server_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+def _cb_admin_back(call, user_id, data):
+    """Back to admin panel"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    safe_edit_message_text(
+        "🔐 *Admin Panel*",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_admin_backup(call, user_id, data):
+    """Manual Backup"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    answer_callback(call, "⏳ Creating backup...", show_alert=False)
+    
+    # Run backup in separate thread to not block
+    def do_backup():
+        if manual_backup():
+            bot.send_message(
+                ADMIN_CHAT_ID,
+                "✅ Backup created and sent to Payment Channel!"
+            )
         else:
-            text = f"⏳ *Pending Orders ({len(orders)})*\n\n"
-            for order in orders[:10]:  # Show last 10
-                text += f"Order #{order[0]} - {order[4]:,} Ks\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=admin_menu_keyboard()
-        )
+            bot.send_message(
+                ADMIN_CHAT_ID,
+                "❌ Backup failed! Check logs."
+            )
     
-    elif data == "admin_users":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        users = get_all_users()
-        text = f"👥 *All Users ({len(users)})*\n\n"
-        for user in users[:20]:  # Show last 20
-            username = user[2] if user[2] else "No username"
-            text += f"• @{username} (ID: {user[1]})\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=admin_menu_keyboard()
-        )
+    threading.Thread(target=do_backup, daemon=True).start()
+
+def _cb_admin_features(call, user_id, data):
+    """Feature Management"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    # Server management
-    elif data == "admin_servers":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        db_server_count = len(get_all_db_servers(active_only=False))
-        text = "🖥️ *Server Management*\n\n"
-        text += "Server ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n"
-        text += f"📦 = Database မှ ထည့်ထားသော Server\n\n"
-        text += f"📊 Total: {len(SERVERS)} servers ({db_server_count} custom)\n\n"
-        
-        for server_id, server in SERVERS.items():
-            status = "🔴" if server_id in disabled_servers else "🟢"
-            db_tag = " 📦" if server.get('from_database') else ""
-            panel_type = server.get('panel_type', 'xui').upper()
-            text += f"{status} {server['name']} [{panel_type}]{db_tag}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=server_management_keyboard()
-        )
+    text = "⚙️ *Feature Management*\n\n"
+    text += "Feature ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n\n"
     
-    elif data.startswith("toggle_server_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        server_id = data.replace("toggle_server_", "")
-        
-        if server_id in disabled_servers:
-            disabled_servers.remove(server_id)
-            action = "✅ Enabled"
+    feature_names = {
+        'referral_system': '👥 Referral System',
+        'free_test_key': '🎁 Free Test Key',
+        'protocol_change': '🔄 Protocol Change',
+        'auto_approve': '🤖 Auto-Approve (OCR)',
+    }
+    
+    for feature_id, feature_name in feature_names.items():
+        status = "🟢 ON" if feature_flags.get(feature_id, True) else "🔴 OFF"
+        text += f"• {feature_name} - {status}\n"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=feature_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+def _cb_toggle_feature(call, user_id, data):
+    """Enable/disable a feature flag"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    feature_id = data.replace("toggle_feature_", "")
+    
+    # Toggle feature
+    if feature_id in feature_flags:
+        new_value = not feature_flags[feature_id]
+        feature_flags[feature_id] = new_value
+        # Save to database
+        set_feature_flag(feature_id, new_value, updated_by=user_id)
+        action = "✅ Enabled" if new_value else "🔴 Disabled"
+    else:
+        answer_callback(call, "❌ Unknown feature", show_alert=True)
+        return
+    
+    feature_names = {
+        'referral_system': 'Referral System',
+        'free_test_key': 'Free Test Key',
+        'protocol_change': 'Protocol Change',
+        'auto_approve': 'Auto-Approve',
+    }
+    
+    feature_name = feature_names.get(feature_id, feature_id)
+    answer_callback(call, f"{action}: {feature_name}", show_alert=True)
+    
+    # Refresh feature management page
+    text = "⚙️ *Feature Management*\n\n"
+    text += "Feature ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n\n"
+    
+    for fid, fname in feature_names.items():
+        status = "🟢 ON" if feature_flags.get(fid, True) else "🔴 OFF"
+        text += f"• {fname} - {status}\n"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=feature_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+# ==================== PROTOCOL MANAGEMENT ====================
+
+def _cb_admin_protocols(call, user_id, data):
+    """Protocol management"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    text = "🔒 *Protocol Management*\n\n"
+    text += "Protocol တွေကို Enable/Disable လုပ်နိုင်ပါတယ်။\n"
+    text += "Disable လုပ်ထားတဲ့ Protocol တွေကို User တွေ ရွေးလို့ရမည်မဟုတ်ပါ။\n\n"
+    
+    protocol_names = {
+        'trojan': '🔐 Trojan',
+        'vless': '⚡ VLESS',
+        'vmess': '🌐 VMess',
+        'shadowsocks': '🔒 Shadowsocks',
+        'wireguard': '🛡️ WireGuard'
+    }
+    
+    protocol_settings = get_all_protocol_settings()
+    
+    for proto_id, proto_name in protocol_names.items():
+        if proto_id in protocol_settings:
+            is_enabled = protocol_settings[proto_id]['is_enabled']
         else:
-            disabled_servers.add(server_id)
-            action = "🔴 Disabled"
-        
-        server_name = SERVERS.get(server_id, {}).get('name', server_id)
-        bot.answer_callback_query(call.id, f"{action}: {server_name}", show_alert=True)
-        
-        # Refresh server management page
-        db_server_count = len(get_all_db_servers(active_only=False))
-        text = "🖥️ *Server Management*\n\n"
-        text += "Server ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n"
-        text += f"📦 = Database မှ ထည့်ထားသော Server\n\n"
-        text += f"📊 Total: {len(SERVERS)} servers ({db_server_count} custom)\n\n"
-        
-        for sid, server in SERVERS.items():
-            status = "🔴" if sid in disabled_servers else "🟢"
-            db_tag = " 📦" if server.get('from_database') else ""
-            panel_type = server.get('panel_type', 'xui').upper()
-            text += f"{status} {server['name']} [{panel_type}]{db_tag}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=server_management_keyboard()
-        )
+            is_enabled = True
+        status = "🟢 ON" if is_enabled else "🔴 OFF"
+        text += f"• {proto_name} - {status}\n"
     
-    # ==================== ADD SERVER ====================
-    elif data == "add_server_start":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        text = "➕ *Add New Server*\n\n"
-        text += "Panel Type ရွေးချယ်ပါ:"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=add_server_type_keyboard()
-        )
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=protocol_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+def _cb_toggle_protocol(call, user_id, data):
+    """Enable/disable a protocol"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    elif data == "add_server_xui":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        set_session(user_id, {'action': 'add_server', 'panel_type': 'xui', 'step': 1})
-        
-        text = "🖥️ *Add 3X-UI Server*\n\n"
-        text += "အောက်ပါ Format အတိုင်း Server Info ထည့်ပါ:\n\n"
-        text += "```\n"
-        text += "Server ID: sg4\n"
-        text += "Name: 🇸🇬 Singapore 4\n"
-        text += "URL: https://sg4.example.com:8080\n"
-        text += "Panel Path: /mka\n"
-        text += "Domain: sg4.example.com\n"
-        text += "Sub Port: 2096\n"
-        text += "```\n\n"
-        text += "💡 Format:\n`server_id,name,url,panel_path,domain,sub_port`\n\n"
-        text += "Example:\n`sg4,🇸🇬 Singapore 4,https://sg4.example.com:8080,/mka,sg4.example.com,2096`"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("❌ Cancel", callback_data="admin_servers"))
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    protocol_id = data.replace("toggle_protocol_", "")
     
-    # ==================== DELETE SERVER ====================
-    elif data == "delete_server_start":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        text = "🗑️ *Delete Server*\n\n"
-        text += "⚠️ Config.py မှ Server များကို ဖျက်၍မရပါ။\n"
-        text += "Database မှ ထည့်ထားသော Server များသာ ဖျက်နိုင်ပါသည်။\n\n"
-        text += "ဖျက်မည့် Server ကို ရွေးပါ:"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=delete_server_keyboard()
-        )
+    protocol_names = {
+        'trojan': 'Trojan',
+        'vless': 'VLESS',
+        'vmess': 'VMess',
+        'shadowsocks': 'Shadowsocks',
+        'wireguard': 'WireGuard'
+    }
     
-    elif data.startswith("confirm_delete_server_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        server_id = data.replace("confirm_delete_server_", "")
-        server = get_server(server_id)
-        
-        if not server:
-            bot.answer_callback_query(call.id, "❌ Server not found!", show_alert=True)
-            return
-        
-        text = f"⚠️ *Confirm Delete*\n\n"
-        text += f"Server: {server['name']}\n"
-        text += f"ID: `{server_id}`\n"
-        text += f"Type: {server['panel_type'].upper()}\n\n"
-        text += "ဒီ Server ကို ဖျက်မှာ သေချာပါသလား?"
-        
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("✅ Yes, Delete", callback_data=f"do_delete_server_{server_id}"),
-            types.InlineKeyboardButton("❌ Cancel", callback_data="delete_server_start")
-        )
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    if protocol_id not in protocol_names:
+        answer_callback(call, "❌ Unknown protocol", show_alert=True)
+        return
     
-    elif data.startswith("do_delete_server_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        server_id = data.replace("do_delete_server_", "")
-        
-        if delete_server(server_id):
-            # Reload servers
-            load_servers()
-            bot.answer_callback_query(call.id, f"✅ Server {server_id} deleted!", show_alert=True)
+    # Get current status
+    protocol_settings = get_all_protocol_settings()
+    current_status = protocol_settings.get(protocol_id, {}).get('is_enabled', True)
+    new_status = not current_status
+    
+    # Don't allow disabling all protocols - at least one must be enabled
+    enabled_count = sum(1 for p in protocol_settings.values() if p.get('is_enabled', True))
+    if not new_status and enabled_count <= 1:
+        answer_callback(call, "⚠️ အနည်းဆုံး Protocol တစ်ခု Enable ထားရမည်!", show_alert=True)
+        return
+    
+    # Toggle protocol
+    set_protocol_enabled(protocol_id, new_status, updated_by=user_id)
+    action = "✅ Enabled" if new_status else "🔴 Disabled"
+    
+    protocol_name = protocol_names.get(protocol_id, protocol_id)
+    answer_callback(call, f"{action}: {protocol_name}", show_alert=True)
+    
+    # Refresh protocol management page
+    text = "🔒 *Protocol Management*\n\n"
+    text += "Protocol တွေကို Enable/Disable လုပ်နိုင်ပါတယ်။\n"
+    text += "Disable လုပ်ထားတဲ့ Protocol တွေကို User တွေ ရွေးလို့ရမည်မဟုတ်ပါ။\n\n"
+    
+    protocol_display = {
+        'trojan': '🔐 Trojan',
+        'vless': '⚡ VLESS',
+        'vmess': '🌐 VMess',
+        'shadowsocks': '🔒 Shadowsocks',
+        'wireguard': '🛡️ WireGuard'
+    }
+    
+    # Refresh protocol settings
+    protocol_settings = get_all_protocol_settings()
+    
+    for proto_id, proto_name in protocol_display.items():
+        if proto_id in protocol_settings:
+            is_enabled = protocol_settings[proto_id]['is_enabled']
         else:
-            bot.answer_callback_query(call.id, "❌ Delete failed!", show_alert=True)
-        
-        # Go back to server management
-        db_server_count = len(get_all_db_servers(active_only=False))
-        text = "🖥️ *Server Management*\n\n"
-        text += f"📊 Total: {len(SERVERS)} servers ({db_server_count} custom)\n\n"
-        
-        for sid, server in SERVERS.items():
-            status = "🔴" if sid in disabled_servers else "🟢"
-            db_tag = " 📦" if server.get('from_database') else ""
-            text += f"{status} {server['name']}{db_tag}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=server_management_keyboard()
-        )
+            is_enabled = True
+        status = "🟢 ON" if is_enabled else "🔴 OFF"
+        text += f"• {proto_name} - {status}\n"
     
-    elif data == "admin_back":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        bot.edit_message_text(
-            "🔐 *Admin Panel*",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=admin_menu_keyboard()
-        )
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=protocol_management_keyboard(),
+        parse_mode='Markdown'
+    )
+
+# ==================== STATISTICS ====================
+
+def _cb_admin_stats(call, user_id, data):
+    """Statistics - choose period"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    # Manual Backup
-    elif data == "admin_backup":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        bot.answer_callback_query(call.id, "⏳ Creating backup...", show_alert=False)
-        
-        # Run backup in separate thread to not block
-        def do_backup():
-            if manual_backup():
-                bot.send_message(
-                    ADMIN_CHAT_ID,
-                    "✅ Backup created and sent to Payment Channel!"
-                )
-            else:
-                bot.send_message(
-                    ADMIN_CHAT_ID,
-                    "❌ Backup failed! Check logs."
-                )
-        
-        threading.Thread(target=do_backup, daemon=True).start()
+    safe_edit_message_text(
+        "📈 *Statistics Dashboard*\n\n"
+        "အချိန်ကာလ ရွေးချယ်ပါ:",
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=STATS_PERIOD_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_stats(call, user_id, data):
+    """Statistics for selected period"""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    # Feature Management
-    elif data == "admin_features":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        text = "⚙️ *Feature Management*\n\n"
-        text += "Feature ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n\n"
-        
-        feature_names = {
-            'referral_system': '👥 Referral System',
-            'free_test_key': '🎁 Free Test Key',
-            'protocol_change': '🔄 Protocol Change',
-            'auto_approve': '🤖 Auto-Approve (OCR)',
-        }
-        
-        for feature_id, feature_name in feature_names.items():
-            status = "🟢 ON" if feature_flags.get(feature_id, True) else "🔴 OFF"
-            text += f"• {feature_name} - {status}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=feature_management_keyboard()
-        )
+    period = data.replace("stats_", "")
     
-    elif data.startswith("toggle_feature_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
+    if period == "top_users":
+        top_users = get_top_users(10)
+        text = "🏆 *Top 10 Users (By Spending)*\n\n"
         
-        feature_id = data.replace("toggle_feature_", "")
-        
-        # Toggle feature
-        if feature_id in feature_flags:
-            new_value = not feature_flags[feature_id]
-            feature_flags[feature_id] = new_value
-            # Save to database
-            set_feature_flag(feature_id, new_value, updated_by=user_id)
-            action = "✅ Enabled" if new_value else "🔴 Disabled"
+        if not top_users:
+            text += "User မရှိသေးပါ။"
         else:
-            bot.answer_callback_query(call.id, "❌ Unknown feature", show_alert=True)
-            return
-        
-        feature_names = {
-            'referral_system': 'Referral System',
-            'free_test_key': 'Free Test Key',
-            'protocol_change': 'Protocol Change',
-            'auto_approve': 'Auto-Approve',
-        }
+            for i, user in enumerate(top_users, 1):
+                name = user['username'] or user['first_name'] or f"User {user['telegram_id']}"
+                text += f"{i}. {name}\n"
+                text += f"   💰 {user['total_spent']:,} Ks | 🛒 {user['order_count']} orders\n\n"
         
-        feature_name = feature_names.get(feature_id, feature_id)
-        bot.answer_callback_query(call.id, f"{action}: {feature_name}", show_alert=True)
-        
-        # Refresh feature management page
-        text = "⚙️ *Feature Management*\n\n"
-        text += "Feature ကို နှိပ်ပြီး Enable/Disable လုပ်နိုင်ပါတယ်။\n\n"
-        
-        for fid, fname in feature_names.items():
-            status = "🟢 ON" if feature_flags.get(fid, True) else "🔴 OFF"
-            text += f"• {fname} - {status}\n"
-        
-        bot.edit_message_text(
+        safe_edit_message_text(
             text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=feature_management_keyboard()
+            chat_id,
+            message_id,
+            reply_markup=ADMIN_STATS_BACK_MARKUP,
+            parse_mode='Markdown'
         )
+        return
     
-    # ==================== PROTOCOL MANAGEMENT ====================
-    elif data == "admin_protocols":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        text = "🔒 *Protocol Management*\n\n"
-        text += "Protocol တွေကို Enable/Disable လုပ်နိုင်ပါတယ်။\n"
-        text += "Disable လုပ်ထားတဲ့ Protocol တွေကို User တွေ ရွေးလို့ရမည်မဟုတ်ပါ။\n\n"
-        
-        protocol_names = {
-            'trojan': '🔐 Trojan',
-            'vless': '⚡ VLESS',
-            'vmess': '🌐 VMess',
-            'shadowsocks': '🔒 Shadowsocks',
-            'wireguard': '🛡️ WireGuard'
-        }
-        
-        protocol_settings = get_all_protocol_settings()
+    elif period == "revenue":
+        revenue_data = get_revenue_by_period()
+        text = "💰 *Revenue (Last 7 Days)*\n\n"
         
-        for proto_id, proto_name in protocol_names.items():
-            if proto_id in protocol_settings:
-                is_enabled = protocol_settings[proto_id]['is_enabled']
-            else:
-                is_enabled = True
-            status = "🟢 ON" if is_enabled else "🔴 OFF"
-            text += f"• {proto_name} - {status}\n"
+        if not revenue_data:
+            text += "Data မရှိသေးပါ။"
+        else:
+            total = 0
+            for day in revenue_data:
+                text += f"📅 {day['date']}: {day['revenue']:,} Ks ({day['orders']} orders)\n"
+                total += day['revenue']
+            text += f"\n📊 Total: {total:,} Ks"
         
-        bot.edit_message_text(
+        safe_edit_message_text(
             text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=protocol_management_keyboard()
+            chat_id,
+            message_id,
+            reply_markup=ADMIN_STATS_BACK_MARKUP,
+            parse_mode='Markdown'
         )
+        return
     
-    elif data.startswith("toggle_protocol_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        protocol_id = data.replace("toggle_protocol_", "")
-        
-        protocol_names = {
-            'trojan': 'Trojan',
-            'vless': 'VLESS',
-            'vmess': 'VMess',
-            'shadowsocks': 'Shadowsocks',
-            'wireguard': 'WireGuard'
-        }
-        
-        if protocol_id not in protocol_names:
-            bot.answer_callback_query(call.id, "❌ Unknown protocol", show_alert=True)
-            return
-        
-        # Get current status
-        protocol_settings = get_all_protocol_settings()
-        current_status = protocol_settings.get(protocol_id, {}).get('is_enabled', True)
-        new_status = not current_status
-        
-        # Don't allow disabling all protocols - at least one must be enabled
-        enabled_count = sum(1 for p in protocol_settings.values() if p.get('is_enabled', True))
-        if not new_status and enabled_count <= 1:
-            bot.answer_callback_query(call.id, "⚠️ အနည်းဆုံး Protocol တစ်ခု Enable ထားရမည်!", show_alert=True)
-            return
-        
-        # Toggle protocol
-        set_protocol_enabled(protocol_id, new_status, updated_by=user_id)
-        action = "✅ Enabled" if new_status else "🔴 Disabled"
-        
-        protocol_name = protocol_names.get(protocol_id, protocol_id)
-        bot.answer_callback_query(call.id, f"{action}: {protocol_name}", show_alert=True)
-        
-        # Refresh protocol management page
-        text = "🔒 *Protocol Management*\n\n"
-        text += "Protocol တွေကို Enable/Disable လုပ်နိုင်ပါတယ်။\n"
-        text += "Disable လုပ်ထားတဲ့ Protocol တွေကို User တွေ ရွေးလို့ရမည်မဟုတ်ပါ။\n\n"
-        
-        protocol_display = {
-            'trojan': '🔐 Trojan',
-            'vless': '⚡ VLESS',
-            'vmess': '🌐 VMess',
-            'shadowsocks': '🔒 Shadowsocks',
-            'wireguard': '🛡️ WireGuard'
-        }
-        
-        # Refresh protocol settings
-        protocol_settings = get_all_protocol_settings()
-        
-        for proto_id, proto_name in protocol_display.items():
-            if proto_id in protocol_settings:
-                is_enabled = protocol_settings[proto_id]['is_enabled']
-            else:
-                is_enabled = True
-            status = "🟢 ON" if is_enabled else "🔴 OFF"
-            text += f"• {proto_name} - {status}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=protocol_management_keyboard()
-        )
+    # Period-based stats
+    period_names = {
+        'today': 'Today',
+        'week': 'This Week',
+        'month': 'This Month',
+        'all': 'All Time'
+    }
     
-    # ==================== STATISTICS ====================
-    elif data == "admin_stats":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        bot.edit_message_text(
-            "📈 *Statistics Dashboard*\n\n"
-            "အချိန်ကာလ ရွေးချယ်ပါ:",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=stats_period_keyboard()
-        )
+    stats = get_statistics(period)
+    period_name = period_names.get(period, 'All Time')
+    
+    text = f"📊 *Statistics - {period_name}*\n\n"
+    text += f"👥 Users: {stats['total_users']:,}\n"
+    text += f"🛒 Total Orders: {stats['total_orders']:,}\n"
+    text += f"✅ Completed: {stats['completed_orders']:,}\n"
+    text += f"⏳ Pending: {stats['pending_orders']:,}\n"
+    text += f"❌ Rejected: {stats['rejected_orders']:,}\n"
+    text += f"💰 Revenue: {stats['total_revenue']:,} Ks\n\n"
+    text += f"🔑 Active Keys: {stats['active_keys']:,}\n"
+    text += f"🎁 Free Tests: {stats['free_tests_used']:,}\n"
+    text += f"👥 Referrals: {stats['total_referrals']:,}\n"
+    text += f"🚫 Banned Users: {stats['banned_users']:,}\n"
+    
+    safe_edit_message_text(
+        text,
+        chat_id,
+        message_id,
+        reply_markup=STATS_PERIOD_MARKUP,
+        parse_mode='Markdown'
+    )
+
+# ==================== BAN MANAGEMENT ====================
+
+def _cb_admin_bans(call, user_id, data):
+    """Ban management"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    elif data.startswith("stats_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        period = data.replace("stats_", "")
-        
-        if period == "top_users":
-            top_users = get_top_users(10)
-            text = "🏆 *Top 10 Users (By Spending)*\n\n"
-            
-            if not top_users:
-                text += "User မရှိသေးပါ။"
-            else:
-                for i, user in enumerate(top_users, 1):
-                    name = user['username'] or user['first_name'] or f"User {user['telegram_id']}"
-                    text += f"{i}. {name}\n"
-                    text += f"   💰 {user['total_spent']:,} Ks | 🛒 {user['order_count']} orders\n\n"
-            
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_stats"))
-            
-            bot.edit_message_text(
-                text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup
-            )
-            return
-        
-        elif period == "revenue":
-            revenue_data = get_revenue_by_period()
-            text = "💰 *Revenue (Last 7 Days)*\n\n"
-            
-            if not revenue_data:
-                text += "Data မရှိသေးပါ။"
-            else:
-                total = 0
-                for day in revenue_data:
-                    text += f"📅 {day['date']}: {day['revenue']:,} Ks ({day['orders']} orders)\n"
-                    total += day['revenue']
-                text += f"\n📊 Total: {total:,} Ks"
-            
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_stats"))
-            
-            bot.edit_message_text(
-                text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup
-            )
-            return
-        
-        # Period-based stats
-        period_names = {
-            'today': 'Today',
-            'week': 'This Week',
-            'month': 'This Month',
-            'all': 'All Time'
-        }
-        
-        stats = get_statistics(period)
-        period_name = period_names.get(period, 'All Time')
-        
-        text = f"📊 *Statistics - {period_name}*\n\n"
-        text += f"👥 Users: {stats['total_users']:,}\n"
-        text += f"🛒 Total Orders: {stats['total_orders']:,}\n"
-        text += f"✅ Completed: {stats['completed_orders']:,}\n"
-        text += f"⏳ Pending: {stats['pending_orders']:,}\n"
-        text += f"❌ Rejected: {stats['rejected_orders']:,}\n"
-        text += f"💰 Revenue: {stats['total_revenue']:,} Ks\n\n"
-        text += f"🔑 Active Keys: {stats['active_keys']:,}\n"
-        text += f"🎁 Free Tests: {stats['free_tests_used']:,}\n"
-        text += f"👥 Referrals: {stats['total_referrals']:,}\n"
-        text += f"🚫 Banned Users: {stats['banned_users']:,}\n"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=stats_period_keyboard()
-        )
+    banned = get_banned_users()
+    text = "🚫 *Ban Management*\n\n"
+    text += f"Currently banned: {len(banned)} users\n\n"
+    text += "အောက်ပါ options ကို ရွေးချယ်ပါ:"
     
-    # ==================== BAN MANAGEMENT ====================
-    elif data == "admin_bans":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        banned = get_banned_users()
-        text = "🚫 *Ban Management*\n\n"
-        text += f"Currently banned: {len(banned)} users\n\n"
-        text += "အောက်ပါ options ကို ရွေးချယ်ပါ:"
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=ban_management_keyboard()
-        )
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=BAN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_ban_user_start(call, user_id, data):
+    """Ban user - ask for user ID"""
+    if user_id != ADMIN_CHAT_ID:
+        return
     
-    elif data == "ban_user_start":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        set_session(user_id, {'action': 'ban_user'})
-        
-        text = "🚫 *Ban User*\n\n"
-        text += "Ban လုပ်မည့် User ၏ Telegram ID ထည့်ပါ:\n\n"
-        text += "Format: `USER_ID HOURS REASON`\n"
-        text += "Example: `123456789 24 Spam messages`\n\n"
-        text += "💡 HOURS = 0 သို့မဟုတ် မထည့်ပါက Permanent ban\n"
-        text += "💡 REASON မထည့်လည်း ရပါတယ်"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("❌ Cancel", callback_data="admin_bans"))
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    set_session(user_id, {'action': 'ban_user'})
+    
+    text = "🚫 *Ban User*\n\n"
+    text += "Ban လုပ်မည့် User ၏ Telegram ID ထည့်ပါ:\n\n"
+    text += "Format: `USER_ID HOURS REASON`\n"
+    text += "Example: `123456789 24 Spam messages`\n\n"
+    text += "💡 HOURS = 0 သို့မဟုတ် မထည့်ပါက Permanent ban\n"
+    text += "💡 REASON မထည့်လည်း ရပါတယ်"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_BANS_CANCEL_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_unban_user_start(call, user_id, data):
+    """Unban user - ask for user ID"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    set_session(user_id, {'action': 'unban_user'})
+    
+    text = "✅ *Unban User*\n\n"
+    text += "Unban လုပ်မည့် User ၏ Telegram ID ထည့်ပါ:"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_BANS_CANCEL_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_ban_list(call, user_id, data):
+    """Banned users list"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    banned = get_banned_users()
+    text = "📋 *Banned Users List*\n\n"
+    
+    if not banned:
+        text += "Ban ထားသော user မရှိပါ။ 🎉"
+    else:
+        for i, user in enumerate(banned[:20], 1):  # Limit to 20
+            name = user['username'] or user['first_name'] or f"User"
+            ban_type = "♾️ Permanent" if user['is_permanent'] else f"⏱️ Until {user['banned_until'][:16]}"
+            text += f"{i}. {name} (`{user['telegram_id']}`)\n"
+            text += f"   {ban_type}\n"
+            if user['reason']:
+                text += f"   📝 {user['reason'][:30]}\n"
+            text += "\n"
+        
+        if len(banned) > 20:
+            text += f"\n... and {len(banned) - 20} more"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_BANS_BACK_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _cb_unban(call, user_id, data):
+    """Unban user from ban list"""
+    if user_id != ADMIN_CHAT_ID:
+        return
+    
+    target_id = int(data.replace("unban_", ""))
+    if unban_user(target_id, unbanned_by=user_id):
+        answer_callback(call, f"✅ User {target_id} unbanned!", show_alert=True)
+    else:
+        answer_callback(call, "❌ Unban failed!", show_alert=True)
+    
+    # Refresh ban list
+    banned = get_banned_users()
+    text = "📋 *Banned Users List*\n\n"
+    
+    if not banned:
+        text += "Ban ထားသော user မရှိပါ။ 🎉"
+    else:
+        for i, user in enumerate(banned[:20], 1):
+            name = user['username'] or user['first_name'] or f"User"
+            ban_type = "♾️ Permanent" if user['is_permanent'] else f"⏱️ Until {user['banned_until'][:16]}"
+            text += f"{i}. {name} (`{user['telegram_id']}`)\n"
+            text += f"   {ban_type}\n"
+            text += "\n"
+    
+    safe_edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=ADMIN_BANS_BACK_MARKUP,
+        parse_mode='Markdown'
+    )
+
+# Exact callback_data -> handler
+_CALLBACK_HANDLERS = {
+    "main_menu": _cb_main_menu,
+    "free_test": _cb_free_test,
+    "free_test_verify": _cb_free_test_verify,
+    "buy_key": _cb_buy_key,
+    "my_keys": _cb_my_keys,
+    "check_usage": _cb_check_usage,
+    "exchange_key": _cb_exchange_key,
+    "help": _cb_help,
+    "contact": _cb_contact,
+    "referral": _cb_referral,
+    "my_referral_link": _cb_my_referral_link,
+    "referral_stats": _cb_referral_stats,
+    "claim_free_month": _cb_claim_free_month,
+    "admin_sales": _cb_admin_sales,
+    "admin_pending": _cb_admin_pending,
+    "admin_users": _cb_admin_users,
+    "admin_servers": _cb_admin_servers,
+    "add_server_start": _cb_add_server_start,
+    "add_server_xui": _cb_add_server_xui,
+    "delete_server_start": _cb_delete_server_start,
+    "admin_back": _cb_admin_back,
+    "admin_backup": _cb_admin_backup,
+    "admin_features": _cb_admin_features,
+    "admin_protocols": _cb_admin_protocols,
+    "admin_stats": _cb_admin_stats,
+    "admin_bans": _cb_admin_bans,
+    "ban_user_start": _cb_ban_user_start,
+    "unban_user_start": _cb_unban_user_start,
+    "ban_list": _cb_ban_list,
+}
+
+# callback_data prefix -> handler
+_CALLBACK_PREFIX_HANDLERS = {
+    "free_server_": _cb_free_server,
+    "free_proto_": _cb_free_proto,
+    "server_": _cb_server,
+    "proto_": _cb_proto,
+    "device_": _cb_device,
+    "plan_": _cb_plan,
+    "send_screenshot_": _cb_send_screenshot,
+    "exkey_": _cb_exkey,
+    "expro_": _cb_expro,
+    "approve_freekey_": _cb_approve_freekey,
+    "approve_": _cb_approve,
+    "reject_freekey_": _cb_reject_freekey,
+    "reject_": _cb_reject,
+    "toggle_server_": _cb_toggle_server,
+    "toggle_feature_": _cb_toggle_feature,
+    "toggle_protocol_": _cb_toggle_protocol,
+    "confirm_delete_server_": _cb_confirm_delete_server,
+    "do_delete_server_": _cb_do_delete_server,
+    "stats_": _cb_stats,
+    "unban_": _cb_unban,
+}
+
+# One anchored alternation over all prefixes; longer prefixes are tried first
+# so e.g. approve_freekey_ wins over approve_
+_CALLBACK_PREFIX_RE = re.compile(
+    "|".join(re.escape(prefix) for prefix in sorted(_CALLBACK_PREFIX_HANDLERS, key=len, reverse=True))
+)
+
+# Same button pressed again while the first press is still fresh: {(user_id, data): first press time}
+CALLBACK_DEBOUNCE = 1.5  # seconds
+_recent_callbacks = {}
+_recent_callbacks_lock = threading.Lock()
+
+def is_duplicate_press(user_id, data):
+    """True if this user pressed the same button within CALLBACK_DEBOUNCE seconds"""
+    now = _time.monotonic()
+    key = (user_id, data)
+    with _recent_callbacks_lock:
+        first = _recent_callbacks.get(key)
+        if first is not None and now - first < CALLBACK_DEBOUNCE:
+            return True
+        _recent_callbacks[key] = now
+        return False
+
+def cleanup_recent_callbacks():
+    """Drop debounce entries that can no longer match"""
+    cutoff = _time.monotonic() - CALLBACK_DEBOUNCE
+    with _recent_callbacks_lock:
+        for key in [k for k, t in _recent_callbacks.items() if t < cutoff]:
+            del _recent_callbacks[key]
+
+# Quick admin actions that answer with their own confirmation alert - the dispatcher
+# leaves the callback unanswered for them (a query can only be answered once)
+_SELF_ANSWERING_HANDLERS = frozenset({
+    _cb_toggle_server,
+    _cb_do_delete_server,
+    _cb_admin_backup,
+    _cb_toggle_feature,
+    _cb_toggle_protocol,
+    _cb_unban,
+})
+
+def get_callback_handler(data):
+    """Resolve the handler for callback data (exact match first, then prefix)"""
+    handler = _CALLBACK_HANDLERS.get(data)
+    if handler:
+        return handler
+    match = _CALLBACK_PREFIX_RE.match(data)
+    return _CALLBACK_PREFIX_HANDLERS[match.group()] if match else None
+
+def _callback_gate(call):
+    """Checks that run before a callback is queued behind the user's running handler"""
+    user_id = call.from_user.id
+    data = call.data
+    
+    # Security: Ban, rate limit and injection check on the callback data
+    allowed, error_msg = security_check(user_id, data, 'callback')
+    if not allowed:
+        answer_callback(call, error_msg, show_alert=True)
+        return False
     
-    elif data == "unban_user_start":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        set_session(user_id, {'action': 'unban_user'})
-        
-        text = "✅ *Unban User*\n\n"
-        text += "Unban လုပ်မည့် User ၏ Telegram ID ထည့်ပါ:"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("❌ Cancel", callback_data="admin_bans"))
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    if not is_valid_callback(data):
+        SecurityLogger.log_suspicious_activity(user_id, "INVALID_CALLBACK", data[:100])
+        abuse_detector.record_suspicious_activity(user_id, "INVALID_CALLBACK_DATA", 2)
+        answer_callback(call, "❌ Invalid action.", show_alert=True)
+        return False
     
-    elif data == "ban_list":
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        banned = get_banned_users()
-        text = "📋 *Banned Users List*\n\n"
-        
-        if not banned:
-            text += "Ban ထားသော user မရှိပါ။ 🎉"
-        else:
-            for i, user in enumerate(banned[:20], 1):  # Limit to 20
-                name = user['username'] or user['first_name'] or f"User"
-                ban_type = "♾️ Permanent" if user['is_permanent'] else f"⏱️ Until {user['banned_until'][:16]}"
-                text += f"{i}. {name} (`{user['telegram_id']}`)\n"
-                text += f"   {ban_type}\n"
-                if user['reason']:
-                    text += f"   📝 {user['reason'][:30]}\n"
-                text += "\n"
-            
-            if len(banned) > 20:
-                text += f"\n... and {len(banned) - 20} more"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_bans"))
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    # Double taps arrive while the first press is still being handled - drop them here,
+    # before they queue behind it (by then the debounce window would have passed)
+    if is_duplicate_press(user_id, data):
+        answer_callback(call)
+        return False
     
-    elif data.startswith("unban_"):
-        if user_id != ADMIN_CHAT_ID:
-            return
-        
-        target_id = int(data.replace("unban_", ""))
-        if unban_user(target_id, unbanned_by=user_id):
-            bot.answer_callback_query(call.id, f"✅ User {target_id} unbanned!", show_alert=True)
-        else:
-            bot.answer_callback_query(call.id, "❌ Unban failed!", show_alert=True)
-        
-        # Refresh ban list
-        banned = get_banned_users()
-        text = "📋 *Banned Users List*\n\n"
-        
-        if not banned:
-            text += "Ban ထားသော user မရှိပါ။ 🎉"
-        else:
-            for i, user in enumerate(banned[:20], 1):
-                name = user['username'] or user['first_name'] or f"User"
-                ban_type = "♾️ Permanent" if user['is_permanent'] else f"⏱️ Until {user['banned_until'][:16]}"
-                text += f"{i}. {name} (`{user['telegram_id']}`)\n"
-                text += f"   {ban_type}\n"
-                text += "\n"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="admin_bans"))
-        
-        bot.edit_message_text(
-            text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup
-        )
+    if get_callback_handler(data) not in _SELF_ANSWERING_HANDLERS:
+        # Clear the button spinner now, even if the press has to wait for a running handler
+        answer_callback(call)
+    return True
+
+@bot.callback_query_handler(func=lambda call: True)
+@per_user_serial(gate=_callback_gate)
+def button_callback(call):
+    """Handle button callbacks"""
+    user_id = call.from_user.id
+    data = call.data
+    
+    handler = get_callback_handler(data)
+    if handler:
+        try:
+            handler(call, user_id, data)
+        finally:
+            answer_callback(call)  # No-op unless a self-answering handler skipped its answer
 
 # ===================== REPLY KEYBOARD BUTTON HANDLERS =====================
 
-@bot.message_handler(func=lambda message: message.text in [
-    "📊 My Referrals", "🔗 Share Link", "🔑 My Keys", "🏠 Main Menu", "🎁 Free Key ရယူမည်"
-])
-def handle_reply_keyboard_buttons(message):
-    """Handle reply keyboard button presses"""
-    user_id = message.from_user.id
-    text = message.text
-    
-    # Security: Check if user is banned
-    if is_user_banned(user_id):
-        return
-    
-    # Remove reply keyboard and show inline keyboard based on button pressed
-    if text == "📊 My Referrals":
-        stats = get_referral_stats(user_id)
-        msg_text = f"""
+# Reply keyboard buttons -> handler(message, user_id)
+def _reply_my_referrals(message, user_id):
+    """My Referrals button"""
+    stats = get_referral_stats(user_id)
+    msg_text = f"""
 📊 *Referral Statistics*
 
 👥 စုစုပေါင်း Refer: {stats['total_referred']} ယောက်
@@ -2810,21 +3859,22 @@ def handle_reply_keyboard_buttons(message):
 
 {'🎉 **1 Month Free Key ရယူနိုင်ပါပြီ!**' if stats['can_claim_free_month'] else f'📈 Free Key ရဖို့ {3 - (stats["paid_referrals"] % 3)} ယောက် လိုပါသေးသည်'}
 """
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        if stats['can_claim_free_month']:
-            markup.add(types.InlineKeyboardButton("🎁 Free Key ရယူမည်", callback_data="claim_free_month"))
-        markup.add(
-            types.InlineKeyboardButton("🔗 Share Link", callback_data="my_referral_link"),
-            types.InlineKeyboardButton("🔙 Back", callback_data="referral")
-        )
-        bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=markup)
-        
-    elif text == "🔗 Share Link":
-        user = get_user(user_id)
-        ref_code = user[9] if user and len(user) > 9 else None  # referral_code is column index 9
-        if ref_code:
-            ref_link = f"https://t.me/BurmeseDigitalStore_bot?start=REF_{ref_code}"
-            msg_text = f"""
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    if stats['can_claim_free_month']:
+        markup.add(types.InlineKeyboardButton("🎁 Free Key ရယူမည်", callback_data="claim_free_month"))
+    markup.add(
+        types.InlineKeyboardButton("🔗 Share Link", callback_data="my_referral_link"),
+        types.InlineKeyboardButton("🔙 Back", callback_data="referral")
+    )
+    bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=markup)
+
+def _reply_share_link(message, user_id):
+    """Share Link button"""
+    user = get_user(user_id)
+    ref_code = user[9] if user and len(user) > 9 else None  # referral_code is column index 9
+    if ref_code:
+        ref_link = f"https://t.me/{BOT_USERNAME}?start=REF_{ref_code}"
+        msg_text = f"""
 🔗 *သင့် Referral Link*
 
 👇 ဒီ Link ကို မျှဝေပါ:
@@ -2839,55 +3889,49 @@ def handle_reply_keyboard_buttons(message):
 • တစ်ယောက်ဝယ်ရင် = +5 Days
 • 3 ယောက်ဝယ်ရင် = 1 Month Free Key
 """
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("📊 My Stats", callback_data="referral_stats"))
-            markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="referral"))
-            bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=markup)
-        else:
-            bot.send_message(user_id, "❌ Referral code မရှိပါ။", reply_markup=main_menu_keyboard())
-    
-    elif text == "🔑 My Keys":
-        # Trigger the my_keys callback
-        keys = get_user_keys(user_id)
-        if not keys:
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("💎 Buy VPN Key", callback_data="buy_key"))
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            bot.send_message(user_id, "🔑 သင့်မှာ Key မရှိသေးပါ။\n\n💎 Key ဝယ်ယူရန် အောက်က Button ကို နှိပ်ပါ။", reply_markup=markup)
-        else:
-            msg_text = "🔑 *သင့် VPN Keys:*\n\n"
-            markup = types.InlineKeyboardMarkup(row_width=1)
-            for i, key in enumerate(keys, 1):
-                # vpn_keys columns: id(0), telegram_id(1), order_id(2), server_id(3), 
-                # client_email(4), client_id(5), sub_link(6), config_link(7), 
-                # data_limit(8), expiry_date(9), is_active(10), created_at(11)
-                key_id = key[0]
-                server_id = key[3]
-                client_email = key[4]
-                expiry_date = key[9]
-                server_name = SERVERS.get(server_id, {}).get('name', 'Unknown')
-                expiry_str = expiry_date if isinstance(expiry_date, str) else expiry_date.strftime('%Y-%m-%d')
-                msg_text += f"*{i}. {server_name}*\nExpiry: {expiry_str}\n\n"
-                markup.add(types.InlineKeyboardButton(f"🔑 Key {i}: {server_name}", callback_data=f"view_key_{key_id}"))
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=markup)
-    
-    elif text == "🏠 Main Menu":
-        bot.send_message(
-            user_id,
-            MESSAGES['welcome'],
-            reply_markup=main_menu_keyboard()
-        )
-    
-    elif text == "🎁 Free Key ရယူမည်":
-        # Check eligibility and send request to admin channel
-        stats = get_referral_stats(user_id)
-        if stats['can_claim_free_month']:
-            user = get_user(user_id)
-            username = user[2] if user and user[2] else f"User_{user_id}"
-            username_display = username.replace("_", "\\_") if username else f"User\\_{user_id}"
-            
-            admin_text = f"""🎁 *Referral Free Key Request*
+        bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=REFERRAL_LINK_REPLY_MARKUP)
+    else:
+        bot.send_message(user_id, "❌ Referral code မရှိပါ။", reply_markup=MAIN_MENU_MARKUP)
+
+def _reply_my_keys(message, user_id):
+    """My Keys button"""
+    # Trigger the my_keys callback
+    keys = get_user_keys(user_id)
+    if not keys:
+        bot.send_message(user_id, "🔑 သင့်မှာ Key မရှိသေးပါ။\n\n💎 Key ဝယ်ယူရန် အောက်က Button ကို နှိပ်ပါ။", reply_markup=NO_KEYS_MARKUP)
+    else:
+        msg_text = "🔑 *သင့် VPN Keys:*\n\n"
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        for i, key in enumerate(keys, 1):
+            key_id = key.id
+            server_id = key.server_id
+            client_email = key.client_email
+            expiry_date = key.expiry_date
+            server_name = key.server_name or _SERVER_NAMES.get(server_id, 'Unknown')
+            expiry_str = expiry_date if isinstance(expiry_date, str) else expiry_date.strftime('%Y-%m-%d')
+            msg_text += f"*{i}. {server_name}*\nExpiry: {expiry_str}\n\n"
+            markup.add(types.InlineKeyboardButton(f"🔑 Key {i}: {server_name}", callback_data=f"view_key_{key_id}"))
+        markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
+        bot.send_message(user_id, msg_text, parse_mode='Markdown', reply_markup=markup)
+
+def _reply_main_menu(message, user_id):
+    """Main Menu button"""
+    bot.send_message(
+        user_id,
+        WELCOME_TEXT,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+def _reply_free_key(message, user_id):
+    """Referral Free Key request button"""
+    # Check eligibility and send request to admin channel
+    stats = get_referral_stats(user_id, fresh=True)
+    if stats['can_claim_free_month']:
+        username = get_username(user_id) or f"User_{user_id}"
+        username_display = username.replace("_", "\\_") if username else f"User\\_{user_id}"
+        
+        admin_text = f"""🎁 *Referral Free Key Request*
 
 👤 User: @{username_display}
 🆔 User ID: `{user_id}`
@@ -2900,36 +3944,54 @@ def handle_reply_keyboard_buttons(message):
 🎁 *Request:* 1 Month Free Key (1 Device)
 
 ✅ Approve နှိပ်ရင် Key အလိုအလျောက် ဖန်တီးပေးပါမည်။"""
-            
-            admin_markup = types.InlineKeyboardMarkup(row_width=2)
-            admin_markup.add(
-                types.InlineKeyboardButton("✅ Approve", callback_data=f"approve_freekey_{user_id}"),
-                types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_freekey_{user_id}")
-            )
-            
-            try:
-                bot.send_message(PAYMENT_CHANNEL_ID, admin_text, parse_mode='Markdown', reply_markup=admin_markup)
-            except Exception as e:
-                logger.error(f"Error sending free key request: {e}")
-            
-            bot.send_message(
-                user_id,
-                "🎉 *Request Sent!*\n\n"
-                "သင့် 1 Month Free Key request ကို Admin ထံ ပို့လိုက်ပါပြီ!\n\n"
-                "⏳ Admin Approve ပြီးတာနဲ့ Key အလိုအလျောက် ရရှိမှာပါ။",
-                parse_mode='Markdown',
-                reply_markup=main_menu_keyboard()
-            )
-        else:
-            remaining = 3 - (stats['paid_referrals'] % 3)
-            bot.send_message(
-                user_id,
-                f"❌ *ရယူ၍မရသေးပါ*\n\n"
-                f"Free Key ရဖို့ {remaining} ယောက် လိုပါသေးသည်။\n\n"
-                f"📌 သင့် Referral Link ကို မျှဝေပြီး ဆက်လက် Refer လုပ်ပါ!",
-                parse_mode='Markdown',
-                reply_markup=main_menu_keyboard()
-            )
+        
+        admin_markup = types.InlineKeyboardMarkup(row_width=2)
+        admin_markup.add(
+            types.InlineKeyboardButton("✅ Approve", callback_data=f"approve_freekey_{user_id}"),
+            types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_freekey_{user_id}")
+        )
+        
+        try:
+            bot.send_message(PAYMENT_CHANNEL_ID, admin_text, parse_mode='Markdown', reply_markup=admin_markup)
+        except Exception as e:
+            logger.error(f"Error sending free key request: {e}")
+        
+        bot.send_message(
+            user_id,
+            "🎉 *Request Sent!*\n\n"
+            "သင့် 1 Month Free Key request ကို Admin ထံ ပို့လိုက်ပါပြီ!\n\n"
+            "⏳ Admin Approve ပြီးတာနဲ့ Key အလိုအလျောက် ရရှိမှာပါ။",
+            parse_mode='Markdown',
+            reply_markup=MAIN_MENU_MARKUP
+        )
+    else:
+        remaining = 3 - (stats['paid_referrals'] % 3)
+        bot.send_message(
+            user_id,
+            f"❌ *ရယူ၍မရသေးပါ*\n\n"
+            f"Free Key ရဖို့ {remaining} ယောက် လိုပါသေးသည်။\n\n"
+            f"📌 သင့် Referral Link ကို မျှဝေပြီး ဆက်လက် Refer လုပ်ပါ!",
+            parse_mode='Markdown',
+            reply_markup=MAIN_MENU_MARKUP
+        )
+
+_REPLY_BUTTON_HANDLERS = {
+    "📊 My Referrals": _reply_my_referrals,
+    "🔗 Share Link": _reply_share_link,
+    "🔑 My Keys": _reply_my_keys,
+    "🏠 Main Menu": _reply_main_menu,
+    "🎁 Free Key ရယူမည်": _reply_free_key,
+}
+
+@bot.message_handler(func=lambda message: message.text in _REPLY_BUTTON_HANDLERS)
+# Security: banned users' button presses are dropped before queueing
+@per_user_serial(gate=lambda message: not is_user_banned(message.from_user.id))
+def handle_reply_keyboard_buttons(message):
+    """Handle reply keyboard button presses"""
+    user_id = message.from_user.id
+    
+    # Remove reply keyboard and show inline keyboard based on button pressed
+    _REPLY_BUTTON_HANDLERS[message.text](message, user_id)
 
 # ===================== ADMIN TEXT INPUT HANDLER =====================
 
@@ -3105,54 +4167,49 @@ def handle_admin_text_input(message):
         # Clear session
         clear_session(user_id)
 
+def _photo_gate(message):
+    """Security: Ban + screenshot rate limit, checked before the photo is queued"""
+    allowed, error_msg = security_check(message.from_user.id, action_type='screenshot')
+    if not allowed:
+        bot.reply_to(message, error_msg, parse_mode='Markdown')
+    return allowed
+
 @bot.message_handler(content_types=['photo'])
+@per_user_serial(gate=_photo_gate)
 def handle_photo(message):
     """Handle payment screenshots with OCR verification"""
     user_id = message.from_user.id
     
-    # Security: Check if user is banned
-    if is_user_banned(user_id):
-        return
-    
-    # Security: Rate limiting for screenshots
-    allowed, error_msg = check_rate_limit(user_id, 'screenshot')
-    if not allowed:
-        bot.reply_to(message, error_msg)
-        return
-    
     # Debug: Log photo received
-    logger.debug(f"📷 Photo received from user {user_id}")
-    session = get_session(user_id)
-    logger.debug(f"   Session exists: {bool(session)}")
-    if session:
-        logger.debug(f"   Waiting screenshot: {session.get('waiting_screenshot')}")
-        logger.debug(f"   Order ID: {session.get('order_id')}")
-    
-    if not session or not session.get('waiting_screenshot'):
-        bot.reply_to(message, "⚠️ Order အရင်လုပ်ပြီးမှ Screenshot ပို့ပါ။\n\n🛒 Buy Key -> Server ရွေး -> Plan ရွေး -> Screenshot ပို့ပါ")
-        return
-    
-    order_id = session.get('order_id')
+    logger.debug("📷 Photo received from user %s", user_id)
+    order_id = pop_awaiting_screenshot(user_id)
+    if not order_id:
+        # State lost (e.g. bot restart) - fall back to the user's recent pending order
+        order_id = get_awaiting_screenshot_order(user_id)
+    logger.debug("   Order ID: %s", order_id)
     
     if not order_id:
-        bot.reply_to(message, "❌ No active order found.")
+        bot.reply_to(message, "⚠️ Order အရင်လုပ်ပြီးမှ Screenshot ပို့ပါ။\n\n🛒 Buy Key -> Server ရွေး -> Plan ရွေး -> Screenshot ပို့ပါ")
         return
     
     # Check if order is already processed (prevent duplicate submissions)
     order = get_order(order_id)
-    if order and order[6] != 'pending':  # status column
-        update_session_field(user_id, 'waiting_screenshot', False)
+    if not order:
+        bot.reply_to(message, "❌ No active order found.")
+        return
+    if order[6] != 'pending':  # status column
         bot.reply_to(message, 
             f"✅ *Order #{order_id} အတွက် Key ရပြီးသားပါ!*\n\n"
             "🔑 My Keys ကို နှိပ်ပြီး Key ကြည့်ပါ။",
-            reply_markup=main_menu_keyboard()
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode='Markdown'
         )
         return
     
     # Get photo file ID
     photo = message.photo[-1]  # Highest resolution
     file_id = photo.file_id
-    logger.debug(f"   File ID: {file_id[:30]}...")
+    logger.debug("   File ID: %s...", file_id[:30])
     
     # Security: Validate file size (max 10MB)
     if photo.file_size and photo.file_size > 10 * 1024 * 1024:
@@ -3170,25 +4227,64 @@ def handle_photo(message):
                 "❌ *Screenshot မှားယွင်း တွေ့ပါတယ်!*\n\n"
                 "အရင်သုံးပြီးသားသော screenshot ဖြစ်ပါသည်။ နောက်ထပ်စှာ payment လုပ်ပြီး screenshot အသစ်ပို့ပါ။",
                 parse_mode='Markdown',
-                reply_markup=main_menu_keyboard()
+                reply_markup=MAIN_MENU_MARKUP
             )
             return
     except Exception as e:
         logger.error(f"Duplicate screenshot check error: {e}")
     
-    logger.debug(f"   Updating order {order_id} with screenshot...")
+    logger.debug("   Updating order %s with screenshot...", order_id)
     # Update order with screenshot
     update_order_screenshot(order_id, file_id)
     save_screenshot_unique_id(order_id, file_unique_id)
     
-    # Get order details
-    server_id = session.get('server_id')
-    plan_id = session.get('plan_id')
-    plan = PLANS.get(plan_id)
-    expected_amount = session.get('amount', 0)
+    # Notify user right away - Don't reveal OCR details to prevent fraud attempts
+    bot.send_message(
+        message.chat.id,
+        "✅ *Screenshot လက်ခံရရှိပါပြီ!*\n\n"
+        "Admin Approve ပြုလုပ်ပြီးသည်နှင့် VPN Key ကို ပေးပို့ပါမည်။\n"
+        "ကျေးဇူးပြု၍ စောင့်ဆိုင်းပေးပါ။",
+        reply_markup=SCREENSHOT_RECEIVED_MARKUP,
+        parse_mode='Markdown'
+    )
     
-    # Clear session
-    update_session_field(user_id, 'waiting_screenshot', False)
+    # OCR + admin notification happen on the screenshot worker
+    user = message.from_user
+    _screenshot_queue.put({
+        'order_id': order_id,
+        'user_id': user_id,
+        'username': user.username,
+        'first_name': user.first_name,
+        'file_id': file_id,
+        # Order details (from the order itself, not whatever the session last held)
+        'server_id': order[2],
+        'plan_id': order[3],
+        'expected_amount': order[4] or 0,
+    })
+
+
+# Payment screenshots waiting for OCR / admin notification
+_screenshot_queue = queue.Queue()
+SCREENSHOT_WORKERS = 2  # Matches ocr_payment.MAX_CONCURRENT_OCR
+
+def screenshot_worker():
+    """Process queued payment screenshots"""
+    while True:
+        job = _screenshot_queue.get()
+        try:
+            process_payment_submission(job)
+        except Exception as e:
+            logger.error(f"Screenshot processing error for order {job.get('order_id')}: {e}")
+
+def process_payment_submission(job):
+    """OCR-check a saved payment screenshot and post it to the Payment Channel"""
+    order_id = job['order_id']
+    user_id = job['user_id']
+    file_id = job['file_id']
+    server_id = job['server_id']
+    plan_id = job['plan_id']
+    plan = PLANS.get(plan_id)
+    expected_amount = job['expected_amount']
     
     # OCR Verification
     ocr_result = None
@@ -3199,41 +4295,15 @@ def handle_photo(message):
     auto_approve_enabled = OCR_ENABLED and AUTO_APPROVE_ENABLED and feature_flags.get('auto_approve', True)
     
     if auto_approve_enabled:
-        bot.reply_to(message, "⏳ Screenshot စစ်ဆေးနေပါသည်...")
-        
         try:
             ocr_result = process_payment_screenshot(bot, file_id, expected_amount, user_id=user_id)
             ocr_verified = ocr_result.get('verified', False)
             ocr_amount = ocr_result.get('ocr_amount')
-            logger.info(f"OCR Result for order {order_id}: verified={ocr_verified}, amount={ocr_amount}, expected={expected_amount}")
+            logger.info("OCR Result for order %s: verified=%s, amount=%s, expected=%s", order_id, ocr_verified, ocr_amount, expected_amount)
         except Exception as e:
             logger.error(f"OCR Error: {e}")
             ocr_result = {'success': False, 'error': str(e)}
     
-    # Create user navigation keyboard
-    user_nav_keyboard = types.InlineKeyboardMarkup(row_width=2)
-    user_nav_keyboard.add(
-        types.InlineKeyboardButton("📖 Help", callback_data="help"),
-        types.InlineKeyboardButton("📞 Contact", url="https://t.me/BDS_Admin")
-    )
-    user_nav_keyboard.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-    
-    # Notify user - Don't reveal OCR details to prevent fraud attempts
-    bot.send_message(
-        message.chat.id,
-        "✅ *Screenshot လက်ခံရရှိပါပြီ!*\n\n"
-        "Admin Approve ပြုလုပ်ပြီးသည်နှင့် VPN Key ကို ပေးပို့ပါမည်။\n"
-        "ကျေးဇူးပြု၍ စောင့်ဆိုင်းပေးပါ။",
-        reply_markup=user_nav_keyboard
-    )
-    
-    # Notify admin
-    user = message.from_user
-    username_display = user.username if user.username else user.first_name
-    username_display = sanitize_username(username_display)
-    if username_display:
-        username_display = username_display.replace("_", "\\_")
-    
     # Build admin message with OCR info
     ocr_status = ""
     if ocr_result:
@@ -3256,7 +4326,7 @@ def handle_photo(message):
             referral_info = f"\n\n🔗 *Referral Info:*\n👥 Referred by: @{referrer_username_display}\n🎁 Referrer will get +5 Days bonus"
     
     # Escape username for Markdown
-    user_display = user.username if user.username else user.first_name
+    user_display = job['username'] if job['username'] else job['first_name']
     if user_display:
         user_display = user_display.replace("_", "\\_")
     
@@ -3264,13 +4334,14 @@ def handle_photo(message):
 
 👤 User: @{user_display}
 🆔 User ID: {user_id}
-🖥️ Server: {SERVERS.get(server_id, {}).get('name', 'Unknown')}
+🖥️ Server: {_SERVER_NAMES.get(server_id, 'Unknown')}
 📦 Plan: {plan['name'] if plan else 'Unknown'}
 💰 Expected: {expected_amount:,} Ks{referral_info}{ocr_status}
 
 📸 Payment Screenshot အောက်တွင်..."""
     
-    # Send to Payment Proof Channel with screenshot
+    # Send to Payment Proof Channel with screenshot (shares the notification send budget)
+    _outbound_throttle.acquire()
     try:
         admin_msg = bot.send_photo(
             PAYMENT_CHANNEL_ID,
@@ -3303,12 +4374,8 @@ def handle_photo(message):
 
 # ===================== REFERRAL SYSTEM =====================
 
-def show_referral_menu(call):
-    """Show referral system menu"""
-    user_id = call.from_user.id
-    stats = get_referral_stats(user_id)
-    
-    text = f"""
+# Constant part of the referral menu - only the stats block below it is formatted per call
+REFERRAL_MENU_HEADER = """
 👥 *Referral Program*
 
 🎁 *သူငယ်ချင်းရှာပြီး ဆုရယူပါ!*
@@ -3316,7 +4383,14 @@ def show_referral_menu(call):
 📌 *Reward များ:*
 • Referral 1 ယောက်ဝယ်ရင် → **+5 Days** (Key သက်တမ်းတိုး)
 • Referral 3 ယောက်ဝယ်ရင် → **1 Month Free Key**
+"""
 
+def show_referral_menu(call):
+    """Show referral system menu"""
+    user_id = call.from_user.id
+    stats = get_referral_stats(user_id)
+    
+    text = REFERRAL_MENU_HEADER + f"""
 📊 *သင့် Stats:*
 • စုစုပေါင်း Refer: {stats['total_referred']} ယောက်
 • ဝယ်ယူပြီးသူ: {stats['paid_referrals']} ယောက်
@@ -3326,24 +4400,12 @@ def show_referral_menu(call):
 {'🎉 **1 Month Free Key ရယူနိုင်ပါပြီ!**' if stats['can_claim_free_month'] else f'📈 Free Key ရဖို့ {3 - (stats["paid_referrals"] % 3)} ယောက် လိုပါသေးသည်'}
 """
     
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        types.InlineKeyboardButton("🔗 ကျွန်ုပ်၏ Referral Link", callback_data="my_referral_link"),
-        types.InlineKeyboardButton("📊 Referral Stats", callback_data="referral_stats")
-    )
-    
-    # Only show claim button when user has 3 paid referrals
-    if stats['can_claim_free_month']:
-        markup.add(types.InlineKeyboardButton("🎁 1 Month Free Key ရယူမည်", callback_data="claim_free_month"))
-    
-    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="main_menu"))
-    
-    bot.edit_message_text(
+    safe_edit_message_text(
         text,
         call.message.chat.id,
         call.message.message_id,
         parse_mode='Markdown',
-        reply_markup=markup
+        reply_markup=REFERRAL_MENU_MARKUPS[bool(stats['can_claim_free_month'])]
     )
 
 def show_referral_link(call):
@@ -3351,9 +4413,7 @@ def show_referral_link(call):
     user_id = call.from_user.id
     ref_code = get_referral_code(user_id)
     
-    # Bot username - update this to your bot's username
-    bot_username = "BurmeseDigitalStore_bot"
-    ref_link = f"https://t.me/{bot_username}?start=REF_{ref_code}"
+    ref_link = f"https://t.me/{BOT_USERNAME}?start=REF_{ref_code}"
     
     text = f"""
 🔗 *သင့် Referral Link*
@@ -3380,7 +4440,7 @@ Link:
     markup.add(types.InlineKeyboardButton("📤 Share Link", url=f"https://t.me/share/url?url={ref_link}&text=VPN Key ဝယ်ဖို့ ဒီ link သုံးပါ"))
     markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="referral"))
     
-    bot.edit_message_text(
+    safe_edit_message_text(
         text,
         call.message.chat.id,
         call.message.message_id,
@@ -3388,6 +4448,13 @@ Link:
         reply_markup=markup
     )
 
+REFERRAL_STATS_TIPS = """
+💡 *Tips:*
+• Social media မှာ Share ပါ
+• Group တွေမှာ Recommend ပါ
+• Review ကောင်းကောင်း ပေးပါ
+"""
+
 def show_referral_stats(call):
     """Show detailed referral statistics"""
     user_id = call.from_user.id
@@ -3411,24 +4478,14 @@ def show_referral_stats(call):
 📈 *Progress to Free Month:*
 {progress_bar} ({progress}/3)
 {f'🎉 ရယူနိုင်ပါပြီ!' if stats['can_claim_free_month'] else f'{3 - progress} ယောက် လိုပါသေးသည်'}
-
-💡 *Tips:*
-• Social media မှာ Share ပါ
-• Group တွေမှာ Recommend ပါ
-• Review ကောင်းကောင်း ပေးပါ
-"""
-    
-    markup = types.InlineKeyboardMarkup()
-    if stats['can_claim_free_month']:
-        markup.add(types.InlineKeyboardButton("🎁 1 Month Free Key ရယူမည်", callback_data="claim_free_month"))
-    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="referral"))
+""" + REFERRAL_STATS_TIPS
     
-    bot.edit_message_text(
+    safe_edit_message_text(
         text,
         call.message.chat.id,
         call.message.message_id,
         parse_mode='Markdown',
-        reply_markup=markup
+        reply_markup=REFERRAL_STATS_MARKUPS[bool(stats['can_claim_free_month'])]
     )
 
 def claim_referral_reward(call):
@@ -3436,14 +4493,13 @@ def claim_referral_reward(call):
     user_id = call.from_user.id
     
     # Check eligibility first (without claiming yet)
-    stats = get_referral_stats(user_id)
+    stats = get_referral_stats(user_id, fresh=True)
     
     # Only proceed if user has 3 paid referrals
     if stats['can_claim_free_month']:
         # Send to Payment Channel for Admin approval
         try:
-            user = get_user(user_id)
-            username = user[2] if user and user[2] else f"User_{user_id}"
+            username = get_username(user_id) or f"User_{user_id}"
             username_display = username.replace("_", "\\_") if username else f"User\\_{user_id}"
             
             # Get detailed referral list
@@ -3521,15 +4577,12 @@ Free Month ရယူရန် Referral 3 ယောက် ဝယ်ပြီး
 📌 သင်ဆက်လက် Refer လုပ်နိုင်ပါသည်!
 """
     
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🔙 Back", callback_data="referral"))
-    
-    bot.edit_message_text(
+    safe_edit_message_text(
         text,
         call.message.chat.id,
         call.message.message_id,
         parse_mode='Markdown',
-        reply_markup=markup
+        reply_markup=REFERRAL_BACK_MARKUP
     )
 
 def process_referral_on_purchase(buyer_id, order_id):
@@ -3543,28 +4596,26 @@ def process_referral_on_purchase(buyer_id, order_id):
         # Auto-extend referrer's active keys by 5 days
         extended_keys = []
         active_keys = get_user_active_keys(referrer_id)
+        panels = {}  # {server_id: logged-in XUIApi, or None if login failed} - one login per server
         
         for key in active_keys:
-            key_id, server_id, client_id, expiry_date = key
-            server = SERVERS.get(server_id, {})
+            key_id, server_id, client_id, expiry_date, client_email = key
             
             try:
                 # Extend in database
                 new_expiry = extend_key_expiry(key_id, 5)
                 if new_expiry:
-                    extended_keys.append((server.get('name', 'Unknown'), new_expiry))
+                    extended_keys.append((_SERVER_NAMES.get(server_id, 'Unknown'), new_expiry))
                     
                     # Also extend on XUI panel
                     try:
-                        from xui_api import XUIApi
-                        api = XUIApi(server_id)
-                        if api.login():
-                            # Get client_email from vpn_keys
-                            key_data = get_vpn_key_by_id(key_id)
-                            if key_data:
-                                client_email = key_data[4]  # client_email column
-                                api.extend_client_expiry(client_email, 5)
-                                logger.info(f"✅ Extended key {key_id} on XUI panel +5 days")
+                        if server_id not in panels:
+                            api = XUIApi(server_id)
+                            panels[server_id] = api if api.login() else None
+                        api = panels[server_id]
+                        if api and client_email:
+                            api.extend_client_expiry(client_email, 5)
+                            logger.info("✅ Extended key %s on XUI panel +5 days", key_id)
                     except Exception as panel_err:
                         logger.error(f"XUI panel extend failed for key {key_id}: {panel_err}")
             except Exception as e:
@@ -3599,7 +4650,7 @@ def process_referral_on_purchase(buyer_id, order_id):
                 types.KeyboardButton("🏠 Main Menu")
             )
             
-            bot.send_message(
+            queue_message(
                 referrer_id,
                 f"🎉 *Referral Reward!*\n\n"
                 f"သင် Refer လုပ်ထားသူ Key ဝယ်သွားပါပြီ!\n\n"
@@ -3614,15 +4665,14 @@ def process_referral_on_purchase(buyer_id, order_id):
 
 # ===================== AUTO-APPROVE FUNCTIONS =====================
 
+# One scheduler thread serves every pending auto-approval: a min-heap of (due_at, order_id).
+# Cancelled or rescheduled orders leave a stale heap entry that is skipped when it comes due.
+_approval_heap = []
+_approval_cv = threading.Condition()
+
 def setup_auto_approve_timer(order_id, customer_id, server_id, plan_id, admin_message_id, ocr_amount):
-    """Setup timer for auto-approve after 5 minutes"""
-    global pending_auto_approvals
-    
-    # Cancel existing timer if any
-    if order_id in pending_auto_approvals:
-        existing = pending_auto_approvals[order_id]
-        if existing.get('timer'):
-            existing['timer'].cancel()
+    """Schedule auto-approve after AUTO_APPROVE_TIMEOUT (replaces any earlier schedule)"""
+    due_at = _time.monotonic() + AUTO_APPROVE_TIMEOUT
     
     # Store approval data
     approval_data = {
@@ -3632,28 +4682,46 @@ def setup_auto_approve_timer(order_id, customer_id, server_id, plan_id, admin_me
         'plan_id': plan_id,
         'admin_message_id': admin_message_id,
         'ocr_amount': ocr_amount,
-        'created_at': datetime.now()
+        'created_at': datetime.now(),
+        'due_at': due_at
     }
     
-    # Create timer
-    timer = threading.Timer(AUTO_APPROVE_TIMEOUT, auto_approve_order, args=[order_id])
-    timer.start()
+    with _approval_cv:
+        pending_auto_approvals[order_id] = approval_data
+        heapq.heappush(_approval_heap, (due_at, order_id))
+        _approval_cv.notify()
     
-    approval_data['timer'] = timer
-    pending_auto_approvals[order_id] = approval_data
-    
-    logger.info(f"⏱️ Auto-approve timer set for order #{order_id} (5 minutes)")
+    logger.info("⏱️ Auto-approve timer set for order #%s (%ss)", order_id, AUTO_APPROVE_TIMEOUT)
+
+def auto_approve_scheduler():
+    """Hand each pending order to auto_approve_order once its timeout has passed"""
+    while True:
+        with _approval_cv:
+            while True:
+                now = _time.monotonic()
+                if _approval_heap and _approval_heap[0][0] <= now:
+                    due_at, order_id = heapq.heappop(_approval_heap)
+                    approval_data = pending_auto_approvals.get(order_id)
+                    if approval_data and approval_data['due_at'] == due_at:
+                        break
+                    continue  # Cancelled or rescheduled
+                _approval_cv.wait(_approval_heap[0][0] - now if _approval_heap else None)
+        # Key creation can take seconds - keep the scheduler free for the next deadline
+        provision_executor.submit(auto_approve_order, order_id)
 
 
 def auto_approve_order(order_id):
     """Auto-approve order after timeout"""
-    global pending_auto_approvals
-    
-    if order_id not in pending_auto_approvals:
-        logger.info(f"Order #{order_id} already processed, skipping auto-approve")
+    with _approval_cv:
+        approval_data = pending_auto_approvals.pop(order_id, None)
+    if approval_data is None:
+        logger.info("Order #%s already processed, skipping auto-approve", order_id)
         return
     
-    approval_data = pending_auto_approvals.pop(order_id)
+    job_key = ('order', order_id)
+    if not start_provisioning(job_key):
+        logger.info("Order #%s is being approved manually, skipping auto-approve", order_id)
+        return
     
     try:
         # Get order details
@@ -3664,7 +4732,7 @@ def auto_approve_order(order_id):
         
         # Check if already approved - use atomic operation to prevent race condition
         if not approve_order_atomic(order_id, 0):  # 0 = auto-approve system
-            logger.info(f"Order #{order_id} already processed, skipping auto-approve")
+            logger.info("Order #%s already processed, skipping auto-approve", order_id)
             return
         
         customer_id = approval_data['customer_id']
@@ -3674,14 +4742,12 @@ def auto_approve_order(order_id):
         protocol = order[5] if len(order) > 5 else 'trojan'
         
         # Get customer info
-        customer = get_user(customer_id)
-        customer_username = customer[2] if customer and customer[2] else f"User_{customer_id}"
+        customer_username = get_username(customer_id) or f"User_{customer_id}"
         
         # Get key count
-        existing_keys = get_user_keys(customer_id)
-        key_number = len(existing_keys) + 1
+        key_number = count_user_keys(customer_id) + 1
         
-        logger.info(f"🤖 Auto-approving order #{order_id} for user {customer_id}")
+        logger.info("🤖 Auto-approving order #%s for user %s", order_id, customer_id)
         
         # Create VPN key
         result = create_vpn_key(
@@ -3720,7 +4786,7 @@ def auto_approve_order(order_id):
 
 ✅ သင့် VPN Key ဖန်တီးပြီးပါပြီ!
 
-🖥️ *Server:* {SERVERS[server_id]['name']}
+🖥️ *Server:* {_SERVER_NAMES[server_id]}
 📦 *Plan:* {plan['name']}
 📅 *Expiry:* {expiry_str}
 📊 *Data Limit:* {data_limit_str}
@@ -3740,14 +4806,8 @@ def auto_approve_order(order_id):
 4. Connect နှိပ်ပါ
 """
             
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            markup.add(
-                types.InlineKeyboardButton("🛒 Key ထပ်ဝယ်ရန်", callback_data="buy_key"),
-                types.InlineKeyboardButton("📞 Admin ဆက်သွယ်ရန်", url="https://t.me/BDS_Admin")
-            )
-            markup.add(types.InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"))
-            
-            bot.send_message(customer_id, customer_message, reply_markup=markup, disable_web_page_preview=True)
+            # Sent directly (not queued) so the caption below reports whether it arrived
+            delivered = _send_outbound(customer_id, customer_message, dict(reply_markup=ORDER_APPROVED_MARKUP, disable_web_page_preview=True, parse_mode='Markdown'))
             
             # Process referral reward
             process_referral_on_purchase(customer_id, order_id)
@@ -3763,13 +4823,13 @@ def auto_approve_order(order_id):
                 bot.edit_message_caption(
                     caption=f"🤖 *AUTO-APPROVED* Order #{order_id}\n\n"
                             f"👤 User: @{safe_username} (`{customer_id}`)\n"
-                            f"🖥️ Server: {SERVERS[server_id]['name']}\n"
+                            f"🖥️ Server: {_SERVER_NAMES[server_id]}\n"
                             f"📦 Plan: {plan['name']}\n"
                             f"💰 Amount: {approval_data['ocr_amount']:,} Ks\n"
                             f"📅 Expiry: {expiry_str}\n"
                             f"📊 Data: {data_limit_str}\n"
                             f"🔑 Key: `{safe_client_email}`\n\n"
-                            f"✅ OCR Verified & Key sent to user",
+                            + ("✅ OCR Verified & Key sent to user" if delivered else "✅ OCR Verified ⚠️ Key saved, but sending it to the user failed"),
                     chat_id=PAYMENT_CHANNEL_ID,
                     message_id=approval_data['admin_message_id'],
                     parse_mode='Markdown'
@@ -3780,7 +4840,7 @@ def auto_approve_order(order_id):
             # Log auto-approval for admin review
             log_auto_approval(order_id, customer_id, approval_data['ocr_amount'], result)
             
-            logger.info(f"✅ Order #{order_id} auto-approved successfully")
+            logger.info("✅ Order #%s auto-approved successfully", order_id)
             
         else:
             # Check if it's a duplicate key error (key already exists)
@@ -3805,7 +4865,7 @@ def auto_approve_order(order_id):
                 except Exception as e:
                     logger.error(f"Error updating admin message for duplicate: {e}")
                 
-                logger.info(f"✅ Order #{order_id} marked as approved (duplicate key)")
+                logger.info("✅ Order #%s marked as approved (duplicate key)", order_id)
             else:
                 logger.error(f"❌ Failed to create key for auto-approve order #{order_id}")
                 # Notify admin about failure
@@ -3824,17 +4884,17 @@ def auto_approve_order(order_id):
         logger.error(f"Auto-approve error for order #{order_id}: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        finish_provisioning(job_key)
 
 
 def cancel_auto_approve(order_id):
     """Cancel auto-approve timer (called when admin manually approves/rejects)"""
-    global pending_auto_approvals
-    
-    if order_id in pending_auto_approvals:
-        approval_data = pending_auto_approvals.pop(order_id)
-        if approval_data.get('timer'):
-            approval_data['timer'].cancel()
-            logger.info(f"⏱️ Auto-approve timer cancelled for order #{order_id}")
+    with _approval_cv:
+        approval_data = pending_auto_approvals.pop(order_id, None)
+    if approval_data is not None:
+        # The heap entry stays behind and is skipped by auto_approve_scheduler
+        logger.info("⏱️ Auto-approve timer cancelled for order #%s", order_id)
 
 
 def log_auto_approval(order_id, customer_id, ocr_amount, result):
@@ -3869,7 +4929,7 @@ def create_backup():
         # Copy database file
         shutil.copy2(DATABASE_PATH, backup_path)
         
-        logger.info(f"📦 Backup created: {backup_filename}")
+        logger.info("📦 Backup created: %s", backup_filename)
         return backup_path, backup_filename
     except Exception as e:
         logger.error(f"Backup creation failed: {e}")
@@ -3912,12 +4972,12 @@ _Auto-backup by VPN Bot System_"""
                 parse_mode='Markdown'
             )
         
-        logger.info(f"✅ Backup sent to payment channel: {backup_filename}")
+        logger.info("✅ Backup sent to payment channel: %s", backup_filename)
         
         # Clean up backup file after sending
         try:
             os.remove(backup_path)
-            logger.info(f"🗑️ Backup file cleaned up: {backup_filename}")
+            logger.info("🗑️ Backup file cleaned up: %s", backup_filename)
         except:
             pass
         
@@ -3941,7 +5001,7 @@ def schedule_next_backup():
     # Calculate seconds until next midnight
     seconds_until_midnight = (next_midnight - yangon_now).total_seconds()
     
-    logger.info(f"⏰ Next backup scheduled in {seconds_until_midnight/3600:.1f} hours ({next_midnight.strftime('%Y-%m-%d %H:%M')} MMT)")
+    logger.info("⏰ Next backup scheduled in %.1f hours (%s MMT)", seconds_until_midnight / 3600, next_midnight.strftime('%Y-%m-%d %H:%M'))
     
     # Cancel existing timer if any
     if backup_timer:
@@ -3971,24 +5031,12 @@ def check_expiring_keys():
             # Send urgent reminders (1 day)
             for key in expiring_1d:
                 try:
-                    telegram_id = key[1]
-                    server_id = key[3]
-                    expiry_date = key[9]
-                    server_name = SERVERS.get(server_id, {}).get('name', server_id)
-                    
-                    # Parse expiry date
-                    if isinstance(expiry_date, str):
-                        try:
-                            exp_dt = datetime.strptime(expiry_date, '%Y-%m-%d %H:%M:%S')
-                        except:
-                            try:
-                                exp_dt = datetime.strptime(expiry_date, '%Y-%m-%d %H:%M:%S.%f')
-                            except:
-                                exp_dt = None
-                    else:
-                        exp_dt = expiry_date
+                    telegram_id = key.telegram_id
+                    server_id = key.server_id
+                    expiry_date = key.expiry_date
+                    server_name = _SERVER_NAMES.get(server_id, server_id)
                     
-                    exp_str = exp_dt.strftime('%Y-%m-%d %H:%M') if exp_dt else str(expiry_date)
+                    exp_str = format_expiry(expiry_date)
                     
                     bot.send_message(
                         telegram_id,
@@ -4005,28 +5053,17 @@ def check_expiring_keys():
                     pass  # User may have blocked bot
             
             # Send advance reminders (3 days, excluding already-warned 1-day ones)
-            expiring_1d_ids = {k[0] for k in expiring_1d}
+            expiring_1d_ids = {k.id for k in expiring_1d}
             for key in expiring_3d:
-                if key[0] in expiring_1d_ids:
+                if key.id in expiring_1d_ids:
                     continue  # Already sent urgent reminder
                 try:
-                    telegram_id = key[1]
-                    server_id = key[3]
-                    expiry_date = key[9]
-                    server_name = SERVERS.get(server_id, {}).get('name', server_id)
-                    
-                    if isinstance(expiry_date, str):
-                        try:
-                            exp_dt = datetime.strptime(expiry_date, '%Y-%m-%d %H:%M:%S')
-                        except:
-                            try:
-                                exp_dt = datetime.strptime(expiry_date, '%Y-%m-%d %H:%M:%S.%f')
-                            except:
-                                exp_dt = None
-                    else:
-                        exp_dt = expiry_date
+                    telegram_id = key.telegram_id
+                    server_id = key.server_id
+                    expiry_date = key.expiry_date
+                    server_name = _SERVER_NAMES.get(server_id, server_id)
                     
-                    exp_str = exp_dt.strftime('%Y-%m-%d %H:%M') if exp_dt else str(expiry_date)
+                    exp_str = format_expiry(expiry_date)
                     
                     bot.send_message(
                         telegram_id,
@@ -4043,7 +5080,7 @@ def check_expiring_keys():
                     pass
             
             if sent_1d > 0 or sent_3d > 0:
-                logger.info(f"📢 Expiry reminders sent: {sent_1d} urgent (1d), {sent_3d} advance (3d)")
+                logger.info("📢 Expiry reminders sent: %s urgent (1d), %s advance (3d)", sent_1d, sent_3d)
                 
         except Exception as e:
             logger.error(f"Expiry reminder error: {e}")
@@ -4057,10 +5094,32 @@ def cleanup_stale_orders():
             _time.sleep(3600)  # Run every hour
             cancelled = cancel_stale_orders(hours=24)
             if cancelled > 0:
-                logger.info(f"🗑️ Auto-cancelled {cancelled} stale pending orders")
+                logger.info("🗑️ Auto-cancelled %s stale pending orders", cancelled)
         except Exception as e:
             logger.error(f"Stale order cleanup error: {e}")
 
+# Write-behind queue for user profile upserts from /start
+_user_write_queue = queue.Queue()
+USER_WRITE_BATCH_SIZE = 100
+
+def queue_user_update(telegram_id, username, first_name, last_name=None):
+    """Queue a user upsert for the background writer"""
+    _user_write_queue.put((telegram_id, username, first_name, last_name))
+
+def user_write_worker():
+    """Drain queued user upserts and write them in batches (one transaction per batch)"""
+    while True:
+        batch = [_user_write_queue.get()]
+        while len(batch) < USER_WRITE_BATCH_SIZE:
+            try:
+                batch.append(_user_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            create_users_batch(batch)
+        except Exception as e:
+            logger.error(f"User write-behind error: {e}")
+
 def run_midnight_backup():
     """Run midnight backup and schedule next one"""
     logger.info("🌙 Midnight backup starting...")
@@ -4091,23 +5150,70 @@ def manual_backup():
     return send_backup_to_channel()
 
 
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+
+def run_webhook():
+    """Receive updates by webhook (push) instead of long-polling"""
+    from flask import Flask, request, abort
+    
+    app = Flask(__name__)
+    webhook_path = f"/webhook/{BOT_TOKEN}"
+    
+    @app.route(webhook_path, methods=['POST'])
+    def telegram_webhook():
+        if request.headers.get('content-type') != 'application/json':
+            abort(403)
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            abort(403)
+        update = types.Update.de_json(request.get_data().decode('utf-8'))
+        # Handed off to the worker pool - returns to Telegram immediately
+        bot.process_new_updates([update])
+        return ''
+    
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + webhook_path,
+        drop_pending_updates=True,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=BOT_WORKER_THREADS,
+        secret_token=WEBHOOK_SECRET or None
+    )
+    logger.info("🌐 Webhook mode: listening on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    
+    try:
+        app.run(host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, threaded=True)
+    except KeyboardInterrupt:
+        logger.info("🛑 Bot stopping gracefully...")
+    finally:
+        logger.info("Bot shutdown complete")
+
+
 def main():
     """Main function to run the bot"""
+    global BOT_USERNAME
     # Initialize database
     init_db()
     
     # Load servers from config + database
     load_servers()
     
+    # Warm the per-server protocol cache in the background so first menus don't wait on the panel
+    for server_id in SERVERS:
+        panel_executor.submit(server_protocols, server_id)
+    
     # Load feature flags from database
     load_feature_flags()
     
+    # Load active bans into memory
+    load_banned_users()
+    
     # Setup DDoS auto-block callback to database
     def db_ban_wrapper(user_id, reason, hours):
         """Wrapper to ban user in database"""
         try:
             ban_user(user_id, reason=reason, duration_hours=hours, banned_by=0)  # 0 = system
-            logger.info(f"🔒 DDoS auto-block: User {user_id} banned in database for {hours}h - {reason}")
+            logger.info("🔒 DDoS auto-block: User %s banned in database for %sh - %s", user_id, hours, reason)
         except Exception as e:
             logger.error(f"Failed to persist DDoS ban: {e}")
     
@@ -4148,7 +5254,7 @@ def main():
     logger.info("📋 Feature Flags:")
     for flag_name, is_enabled in feature_flags.items():
         status = "✅" if is_enabled else "❌"
-        logger.debug(f"   ├ {flag_name}: {status}")
+        logger.debug("   ├ %s: %s", flag_name, status)
     
     # OCR and Auto-approve status
     if OCR_ENABLED:
@@ -4157,7 +5263,7 @@ def main():
         logger.info("🤖 OCR Payment Verification: ❌")
     
     if AUTO_APPROVE_ENABLED:
-        logger.info(f"⏱️ Auto-Approve: ✅ ({AUTO_APPROVE_TIMEOUT} seconds timeout)")
+        logger.info("⏱️ Auto-Approve: ✅ (%s seconds timeout)", AUTO_APPROVE_TIMEOUT)
     else:
         logger.info("⏱️ Auto-Approve: ❌")
     
@@ -4176,22 +5282,42 @@ def main():
     stale_cleaner.start()
     logger.info("🗑️ Stale Order Cleanup: ✅ (every 1 hour, cancels 24h+ pending)")
     
+    # Start payment screenshot workers
+    for _ in range(SCREENSHOT_WORKERS):
+        threading.Thread(target=screenshot_worker, daemon=True).start()
+    logger.info("📸 Screenshot Workers: ✅ (%s)", SCREENSHOT_WORKERS)
+    
+    # Start auto-approve scheduler
+    threading.Thread(target=auto_approve_scheduler, daemon=True).start()
+    logger.info("🤖 Auto-Approve Scheduler: ✅ (%ss after OCR match)", AUTO_APPROVE_TIMEOUT)
+    
+    # Start user write-behind worker
+    user_writer = threading.Thread(target=user_write_worker, daemon=True)
+    user_writer.start()
+    logger.info("✍️ User Write-Behind: ✅ (batched upserts)")
+    
     # Start auto backup scheduler
     logger.info("📦 Auto Backup: ✅ (Daily at 00:00 MMT)")
     schedule_next_backup()
     
     # Start the bot
     logger.info("🚀 VPN Seller Bot started!")
-    logger.info(f"📱 Bot: @{bot.get_me().username}")
+    BOT_USERNAME = bot.get_me().username
+    logger.info("📱 Bot: @%s", BOT_USERNAME)
+    logger.info("🧵 Update Workers: %s", BOT_WORKER_THREADS)
     logger.info("Press Ctrl+C to stop")
     
+    if WEBHOOK_URL:
+        run_webhook()
+        return
+    
     # Start polling with auto-reconnect
     try:
         bot.infinity_polling(
             skip_pending=True,
             timeout=60,
             long_polling_timeout=30,
-            allowed_updates=["message", "callback_query", "chat_member"]
+            allowed_updates=ALLOWED_UPDATES
         )
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopping gracefully...")
@@ -125,6 +125,16 @@ PAYMENT_INFO = {
 # Database (from environment variables)
 DATABASE_PATH = os.environ.get('DATABASE_PATH', 'vpn_bot.db')
 
+# Update handling (from environment variables)
+# Handlers run on a worker pool so one slow panel/DB call doesn't stall other users
+BOT_WORKER_THREADS = int(os.environ.get('BOT_WORKER_THREADS', '8'))
+# Set WEBHOOK_URL (public https base URL) to receive updates by webhook instead of long-polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+# Telegram echoes this back in X-Telegram-Bot-Api-Secret-Token on every webhook call
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+
 # Bot Messages (Burmese)
 MESSAGES = {
     "welcome": """
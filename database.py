@@ -1,17 +1,48 @@
 import sqlite3
 import logging
+import queue
+import threading
+import time
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 from config import DATABASE_PATH
 
 logger = logging.getLogger(__name__)
 
+# vpn_keys row (server_name is only filled by queries that join the servers table)
+VpnKey = namedtuple('VpnKey', [
+    'id', 'telegram_id', 'order_id', 'server_id', 'client_email', 'client_id',
+    'sub_link', 'config_link', 'data_limit', 'expiry_date', 'is_active', 'created_at',
+    'server_name'
+], defaults=(None,))
+_VPN_KEY_COLUMNS = ('id, telegram_id, order_id, server_id, client_email, client_id, '
+                    'sub_link, config_link, data_limit, expiry_date, is_active, created_at')
+
+def _vpn_key_row(cursor, row):
+    """sqlite3 row_factory producing VpnKey rows"""
+    return VpnKey(*row)
+
+
+# Idle connections kept for reuse; WAL lets readers run alongside the single writer
+DB_POOL_SIZE = 8
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _connect():
+    """Open a connection with the per-connection pragmas applied"""
+    conn = sqlite3.connect(DATABASE_PATH, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout=5000")  # Wait for the writer instead of 'database is locked'
+    conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, avoids an fsync per commit
+    conn.execute("PRAGMA cache_size=-8000")  # ~8 MB page cache
+    return conn
 
 @contextmanager
 def get_db():
-    """Context manager for database connections - ensures proper cleanup"""
-    conn = sqlite3.connect(DATABASE_PATH, timeout=10)
-    conn.execute("PRAGMA journal_mode=WAL")  # Better concurrent access
+    """Context manager for pooled database connections - commits or rolls back on exit"""
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
     try:
         yield conn
         conn.commit()
@@ -19,11 +50,15 @@ def get_db():
         conn.rollback()
         raise
     finally:
-        conn.close()
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 def init_db():
     """Initialize the database with required tables"""
     conn = sqlite3.connect(DATABASE_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")  # Persistent, so only needs setting once
     cursor = conn.cursor()
     
     # Users table
@@ -233,6 +268,14 @@ def init_db():
         )
     ''')
 
+    # Disabled servers (admin toggle) - covers config.py servers too, which have no servers row
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS disabled_servers (
+            server_id TEXT PRIMARY KEY,
+            disabled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
     # Protocol settings table (admin can enable/disable protocols)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS protocol_settings (
@@ -262,8 +305,11 @@ def init_db():
     index_statements = [
         'CREATE INDEX IF NOT EXISTS idx_orders_telegram_id ON orders(telegram_id)',
         'CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)',
         'CREATE INDEX IF NOT EXISTS idx_vpn_keys_telegram_id ON vpn_keys(telegram_id)',
         'CREATE INDEX IF NOT EXISTS idx_vpn_keys_active ON vpn_keys(is_active)',
+        'CREATE INDEX IF NOT EXISTS idx_vpnkeys_user_active ON vpn_keys(telegram_id, is_active, id)',
         'CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)',
         'CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id)',
         'CREATE INDEX IF NOT EXISTS idx_user_bans_telegram_id ON user_bans(telegram_id)',
@@ -304,6 +350,24 @@ def create_user(telegram_id, username, first_name, last_name=None):
         except Exception as e:
             logger.error(f"Error creating user: {e}")
 
+def create_users_batch(users):
+    """Upsert many users in one transaction - users: [(telegram_id, username, first_name, last_name), ...]"""
+    if not users:
+        return
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.executemany('''
+                INSERT INTO users (telegram_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+            ''', users)
+        except Exception as e:
+            logger.error(f"Error creating users batch: {e}")
+
 def has_used_free_test(telegram_id):
     """Check if user has already used free test"""
     with get_db() as conn:
@@ -312,6 +376,17 @@ def has_used_free_test(telegram_id):
         result = cursor.fetchone()
         return result is not None
 
+def get_free_test_status(telegram_id):
+    """(has used free test, active key count) for a user in one query"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT EXISTS(SELECT 1 FROM free_tests WHERE telegram_id = ?),
+                   (SELECT COUNT(*) FROM vpn_keys WHERE telegram_id = ? AND is_active = 1)
+        ''', (telegram_id, telegram_id))
+        used, key_count = cursor.fetchone()
+        return bool(used), key_count
+
 def mark_free_test_used(telegram_id, server_id=None, protocol=None, username=None):
     """Mark free test as used for user with server/protocol tracking"""
     with get_db() as conn:
@@ -396,6 +471,20 @@ def update_order_screenshot(order_id, screenshot_file_id):
             UPDATE orders SET payment_screenshot = ? WHERE id = ?
         ''', (screenshot_file_id, order_id))
 
+def get_awaiting_screenshot_order(telegram_id, max_age_minutes=60):
+    """Get user's latest recent pending order that has no screenshot yet (order id or None)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id FROM orders
+            WHERE telegram_id = ? AND status = 'pending' AND payment_screenshot IS NULL
+              AND created_at >= datetime('now', ?)
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (telegram_id, f'-{int(max_age_minutes)} minutes'))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
 def is_duplicate_screenshot(file_unique_id, current_order_id=None):
     """Check if a screenshot file_unique_id was already used in an approved/pending order.
     Returns the order_id if duplicate found, None otherwise."""
@@ -445,13 +534,14 @@ def approve_order_atomic(order_id, admin_id):
         return affected > 0
 
 def reject_order(order_id, admin_id):
-    """Reject an order"""
+    """Reject an order only if pending. Returns True if rejected, False if already processed."""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE orders SET status = 'rejected', approved_at = ?, approved_by = ?
-            WHERE id = ?
+            WHERE id = ? AND status = 'pending'
         ''', (datetime.now(), admin_id, order_id))
+        return cursor.rowcount > 0
 
 def get_order(order_id):
     """Get order by ID"""
@@ -502,22 +592,73 @@ def save_vpn_key(telegram_id, order_id, server_id, client_email, client_id, sub_
             logger.error(f"Error saving VPN key: {e}")
             return None
 
+def approve_and_save_key(order_id, admin_id, telegram_id, server_id, client_email, client_id, sub_link, config_link, data_limit, expiry_date):
+    """Approve a pending order and save its VPN key in one transaction. Returns the key id, or
+    None if nothing was written (order no longer pending, or a DB error)"""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE orders SET status = 'approved', approved_at = ?, approved_by = ?
+                WHERE id = ? AND status = 'pending'
+            ''', (datetime.now(), admin_id, order_id))
+            if cursor.rowcount != 1:
+                # Rejected/approved by someone else meanwhile - don't attach a key to it
+                conn.rollback()
+                logger.warning(f"Order {order_id} is no longer pending, key not saved")
+                return None
+            cursor.execute('''
+                INSERT INTO vpn_keys (telegram_id, order_id, server_id, client_email, client_id, sub_link, config_link, data_limit, expiry_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (telegram_id, order_id, server_id, client_email, client_id, sub_link, config_link, data_limit, expiry_date))
+            return cursor.lastrowid
+    except Exception as e:
+        logger.error(f"Error approving order {order_id}: {e}")
+        return None
+
 def get_user_keys(telegram_id):
-    """Get all VPN keys for a user"""
+    """Get all VPN keys for a user (vpn_keys columns + server_name of database servers)"""
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.row_factory = _vpn_key_row
         cursor.execute('''
-            SELECT * FROM vpn_keys WHERE telegram_id = ? AND is_active = 1
-            ORDER BY created_at ASC
+            SELECT k.id, k.telegram_id, k.order_id, k.server_id, k.client_email, k.client_id,
+                   k.sub_link, k.config_link, k.data_limit, k.expiry_date, k.is_active,
+                   k.created_at, s.name AS server_name
+            FROM vpn_keys k
+            LEFT JOIN servers s ON s.server_id = k.server_id
+            WHERE k.telegram_id = ? AND k.is_active = 1
+            ORDER BY k.created_at ASC
         ''', (telegram_id,))
         keys = cursor.fetchall()
         return keys
 
+def count_user_keys(telegram_id):
+    """Number of active VPN keys a user has"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM vpn_keys
+            WHERE telegram_id = ? AND is_active = 1
+        ''', (telegram_id,))
+        return cursor.fetchone()[0]
+
+def get_key_position(telegram_id, key_id):
+    """1-based position of a key among the user's active keys (Key 1, Key 2, ...)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM vpn_keys
+            WHERE telegram_id = ? AND is_active = 1 AND id <= ?
+        ''', (telegram_id, key_id))
+        return cursor.fetchone()[0] or 1
+
 def get_vpn_key_by_id(key_id):
     """Get VPN key by ID"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM vpn_keys WHERE id = ?', (key_id,))
+        cursor.row_factory = _vpn_key_row
+        cursor.execute(f'SELECT {_VPN_KEY_COLUMNS} FROM vpn_keys WHERE id = ?', (key_id,))
         key = cursor.fetchone()
         return key
 
@@ -551,24 +692,42 @@ def deactivate_vpn_key(key_id):
             logger.error(f"Error deactivating VPN key: {e}")
             return False
 
+def deactivate_vpn_keys(key_ids):
+    """Deactivate several VPN keys in one UPDATE/transaction"""
+    if not key_ids:
+        return True
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            placeholders = ','.join('?' * len(key_ids))
+            cursor.execute(
+                f'UPDATE vpn_keys SET is_active = 0 WHERE id IN ({placeholders})',
+                list(key_ids)
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error deactivating VPN keys: {e}")
+            return False
+
 def get_expiring_keys(days=3):
     """Get keys expiring within specified days"""
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.row_factory = _vpn_key_row
         expiry_threshold = datetime.now() + timedelta(days=days)
-        cursor.execute('''
-            SELECT * FROM vpn_keys 
+        cursor.execute(f'''
+            SELECT {_VPN_KEY_COLUMNS} FROM vpn_keys 
             WHERE is_active = 1 AND expiry_date <= ? AND expiry_date > ?
         ''', (expiry_threshold, datetime.now()))
         keys = cursor.fetchall()
         return keys
 
 def get_user_active_keys(telegram_id):
-    """Get user's active keys with server info"""
+    """Get user's active keys with server info: (id, server_id, client_id, expiry_date, client_email)"""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT id, server_id, client_id, expiry_date FROM vpn_keys 
+            SELECT id, server_id, client_id, expiry_date, client_email FROM vpn_keys 
             WHERE telegram_id = ? AND is_active = 1
             ORDER BY expiry_date DESC
         ''', (telegram_id,))
@@ -602,17 +761,33 @@ def extend_key_expiry(key_id, days):
             logger.error(f"Error extending key expiry: {e}")
             return None
 
-def get_all_orders(status=None):
-    """Get all orders, optionally filtered by status"""
+def get_all_orders(status=None, limit=None):
+    """Get orders newest first, optionally filtered by status and capped at limit rows"""
+    query = 'SELECT * FROM orders'
+    params = []
+    if status:
+        query += ' WHERE status = ?'
+        params.append(status)
+    query += ' ORDER BY created_at DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
     with get_db() as conn:
         cursor = conn.cursor()
-        if status:
-            cursor.execute('SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC', (status,))
-        else:
-            cursor.execute('SELECT * FROM orders ORDER BY created_at DESC')
+        cursor.execute(query, params)
         orders = cursor.fetchall()
         return orders
 
+def count_orders(status=None):
+    """Number of orders, optionally filtered by status"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if status:
+            cursor.execute('SELECT COUNT(*) FROM orders WHERE status = ?', (status,))
+        else:
+            cursor.execute('SELECT COUNT(*) FROM orders')
+        return cursor.fetchone()[0]
+
 def cancel_stale_orders(hours=24):
     """Cancel pending orders older than specified hours. Returns count of cancelled orders."""
     with get_db() as conn:
@@ -699,14 +874,42 @@ def get_security_logs(limit=100):
         logs = cursor.fetchall()
         return logs
 
-def get_all_users():
-    """Get all users"""
+def get_all_users(limit=None):
+    """Get users newest first, capped at limit rows if given"""
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY created_at DESC')
+        if limit:
+            cursor.execute('SELECT * FROM users ORDER BY created_at DESC LIMIT ?', (limit,))
+        else:
+            cursor.execute('SELECT * FROM users ORDER BY created_at DESC')
         users = cursor.fetchall()
         return users
 
+def count_users():
+    """Number of registered users"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM users')
+        return cursor.fetchone()[0]
+
+def iter_all_users(batch_size=1000):
+    """Yield telegram_ids of all users in batches (keyset pagination - O(batch) memory)"""
+    last_id = 0
+    while True:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1] for row in rows]
+        if len(rows) < batch_size:
+            return
+
 # ===================== REFERRAL SYSTEM =====================
 
 def generate_referral_code(telegram_id):
@@ -761,9 +964,10 @@ def add_referral(referrer_id, referred_id):
                 INSERT INTO referrals (referrer_id, referred_id)
                 VALUES (?, ?)
             ''', (referrer_id, referred_id))
-            return True, "success"
         except Exception as e:
             return False, str(e)
+    invalidate_referral_stats(referrer_id)
+    return True, "success"
 
 def mark_referral_paid(referred_id, order_id):
     """Mark referral as paid when referred user makes a purchase"""
@@ -794,59 +998,59 @@ def mark_referral_paid(referred_id, order_id):
             WHERE telegram_id = ?
         ''', (referrer_id,))
 
+    invalidate_referral_stats(referrer_id)
+    return referrer_id
 
-        return referrer_id
-
-def get_referral_stats(telegram_id):
-    """Get referral statistics for a user"""
-    with get_db() as conn:
-        cursor = conn.cursor()
+# Users flip between the referral menus, re-reading the same stats seconds apart. Entries are
+# dropped by every referral write in this module, so the TTL only bounds other processes' writes.
+REFERRAL_STATS_TTL = 30  # seconds
+_referral_stats_cache = {}  # {telegram_id: (stats, expires_at)}
+_referral_stats_lock = threading.Lock()
 
-        # Total referred users (signed up through link)
-        cursor.execute('''
-            SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
-        ''', (telegram_id,))
-        result = cursor.fetchone()
-        total_referred = result[0] if result else 0
+def invalidate_referral_stats(telegram_id):
+    """Drop a user's cached referral stats (call after changing their referrals/rewards/bonus)"""
+    with _referral_stats_lock:
+        _referral_stats_cache.pop(telegram_id, None)
 
-        # Paid referrals (referred users who made a purchase)
-        cursor.execute('''
-            SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND is_paid = 1
-        ''', (telegram_id,))
-        result = cursor.fetchone()
-        paid_referrals = result[0] if result else 0
-
-        # Get bonus Days
-        cursor.execute('''
-            SELECT COALESCE(referral_bonus_days, 0) FROM users WHERE telegram_id = ?
-        ''', (telegram_id,))
-        result = cursor.fetchone()
-        bonus_days = result[0] if result else 0
-
-        # Get claimed free months
-        cursor.execute('''
-            SELECT COUNT(*) FROM referral_rewards 
-            WHERE telegram_id = ? AND reward_type = 'free_month'
-        ''', (telegram_id,))
-        result = cursor.fetchone()
-        claimed_free_months = result[0] if result else 0
-
-
-        return {
-            'total_referred': total_referred,
-            'paid_referrals': paid_referrals,
-            'bonus_days': bonus_days,
-            'claimed_free_months': claimed_free_months,
-            'can_claim_free_month': paid_referrals >= 3 and paid_referrals // 3 > claimed_free_months
-        }
+def _query_referral_stats(cursor, telegram_id):
+    """Referral statistics for a user, read in one round-trip on the given cursor"""
+    cursor.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM referrals WHERE referrer_id = ?),
+            (SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND is_paid = 1),
+            (SELECT COALESCE(referral_bonus_days, 0) FROM users WHERE telegram_id = ?),
+            (SELECT COUNT(*) FROM referral_rewards
+             WHERE telegram_id = ? AND reward_type = 'free_month')
+    ''', (telegram_id, telegram_id, telegram_id, telegram_id))
+    total_referred, paid_referrals, bonus_days, claimed_free_months = cursor.fetchone()
+    return {
+        'total_referred': total_referred,
+        'paid_referrals': paid_referrals,
+        'bonus_days': bonus_days or 0,
+        'claimed_free_months': claimed_free_months,
+        'can_claim_free_month': paid_referrals >= 3 and paid_referrals // 3 > claimed_free_months
+    }
+
+def get_referral_stats(telegram_id, fresh=False):
+    """Get referral statistics for a user (cached briefly; fresh=True for eligibility checks)"""
+    if not fresh:
+        with _referral_stats_lock:
+            cached = _referral_stats_cache.get(telegram_id)
+        if cached and cached[1] > time.monotonic():
+            return dict(cached[0])
+    with get_db() as conn:
+        stats = _query_referral_stats(conn.cursor(), telegram_id)
+    with _referral_stats_lock:
+        _referral_stats_cache[telegram_id] = (stats, time.monotonic() + REFERRAL_STATS_TTL)
+    return dict(stats)
 
 def claim_free_month_reward(telegram_id):
     """Claim free month reward for 3 paid referrals"""
     with get_db() as conn:
         cursor = conn.cursor()
 
-        # Check eligibility
-        stats = get_referral_stats(telegram_id)
+        # Check eligibility (on this connection, never from the cache)
+        stats = _query_referral_stats(cursor, telegram_id)
         if not stats['can_claim_free_month']:
             return False, "not_eligible"
 
@@ -855,9 +1059,10 @@ def claim_free_month_reward(telegram_id):
                 INSERT INTO referral_rewards (telegram_id, reward_type, reward_value, referral_count)
                 VALUES (?, 'free_month', '1 month free key', ?)
             ''', (telegram_id, stats['paid_referrals']))
-            return True, "success"
         except Exception as e:
             return False, str(e)
+    invalidate_referral_stats(telegram_id)
+    return True, "success"
 
 def get_referrer_id(referred_id):
     """Get the referrer ID for a user"""
@@ -882,7 +1087,8 @@ def use_bonus_days(telegram_id, days_amount):
             UPDATE users SET referral_bonus_days = referral_bonus_days - ?
             WHERE telegram_id = ?
         ''', (days_amount, telegram_id))
-        return True
+    invalidate_referral_stats(telegram_id)
+    return True
 
 def get_referred_users_details(referrer_id):
     """Get detailed list of referred users with their order info"""
@@ -1318,7 +1524,9 @@ def delete_server(server_id):
         cursor = conn.cursor()
         try:
             cursor.execute('DELETE FROM servers WHERE server_id = ?', (server_id,))
-            return cursor.rowcount > 0
+            deleted = cursor.rowcount > 0
+            cursor.execute('DELETE FROM disabled_servers WHERE server_id = ?', (server_id,))
+            return deleted
         except Exception as e:
             logger.error(f"Error deleting server: {e}")
             return False
@@ -1386,5 +1594,24 @@ def toggle_server_active(server_id, is_active):
     """Toggle server active status"""
     return update_server(server_id, is_active=1 if is_active else 0)
 
+def set_server_disabled(server_id, disabled):
+    """Persist a server's enabled/disabled toggle (database servers also get servers.is_active)"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if disabled:
+            cursor.execute('INSERT OR IGNORE INTO disabled_servers (server_id) VALUES (?)', (server_id,))
+        else:
+            cursor.execute('DELETE FROM disabled_servers WHERE server_id = ?', (server_id,))
+        cursor.execute('''
+            UPDATE servers SET is_active = ?, updated_at = CURRENT_TIMESTAMP WHERE server_id = ?
+        ''', (0 if disabled else 1, server_id))
+
+def get_disabled_servers():
+    """Server IDs the admin has disabled"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT server_id FROM disabled_servers')
+        return {row[0] for row in cursor.fetchall()}
+
 if __name__ == "__main__":
     init_db()
@@ -12,7 +12,7 @@ from PIL import Image
 import logging
 import threading
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +38,20 @@ MIN_IMAGE_SIZE = 10 * 1024  # 10KB min (reject tiny/empty files)
 ALLOWED_FORMATS = {'JPEG', 'PNG', 'WEBP'}
 MAX_IMAGE_DIMENSION = 4096  # Max width/height
 
+# Patterns to find amounts (prioritized) - compiled once, used for every screenshot
+AMOUNT_PATTERNS = [
+    # Amount with Ks/MMK suffix
+    re.compile(r'(\d{1,3}(?:,\d{3})*|\d+)\s*(?:Ks|KS|ks|MMK|mmk|Kyat|kyat)', re.IGNORECASE),
+    # MMK/Ks prefix
+    re.compile(r'(?:Ks|KS|ks|MMK|mmk)\s*(\d{1,3}(?:,\d{3})*|\d+)', re.IGNORECASE),
+    # Amount followed by numbers (for KBZ/Wave format)
+    re.compile(r'(?:Amount|amount|Total|total|ငွေပမာဏ|ငွေ|ပမာဏ)[:\s]*(\d{1,3}(?:,\d{3})*|\d+)', re.IGNORECASE),
+    # Transfer amount patterns
+    re.compile(r'(?:Transfer|transfer|Send|send|ငွေလွှဲ)[:\s]*(\d{1,3}(?:,\d{3})*|\d+)', re.IGNORECASE),
+    # Generic large numbers (3000+) that could be amounts
+    re.compile(r'\b(\d{1,3}(?:,\d{3})+)\b', re.IGNORECASE),  # Numbers with commas like 3,000
+]
+
 def get_reader():
     """Lazy load OCR reader to avoid slow startup - thread safe"""
     global reader
@@ -221,24 +235,10 @@ def extract_amount_from_text(text):
     # Clean text
     text = text.replace('\n', ' ').replace('  ', ' ')
     
-    # Patterns to find amounts (prioritized)
-    patterns = [
-        # Amount with Ks/MMK suffix
-        r'(\d{1,3}(?:,\d{3})*|\d+)\s*(?:Ks|KS|ks|MMK|mmk|Kyat|kyat)',
-        # MMK/Ks prefix
-        r'(?:Ks|KS|ks|MMK|mmk)\s*(\d{1,3}(?:,\d{3})*|\d+)',
-        # Amount followed by numbers (for KBZ/Wave format)
-        r'(?:Amount|amount|Total|total|ငွေပမာဏ|ငွေ|ပမာဏ)[:\s]*(\d{1,3}(?:,\d{3})*|\d+)',
-        # Transfer amount patterns
-        r'(?:Transfer|transfer|Send|send|ငွေလွှဲ)[:\s]*(\d{1,3}(?:,\d{3})*|\d+)',
-        # Generic large numbers (3000+) that could be amounts
-        r'\b(\d{1,3}(?:,\d{3})+)\b',  # Numbers with commas like 3,000
-    ]
-    
     amounts_found = []
     
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
+    for pattern in AMOUNT_PATTERNS:
+        matches = pattern.findall(text)
         for match in matches:
             # Remove commas and convert to int
             amount_str = match.replace(',', '').replace(' ', '')
@@ -252,7 +252,6 @@ def extract_amount_from_text(text):
     
     if amounts_found:
         # Return most common amount, or largest if all unique
-        from collections import Counter
         amount_counts = Counter(amounts_found)
         most_common = amount_counts.most_common(1)
         if most_common:
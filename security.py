@@ -21,8 +21,9 @@ class RateLimiter:
     """Enhanced rate limiter to prevent spam, DDoS and abuse with auto-block"""
     
     def __init__(self):
-        # Store: {user_id: [(timestamp, action_type), ...]}
-        self.user_actions: Dict[int, list] = defaultdict(list)
+        # Fixed-window counters: {(user_id, action_type, window_index): [count, expires_at]}
+        self.counters: Dict[tuple, list] = {}
+        self._last_purge = time.time()
         self.banned_users: Dict[int, datetime] = {}  # Temporary bans (runtime)
         self.ip_tracking: Dict[str, list] = defaultdict(list)  # IP-based tracking
         self.global_request_count = 0
@@ -66,13 +67,37 @@ class RateLimiter:
         # Callback for database ban (set by bot.py)
         self.db_ban_callback = None
         
-    def _cleanup_old_actions(self, user_id: int, period: int):
-        """Remove actions older than the specified period"""
-        cutoff = time.time() - period
-        self.user_actions[user_id] = [
-            (ts, action) for ts, action in self.user_actions[user_id]
-            if ts > cutoff
-        ]
+    def _bucket_key(self, user_id: int, action_type: str, period: int, now: float) -> tuple:
+        """Counter key for the fixed window containing 'now'"""
+        return (user_id, action_type, int(now // period))
+    
+    def _get_count(self, key: tuple, now: float) -> int:
+        """Current count of a counter (0 if missing or expired)"""
+        bucket = self.counters.get(key)
+        if bucket is None or bucket[1] <= now:
+            return 0
+        return bucket[0]
+    
+    def _incr(self, key: tuple, period: int, now: float) -> int:
+        """Increment a counter that expires at the end of its window (INCR + EXPIRE)"""
+        bucket = self.counters.get(key)
+        if bucket is None or bucket[1] <= now:
+            bucket = self.counters[key] = [0, (key[2] + 1) * period]
+        bucket[0] += 1
+        return bucket[0]
+    
+    def _purge_expired(self, now: float):
+        """Drop expired counters, bans and idle DDoS trackers so memory tracks active users only"""
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        self.counters = {k: v for k, v in self.counters.items() if v[1] > now}
+        for user_id in [uid for uid, s in self.ddos_suspects.items()
+                        if now - max(s['first_request'], s['last_violation']) > 3600]:
+            del self.ddos_suspects[user_id]
+        current_dt = datetime.now()
+        for user_id in [uid for uid, until in list(self.banned_users.items()) if until <= current_dt]:
+            self.banned_users.pop(user_id, None)
     
     def is_banned(self, user_id: int) -> bool:
         """Check if user is temporarily banned"""
@@ -80,7 +105,7 @@ class RateLimiter:
             if datetime.now() < self.banned_users[user_id]:
                 return True
             else:
-                del self.banned_users[user_id]
+                self.banned_users.pop(user_id, None)
         return False
     
     def ban_user(self, user_id: int, duration: int = None, reason: str = "rate_limit", persist_to_db: bool = False):
@@ -197,36 +222,37 @@ class RateLimiter:
         # Get limit config
         limit_config = self.limits.get(action_type, self.limits['message'])
         
-        # Cleanup old actions
-        self._cleanup_old_actions(user_id, limit_config['period'])
-        
-        # Count recent actions of this type
-        action_count = sum(
-            1 for ts, action in self.user_actions[user_id]
-            if action == action_type
-        )
-        
-        # Check spam (any action type) - stricter threshold
-        total_actions = len(self.user_actions[user_id])
-        if total_actions >= self.spam_threshold:
-            # Ban user and persist to database for repeated offenders
-            persist = total_actions >= self.spam_threshold * 1.5  # Persist if 1.5x threshold
-            self.ban_user(user_id, self.severe_ban_duration, "spam_detected", persist_to_db=persist)
-            return False, "⚠️ Request များ အများကြီး ပို့နေပါသည်! 2 နာရီ ယာယီ block ခံရပါမည်။"
-        
-        # Warning at 80% of threshold
-        if total_actions >= self.spam_threshold * 0.8:
-            logger.warning(f"⚠️ User {user_id} approaching spam threshold: {total_actions}/{self.spam_threshold}")
-        
-        # Check specific rate limit
-        if action_count >= limit_config['count']:
-            # Record violation for DDoS tracking
-            self.ddos_suspects[user_id]['violations'] += 1
-            return False, f"⚠️ Rate limit ကျော်နေပါသည်။ ခဏနေ ပြန်စမ်းပါ။"
-        
-        # Record this action
-        self.user_actions[user_id].append((current_time, action_type))
-        return True, ""
+        with self._lock:
+            self._purge_expired(current_time)
+            
+            action_key = self._bucket_key(user_id, action_type, limit_config['period'], current_time)
+            spam_key = self._bucket_key(user_id, '*', 60, current_time)
+            
+            # Count recent actions of this type
+            action_count = self._get_count(action_key, current_time)
+            
+            # Check spam (any action type in the last minute) - stricter threshold
+            total_actions = self._get_count(spam_key, current_time)
+            if total_actions >= self.spam_threshold:
+                # Ban user and persist to database for repeated offenders
+                persist = total_actions >= self.spam_threshold * 1.5  # Persist if 1.5x threshold
+                self.ban_user(user_id, self.severe_ban_duration, "spam_detected", persist_to_db=persist)
+                return False, "⚠️ Request များ အများကြီး ပို့နေပါသည်! 2 နာရီ ယာယီ block ခံရပါမည်။"
+            
+            # Warning at 80% of threshold
+            if total_actions >= self.spam_threshold * 0.8:
+                logger.warning(f"⚠️ User {user_id} approaching spam threshold: {total_actions}/{self.spam_threshold}")
+            
+            # Check specific rate limit
+            if action_count >= limit_config['count']:
+                # Record violation for DDoS tracking
+                self.ddos_suspects[user_id]['violations'] += 1
+                return False, f"⚠️ Rate limit ကျော်နေပါသည်။ ခဏနေ ပြန်စမ်းပါ။"
+            
+            # Record this action
+            self._incr(action_key, limit_config['period'], current_time)
+            self._incr(spam_key, 60, current_time)
+            return True, ""
 
 
 # ===================== INPUT VALIDATION =====================
@@ -339,6 +365,22 @@ class InputValidator:
         r'\\\\windows',
     ]
     
+    # Compiled once at import - is_safe_text runs on every message and callback, so each
+    # category is a single alternation: one scan of the text per category, not per pattern
+    _PROMPT_INJECTION_RES = [re.compile(p, re.IGNORECASE) for p in PROMPT_INJECTION_PATTERNS]
+    _PROMPT_INJECTION_RE = re.compile('|'.join(f'(?:{p})' for p in PROMPT_INJECTION_PATTERNS), re.IGNORECASE)
+    _DANGEROUS_RE = re.compile('|'.join(f'(?:{p})' for p in DANGEROUS_PATTERNS), re.IGNORECASE)
+    _SQL_RE = re.compile('|'.join(f'(?:{p})' for p in SQL_PATTERNS), re.IGNORECASE)
+    _COMMAND_RE = re.compile('|'.join(f'(?:{p})' for p in COMMAND_PATTERNS))
+    _PATH_TRAVERSAL_RE = re.compile('|'.join(f'(?:{p})' for p in PATH_TRAVERSAL_PATTERNS), re.IGNORECASE)
+    _USERNAME_UNSAFE_RE = re.compile(r'[^\w]')
+    # sanitize_text in one C-level pass: drop control chars (keeping \n and \t), escape HTML
+    _SANITIZE_TRANS = str.maketrans({
+        **{chr(c): None for c in range(32) if chr(c) not in '\n\t'},
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+        "'": '&#x27;', '/': '&#x2F;', '\\': '&#x5C;',
+    })
+    
     @classmethod
     def is_safe_text(cls, text: str) -> tuple[bool, str]:
         """
@@ -351,30 +393,27 @@ class InputValidator:
         text_lower = text.lower()
         
         # Check prompt injection (highest priority for bots)
-        for pattern in cls.PROMPT_INJECTION_PATTERNS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                logger.warning(f"Prompt injection attempt detected: {pattern}")
-                return False, "prompt_injection"
+        if cls._PROMPT_INJECTION_RE.search(text_lower):
+            # Rare path - find the individual pattern for the log
+            pattern = next(p for p in cls._PROMPT_INJECTION_RES if p.search(text_lower))
+            logger.warning(f"Prompt injection attempt detected: {pattern.pattern}")
+            return False, "prompt_injection"
         
         # Check dangerous patterns
-        for pattern in cls.DANGEROUS_PATTERNS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return False, "dangerous_pattern"
+        if cls._DANGEROUS_RE.search(text_lower):
+            return False, "dangerous_pattern"
         
         # Check SQL injection
-        for pattern in cls.SQL_PATTERNS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return False, "sql_injection"
+        if cls._SQL_RE.search(text_lower):
+            return False, "sql_injection"
         
         # Check command injection
-        for pattern in cls.COMMAND_PATTERNS:
-            if re.search(pattern, text):
-                return False, "command_injection"
+        if cls._COMMAND_RE.search(text):
+            return False, "command_injection"
         
         # Check path traversal
-        for pattern in cls.PATH_TRAVERSAL_PATTERNS:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return False, "path_traversal"
+        if cls._PATH_TRAVERSAL_RE.search(text_lower):
+            return False, "path_traversal"
         
         # Check for excessive length (potential buffer overflow)
         if len(text) > 4096:
@@ -392,25 +431,8 @@ class InputValidator:
         if not text:
             return ""
         
-        # Truncate to max length
-        text = text[:max_length]
-        
-        # Remove null bytes
-        text = text.replace('\x00', '')
-        
-        # Remove control characters (except newline and tab)
-        text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\t')
-        
-        # Escape HTML special characters
-        text = text.replace('&', '&amp;')
-        text = text.replace('<', '&lt;')
-        text = text.replace('>', '&gt;')
-        text = text.replace('"', '&quot;')
-        text = text.replace("'", '&#x27;')
-        text = text.replace('/', '&#x2F;')
-        text = text.replace('\\', '&#x5C;')
-        
-        return text.strip()
+        # Truncate, remove null bytes/control characters and escape HTML special characters
+        return text[:max_length].translate(cls._SANITIZE_TRANS).strip()
     
     @classmethod
     def sanitize_username(cls, username: str) -> str:
@@ -419,7 +441,7 @@ class InputValidator:
             return ""
         
         # Only allow alphanumeric, underscore
-        sanitized = re.sub(r'[^\w]', '', username)
+        sanitized = cls._USERNAME_UNSAFE_RE.sub('', username)
         return sanitized[:64]  # Max 64 chars
     
     @classmethod
@@ -625,9 +647,19 @@ VALID_CALLBACK_PREFIXES = [
     'view_key_',
 ]
 
+# Precomputed for is_valid_callback (runs on every callback):
+# str.startswith(tuple) does the prefix scan in C, bare names are a set lookup
+VALID_CALLBACK_PREFIX_TUPLE = tuple(VALID_CALLBACK_PREFIXES)
+VALID_CALLBACK_EXACT = frozenset(prefix.rstrip('_') for prefix in VALID_CALLBACK_PREFIXES)
+_UNSAFE_CALLBACK_CHARS = frozenset('<>"\';|&')
+
 def is_valid_callback(callback_data: str) -> bool:
-    """Check if callback data is valid"""
-    return InputValidator.validate_callback_data(callback_data, VALID_CALLBACK_PREFIXES)
+    """Check if callback data is valid (same rules as InputValidator.validate_callback_data)"""
+    if not callback_data or len(callback_data) > 64:
+        return False
+    if not _UNSAFE_CALLBACK_CHARS.isdisjoint(callback_data):
+        return False
+    return callback_data in VALID_CALLBACK_EXACT or callback_data.startswith(VALID_CALLBACK_PREFIX_TUPLE)
 
 
 # ===================== ANTI-ABUSE MEASURES =====================
@@ -1,9 +1,13 @@
 import requests
 import json
+import base64
+import urllib.parse
 import uuid
 import random
 import string
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
 from config import SERVERS as CONFIG_SERVERS, XUI_USERNAME, XUI_PASSWORD
 from requests.adapters import HTTPAdapter
@@ -15,6 +19,20 @@ logger = logging.getLogger(__name__)
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Optional: orjson serializes the vmess:// config faster; output is identical to the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def encode_vmess_link(vmess_config):
+    """vmess:// share link - base64 of the compact JSON config"""
+    if orjson is not None:
+        payload = orjson.dumps(vmess_config)
+    else:
+        payload = json.dumps(vmess_config, separators=(',', ':'), ensure_ascii=False).encode()
+    return "vmess://" + base64.b64encode(payload).decode('ascii')
+
 # Server down alert callback (set by bot.py)
 _server_alert_callback = None
 
@@ -35,24 +53,40 @@ def _get_server(server_id):
     return CONFIG_SERVERS.get(server_id)
 
 
+# Keep-alive HTTP sessions, one per panel URL: {base_url: requests.Session}
+_panel_sessions = {}
+_panel_sessions_lock = threading.Lock()
+
+def _get_panel_session(base_url):
+    """Get (or create) the shared requests.Session for a panel"""
+    with _panel_sessions_lock:
+        session = _panel_sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            
+            # Add retry strategy
+            retry_strategy = Retry(
+                total=3,
+                backoff_factor=1,
+                status_forcelist=[500, 502, 503, 504],
+            )
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry_strategy)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _panel_sessions[base_url] = session
+        return session
+
+
 class XUIApi:
     def __init__(self, server_id):
         self.server = _get_server(server_id)
         if not self.server:
             raise ValueError(f"Server {server_id} not found")
+        self.server_id = server_id
         self.base_url = self.server['url'] + self.server['panel_path']
-        self.session = requests.Session()
-        self.session.verify = False
-        
-        # Add retry strategy
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504],
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
+        # Shared per panel so TCP/TLS connections are kept alive across calls
+        self.session = _get_panel_session(self.base_url)
         
         self.logged_in = False
         
@@ -69,7 +103,7 @@ class XUIApi:
             
             if result.get('success'):
                 self.logged_in = True
-                logger.info(f"✅ Logged in to {self.server['name']}")
+                logger.info("✅ Logged in to %s", self.server['name'])
                 return True
             else:
                 logger.error(f"❌ Login failed for {self.server['name']}: {result.get('msg')}")
@@ -262,12 +296,13 @@ class XUIApi:
                 "settings": json.dumps({"clients": [client_settings]})
             }
             
-            logger.info(f"📡 Creating client: {client_name} with protocol: {inbound_protocol}")
+            logger.info("📡 Creating client: %s with protocol: %s", client_name, inbound_protocol)
             response = self.session.post(url, data=payload)
+            invalidate_clients_cache(self.server_id)  # Panel changed
             result = response.json()
             
             if result.get('success'):
-                logger.info(f"✅ Client created: {client_name}")
+                logger.info("✅ Client created: %s", client_name)
                 
                 # Generate subscription link
                 sub_link = f"https://{self.server['domain']}:{self.server['sub_port']}/sub/{sub_id}"
@@ -285,7 +320,6 @@ class XUIApi:
                 expiry_days_left = f"{days_remaining}D"
                 
                 # URL encode the remark
-                import urllib.parse
                 encoded_remark = urllib.parse.quote(f"{remark}-{client_name}-{expiry_days_left}")
                 
                 if inbound_protocol == 'trojan':
@@ -295,7 +329,6 @@ class XUIApi:
                 elif inbound_protocol == 'vless':
                     config_link = f"vless://{client_uuid}@{self.server['domain']}:{port}?type=tcp&security=none#{encoded_remark}"
                 elif inbound_protocol == 'vmess':
-                    import base64
                     vmess_config = {
                         "v": "2",
                         "ps": f"{remark}-{client_name}",
@@ -307,13 +340,12 @@ class XUIApi:
                         "type": "none",
                         "tls": ""
                     }
-                    config_link = "vmess://" + base64.b64encode(json.dumps(vmess_config).encode()).decode()
+                    config_link = encode_vmess_link(vmess_config)
                 elif inbound_protocol == 'shadowsocks':
                     # Get shadowsocks settings from inbound
                     ss_settings = json.loads(inbound.get('settings', '{}'))
                     method = ss_settings.get('method', 'aes-256-gcm')
                     password = client_settings.get('password', client_uuid)
-                    import base64
                     ss_auth = base64.b64encode(f"{method}:{password}".encode()).decode()
                     config_link = f"ss://{ss_auth}@{self.server['domain']}:{port}#{encoded_remark}"
                 else:
@@ -349,6 +381,7 @@ class XUIApi:
         try:
             url = f"{self.base_url}/panel/api/inbounds/{inbound_id}/delClient/{client_email}"
             response = self.session.post(url)
+            invalidate_clients_cache(self.server_id)  # Panel changed
             result = response.json()
             return result.get('success', False)
         except Exception as e:
@@ -394,6 +427,7 @@ class XUIApi:
         try:
             url = f"{self.base_url}/panel/api/inbounds/{inbound_id}/resetClientTraffic/{client_email}"
             response = self.session.post(url)
+            invalidate_clients_cache(self.server_id)  # Panel changed
             result = response.json()
             return result.get('success', False)
         except Exception as e:
@@ -437,11 +471,12 @@ class XUIApi:
             }
             
             response = self.session.post(url, data=payload)
+            invalidate_clients_cache(self.server_id)  # Panel changed
             result = response.json()
             
             if result.get('success'):
                 new_dt = datetime.fromtimestamp(new_expiry_ms / 1000)
-                logger.info(f"✅ Extended {client_email} by {extra_days} days → {new_dt.strftime('%Y-%m-%d %H:%M')}")
+                logger.info("✅ Extended %s by %s days → %s", client_email, extra_days, new_dt.strftime('%Y-%m-%d %H:%M'))
                 return True
             else:
                 logger.error(f"❌ Failed to extend client: {result.get('msg')}")
@@ -503,12 +538,13 @@ def delete_vpn_client_xui(server_id, client_email):
     if not client_uuid:
         client_uuid = client.get('email')
     
-    logger.info(f"🗑️ Deleting client: {client_email} (UUID: {client_uuid}) from inbound {inbound_id}")
+    logger.info("🗑️ Deleting client: %s (UUID: %s) from inbound %s", client_email, client_uuid, inbound_id)
     
     try:
         # Delete client from inbound - use UUID
         url = f"{api.base_url}/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
         response = api.session.post(url)
+        invalidate_clients_cache(server_id)  # Panel changed
         
         # Check if response is valid JSON
         try:
@@ -518,13 +554,14 @@ def delete_vpn_client_xui(server_id, client_email):
             # Try alternative deletion method with email
             url2 = f"{api.base_url}/panel/api/inbounds/{inbound_id}/delClient/{client.get('email')}"
             response2 = api.session.post(url2)
+            invalidate_clients_cache(server_id)
             try:
                 result = response2.json()
             except:
                 return False
         
         if result.get('success'):
-            logger.info(f"✅ Deleted client {client_email} from panel")
+            logger.info("✅ Deleted client %s from panel", client_email)
             return True
         else:
             logger.error(f"❌ Failed to delete client: {result.get('msg')}")
@@ -539,12 +576,12 @@ if __name__ == "__main__":
     api = XUIApi('sg1')
     if api.login():
         inbounds = api.get_inbounds()
-        logger.debug(f"Found {len(inbounds)} inbounds")
+        logger.debug("Found %s inbounds", len(inbounds))
         for ib in inbounds:
-            logger.debug(f"  - {ib.get('remark')} ({ib.get('protocol')})")
+            logger.debug("  - %s (%s)", ib.get('remark'), ib.get('protocol'))
         
         protocols = api.get_available_protocols()
-        logger.debug(f"Available protocols: {protocols}")
+        logger.debug("Available protocols: %s", protocols)
 
 
 # ===================== UNIFIED API =====================
@@ -557,7 +594,7 @@ def create_vpn_key(server_id, telegram_id, username, data_limit_gb=0, expiry_day
         logger.error(f"❌ Server {server_id} not found")
         return None
     
-    logger.info(f"📡 Creating VPN key on {server['name']}")
+    logger.info("📡 Creating VPN key on %s", server['name'])
     
     api = XUIApi(server_id)
     if not api.login():
@@ -594,10 +631,11 @@ def delete_vpn_client(server_id, client_id):
                 try:
                     url = f"{api.base_url}/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
                     response = api.session.post(url)
+                    invalidate_clients_cache(server_id)  # Panel changed
                     result = response.json()
                     
                     if result.get('success'):
-                        logger.info(f"✅ Deleted client {client_email}")
+                        logger.info("✅ Deleted client %s", client_email)
                         return True
                 except Exception as e:
                     logger.error(f"❌ Error deleting client: {e}")
@@ -633,32 +671,106 @@ def verify_client_exists(server_id, client_id):
     
     return False
 
+# list_all_clients cache: {server_id: (clients_by_key, timestamp)}. Panels only change through
+# this bot's own XUIApi calls, which invalidate it, so the TTL just bounds drift from manual edits.
+_clients_cache = {}
+_clients_cache_gen = {}  # {server_id: invalidation count} - stops a fetch that raced an invalidation from caching
+_clients_cache_lock = threading.Lock()
+_CLIENTS_CACHE_TTL = 10
 
-# Protocol cache: {server_id: (protocols_list, timestamp)}
-_protocol_cache = {}
-_PROTOCOL_CACHE_TTL = 300  # 5 minutes
-
-def get_available_protocols(server_id):
-    """Get available protocols from XUI panel (cached for 5 min)"""
-    import time as _cache_time
-    
-    # Check cache
-    if server_id in _protocol_cache:
-        cached_protocols, cached_at = _protocol_cache[server_id]
-        if _cache_time.time() - cached_at < _PROTOCOL_CACHE_TTL:
-            return cached_protocols
+def list_all_clients(server_id):
+    """All clients of a panel in one inbounds request: {client uuid/password or email: {'client', 'inbound'}}
+    Lookups match verify_client_exists(); returns None if the panel can't be read, so callers can
+    tell an outage from a missing client. Cached for 10s - treat the result as read-only."""
+    cached = _clients_cache.get(server_id)
+    if cached and time.time() - cached[1] < _CLIENTS_CACHE_TTL:
+        return cached[0]
     
+    gen = _clients_cache_gen.get(server_id, 0)
+    clients_by_key = _fetch_all_clients(server_id)
+    if clients_by_key is not None:  # Don't cache an unreachable panel
+        with _clients_cache_lock:
+            if _clients_cache_gen.get(server_id, 0) == gen:
+                _clients_cache[server_id] = (clients_by_key, time.time())
+    return clients_by_key
+
+def invalidate_clients_cache(server_id):
+    """Drop a server's cached client list (after any panel change)"""
+    with _clients_cache_lock:
+        _clients_cache.pop(server_id, None)
+        _clients_cache_gen[server_id] = _clients_cache_gen.get(server_id, 0) + 1
+
+def _fetch_all_clients(server_id):
+    """Uncached list_all_clients"""
     server = _get_server(server_id)
     if not server:
-        return []
+        return None
     
     api = XUIApi(server_id)
     if not api.login():
-        return []
+        return None
+    
+    inbounds = api.get_inbounds()
+    if not inbounds:  # get_inbounds() returns [] on request/API errors too
+        return None
+    
+    clients_by_key = {}
+    for inbound in inbounds:
+        settings = json.loads(inbound.get('settings', '{}'))
+        for client in settings.get('clients', []):
+            info = {'client': client, 'inbound': inbound}
+            # setdefault keeps the first match, like verify_client_exists' scan order
+            client_uuid = client.get('id') or client.get('password')
+            if client_uuid:
+                clients_by_key.setdefault(client_uuid, info)
+            if client.get('email'):
+                clients_by_key.setdefault(client['email'], info)
+    return clients_by_key
+
+
+# Protocol cache: {server_id: (protocols_list, timestamp, ttl)}
+_protocol_cache = {}
+_protocol_cache_locks = {}
+_protocol_cache_lock = threading.Lock()
+_PROTOCOL_CACHE_TTL = 300  # 5 minutes
+_PROTOCOL_FAIL_TTL = 30  # Don't hammer a panel that is down on every menu open
+
+def get_available_protocols(server_id):
+    """Get available protocols from XUI panel (cached for 5 min)"""
+    # Check cache
+    cached = _protocol_cache.get(server_id)
+    if cached and time.time() - cached[1] < cached[2]:
+        return cached[0]
     
-    protocols = api.get_available_protocols()
+    # Only one thread refreshes a given server; others wait and reuse its result
+    with _protocol_cache_lock:
+        server_lock = _protocol_cache_locks.setdefault(server_id, threading.Lock())
     
-    # Store in cache
-    _protocol_cache[server_id] = (protocols, _cache_time.time())
-    return protocols
+    with server_lock:
+        cached = _protocol_cache.get(server_id)
+        if cached and time.time() - cached[1] < cached[2]:
+            return cached[0]
+        
+        server = _get_server(server_id)
+        if not server:
+            return []
+        
+        api = XUIApi(server_id)
+        if api.login():
+            protocols = api.get_available_protocols()
+        else:
+            protocols = []
+        
+        # Store in cache (failures only briefly)
+        ttl = _PROTOCOL_CACHE_TTL if protocols else _PROTOCOL_FAIL_TTL
+        _protocol_cache[server_id] = (protocols, time.time(), ttl)
+        return protocols
 
+
+def invalidate_protocol_cache(server_id=None):
+    """Drop cached protocols for one server (or all servers)"""
+    with _protocol_cache_lock:
+        if server_id is None:
+            _protocol_cache.clear()
+        else:
+            _protocol_cache.pop(server_id, None)